@@ -0,0 +1,284 @@
+import json
+import random
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from xml.sax.saxutils import escape
+
+
+WORDS = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta", "iota", "kappa", "lambda", "mu",
+         "ocean", "glacier", "forest", "prairie", "river", "genome", "survey", "census", "climate", "sediment"]
+INSTITUTIONS = ["University of Alberta", "McGill University", "University of British Columbia", "Dalhousie University",
+                "Université de Montréal", "University of Toronto", "Simon Fraser University", "Université Laval"]
+
+
+class SyntheticCorpus(object):
+    """ A deterministic set of records; the same size and seed always give the same metadata """
+
+    def __init__(self, size, seed=0):
+        self.size = int(size)
+        self.seed = seed
+
+    def item(self, i):
+        """ The fields shared by every protocol for item i """
+        rng = random.Random("{}-{}".format(self.seed, i))
+        words = lambda n: " ".join(rng.choice(WORDS) for _ in range(n))
+        return {
+            "title": "Dataset {} {}".format(i, words(4)).title(),
+            "creators": ["{}, {}.".format(rng.choice(WORDS).title(), rng.choice("ABCDEFGHJKLM"))
+                         for _ in range(1 + i % 4)],
+            "affiliation": INSTITUTIONS[i % len(INSTITUTIONS)],
+            "subjects": sorted({rng.choice(WORDS) for _ in range(3)}),
+            "description": "Synthetic record {}. {}".format(i, words(40)),
+            "date": "20{:02d}-{:02d}-{:02d}".format(13 + i % 10, 1 + i % 12, 1 + i % 28),
+            "rights": "CC-BY {}.0".format(1 + i % 4),
+            "publisher": "Publisher {}".format(i % 7)
+        }
+
+
+class MockRepositoryHandler(BaseHTTPRequestHandler):
+    """ Answers OAI-PMH, CKAN, Dataverse and DataCite API requests from the server's corpus """
+
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately; without this, keep-alive requests wait on delayed ACKs
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        self.body = self.rfile.read(length) if length else b""
+        self.dispatch()
+
+    def dispatch(self):
+        self.server.count_request()
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        url = urlparse(self.path)
+        query = {key: value[0] for key, value in parse_qs(url.query).items()}
+        protocol, _, path = url.path.lstrip("/").partition("/")
+        handler = getattr(self, "handle_" + protocol, None)
+        try:
+            if handler is None:
+                raise KeyError(url.path)
+            content_type, body = handler("/" + path, query)
+        except (KeyError, ValueError, IndexError):
+            self.respond(404, "application/json", json.dumps({"status": "ERROR", "message": "Not found"}))
+            return
+        self.respond(200, content_type, body)
+
+    def respond(self, status, content_type, body):
+        data = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type + "; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def item_index(self, identifier, prefix):
+        if not identifier.startswith(prefix):
+            raise KeyError(identifier)
+        i = int(identifier[len(prefix):])
+        if i < 0 or i >= self.server.corpus.size:
+            raise IndexError(identifier)
+        return i
+
+    # OAI-PMH, oai_dc only
+
+    def handle_oai(self, path, query):
+        verb = query.get("verb")
+        if verb == "Identify":
+            return "text/xml", self.oai_response(verb, "<Identify><repositoryName>Benchmark</repositoryName>"
+                                                       "<granularity>YYYY-MM-DDThh:mm:ssZ</granularity></Identify>")
+        if verb == "GetRecord":
+            i = self.item_index(query["identifier"], "oai:benchmark:")
+            return "text/xml", self.oai_response(verb, "<GetRecord>{}</GetRecord>".format(self.oai_record(i)))
+        if verb == "ListRecords":
+            start = int(query.get("resumptionToken", 0))
+            end = min(start + self.server.page_size, self.server.corpus.size)
+            token = ""
+            if end < self.server.corpus.size:
+                token = '<resumptionToken completeListSize="{}" cursor="{}">{}</resumptionToken>'.format(
+                    self.server.corpus.size, start, end)
+            records = "".join(self.oai_record(i) for i in range(start, end))
+            return "text/xml", self.oai_response(verb, "<ListRecords>{}{}</ListRecords>".format(records, token))
+        raise KeyError(verb)
+
+    def oai_response(self, verb, contents):
+        return ('<?xml version="1.0" encoding="UTF-8"?>'
+                '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/">'
+                '<responseDate>2024-01-01T00:00:00Z</responseDate>'
+                '<request verb="{}">{}/oai</request>{}</OAI-PMH>').format(verb, self.server.base_url, contents)
+
+    def oai_record(self, i):
+        item = self.server.corpus.item(i)
+        fields = [("title", item["title"])] + [("creator", c) for c in item["creators"]] + \
+                 [("subject", s) for s in item["subjects"]] + \
+                 [("description", item["description"]), ("publisher", item["publisher"]), ("date", item["date"]),
+                  ("type", "Dataset"), ("rights", item["rights"]),
+                  ("identifier", "https://benchmark.example.org/record/{}".format(i))]
+        metadata = "".join("<dc:{0}>{1}</dc:{0}>".format(name, escape(value)) for name, value in fields)
+        return ('<record><header><identifier>oai:benchmark:{}</identifier><datestamp>{}T00:00:00Z</datestamp></header>'
+                '<metadata><oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" '
+                'xmlns:dc="http://purl.org/dc/elements/1.1/">{}</oai_dc:dc></metadata></record>').format(
+            i, item["date"], metadata)
+
+    # CKAN action API
+
+    def handle_ckan(self, path, query):
+        action = path.rsplit("/", 1)[-1]
+        if action == "package_list":
+            # The CKAN harvester pages with limit and offset in the action name once a list has 1000 entries
+            offset = int(query.get("offset", 0))
+            limit = int(query.get("limit", self.server.corpus.size))
+            names = ["benchmark-{}".format(i) for i in range(offset, min(offset + limit, self.server.corpus.size))]
+            return "application/json", json.dumps({"success": True, "result": names})
+        if action == "package_show":
+            args = json.loads(self.body.decode("utf-8")) if getattr(self, "body", None) else query
+            i = self.item_index(args["id"], "benchmark-")
+            return "application/json", json.dumps({"success": True, "result": self.ckan_package(i)})
+        raise KeyError(action)
+
+    def ckan_package(self, i):
+        item = self.server.corpus.item(i)
+        return {
+            "id": "benchmark-{}".format(i),
+            "name": "benchmark-{}".format(i),
+            "type": "dataset",
+            "title": item["title"],
+            "notes": item["description"],
+            "author": "; ".join(item["creators"]),
+            "url": "https://benchmark.example.org/dataset/{}".format(i),
+            "metadata_created": item["date"] + "T00:00:00.000000",
+            "license_title": item["rights"],
+            "organization": {"title": item["publisher"]},
+            "tags": [{"display_name": s} for s in item["subjects"]],
+            "resources": [{"url": "https://benchmark.example.org/dataset/{}/data.csv".format(i)}]
+        }
+
+    # Dataverse native API; every tenth dataset is in a sub-dataverse
+
+    def handle_dataverse(self, path, query):
+        parts = path.strip("/").split("/")
+        if parts[:2] == ["api", "dataverses"] and len(parts) == 4 and parts[3] == "contents":
+            if parts[2] == ":root":
+                data = [{"type": "dataset", "id": 1000 + i} for i in range(self.server.corpus.size) if i % 10]
+                data.append({"type": "dataverse", "id": 2})
+            elif parts[2] == "2":
+                data = [{"type": "dataset", "id": 1000 + i} for i in range(0, self.server.corpus.size, 10)]
+            else:
+                raise KeyError(path)
+            return "application/json", json.dumps({"status": "OK", "data": data})
+        if parts[:2] == ["api", "dataverses"] and len(parts) == 3:
+            if parts[2] != "2":
+                raise KeyError(path)
+            return "application/json", json.dumps({"status": "OK", "data": {"id": 2, "name": "Benchmark Collection"}})
+        if parts[:2] == ["api", "datasets"] and len(parts) == 3:
+            i = int(parts[2]) - 1000
+            self.item_index(str(i), "")
+            return "application/json", json.dumps({"status": "OK", "data": self.dataverse_dataset(i)})
+        raise KeyError(path)
+
+    def dataverse_dataset(self, i):
+        item = self.server.corpus.item(i)
+        fields = [
+            {"typeName": "title", "value": item["title"]},
+            {"typeName": "author", "value": [{"authorName": {"value": c},
+                                              "authorAffiliation": {"value": item["affiliation"]}}
+                                             for c in item["creators"]]},
+            {"typeName": "dsDescription", "value": [{"dsDescriptionValue": {"value": item["description"]}}]},
+            {"typeName": "subject", "value": ["Earth and Environmental Sciences"]},
+            {"typeName": "keyword", "value": [{"keywordValue": {"value": s}} for s in item["subjects"]]}
+        ]
+        return {
+            "id": 1000 + i,
+            "publicationDate": item["date"],
+            "persistentUrl": "https://doi.org/10.80240/benchmark-{}".format(i),
+            "latestVersion": {
+                "license": item["rights"],
+                "files": [{"restricted": False, "dataFile": {"id": 50000 + i, "filename": "data{}.csv".format(i)}}],
+                "metadataBlocks": {"citation": {"fields": fields}}
+            }
+        }
+
+    # DataCite REST API
+
+    def handle_datacite(self, path, query):
+        parts = path.strip("/").split("/", 1)
+        if parts[0] != "dois":
+            raise KeyError(path)
+        if len(parts) == 2:
+            i = self.item_index(parts[1], "10.80240/benchmark-")
+            return "application/json", json.dumps({"data": self.datacite_doi(i)})
+        page_size = int(query.get("page[size]", self.server.page_size))
+        total_pages = max(1, (self.server.corpus.size + page_size - 1) // page_size)
+        # Page numbers, or a cursor that is simply the next page number
+        page = int(query.get("page[number]", query.get("page[cursor]", 1)))
+        start = (page - 1) * page_size
+        ids = ["10.80240/benchmark-{}".format(i) for i in range(start, min(start + page_size, self.server.corpus.size))]
+        body = {"data": [{"id": doi} for doi in ids], "meta": {"totalPages": total_pages}, "links": {}}
+        if "page[cursor]" in query and page < total_pages:
+            body["links"]["next"] = "{}/datacite/dois?client-id={}&page[size]={}&page[cursor]={}".format(
+                self.server.base_url, query.get("client-id", ""), page_size, page + 1)
+        return "application/json", json.dumps(body)
+
+    def datacite_doi(self, i):
+        item = self.server.corpus.item(i)
+        return {
+            "id": "10.80240/benchmark-{}".format(i),
+            "attributes": {
+                "types": {"resourceTypeGeneral": "Dataset"},
+                "creators": [{"name": c, "affiliation": [item["affiliation"]]} for c in item["creators"]],
+                "titles": [{"title": item["title"], "lang": "en"}],
+                "publisher": item["publisher"],
+                "publicationYear": int(item["date"][:4]),
+                "dates": [{"dateType": "Issued", "date": item["date"]}],
+                "subjects": [{"subject": s} for s in item["subjects"]],
+                "contributors": [],
+                "rightsList": [{"rights": item["rights"]}],
+                "descriptions": [{"description": item["description"], "descriptionType": "Abstract"}],
+                "geoLocations": [{"geoLocationPlace": "Canada"}]
+            }
+        }
+
+
+class MockRepositoryServer(ThreadingHTTPServer):
+    """ A local stand-in for OAI-PMH, CKAN, Dataverse and DataCite repositories, serving a synthetic corpus """
+
+    daemon_threads = True
+
+    def __init__(self, size, page_size=100, latency=0.0, seed=0, host="127.0.0.1", port=0):
+        super(MockRepositoryServer, self).__init__((host, port), MockRepositoryHandler)
+        self.corpus = SyntheticCorpus(size, seed)
+        self.page_size = int(page_size)
+        self.latency = float(latency)
+        self.base_url = "http://{}:{}".format(host, self.server_port)
+        self.request_count = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def count_request(self):
+        with self.lock:
+            self.request_count = self.request_count + 1
+
+    def url(self, protocol):
+        """ The repository url to put in repos.json for this protocol """
+        if protocol == "dataverse":
+            return self.base_url + "/dataverse/api/dataverses/%id%/contents"
+        if protocol == "datacite":
+            return self.base_url + "/datacite/dois"
+        return self.base_url + "/" + protocol
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever, name="mock-repository", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -0,0 +1,264 @@
+"""Harvester benchmarks
+
+Crawls, refreshes, writes and exports a synthetic corpus served by local stand-in repositories, and reports the
+items per second of each step, so performance regressions can be caught without touching any live repository.
+Run it from the top of the harvester tree.
+
+Usage:
+  run_benchmarks.py [--db=<type>]... [--size=<n>] [--page-size=<n>] [--latency=<seconds>] [--crawl-engine=<engine>] [--update-workers=<n>] [--config=<file>] [--sqlite-file=<file>] [--pg-dbname=<name>] [--pg-host=<host>] [--pg-user=<user>] [--pg-pass=<pass>] [--output=<file>] [--baseline=<file>] [--tolerance=<percent>]
+
+Options:
+  --db=<type>               Database to benchmark, sqlite and/or postgres; may be repeated [default: sqlite].
+  --size=<n>                Items in each stand-in repository [default: 1000].
+  --page-size=<n>           Items per OAI-PMH or DataCite page [default: 100].
+  --latency=<seconds>       Delay added to every stand-in repository response [default: 0].
+  --crawl-engine=<engine>   sync or async [default: sync].
+  --update-workers=<n>      Records refreshed at the same time [default: 1].
+  --config=<file>           Take the [db] tuning (pragmas, pool_size, etc.) and write_batch_size from this file [default: conf/harvester.conf].
+  --sqlite-file=<file>      The sqlite database to create; it is deleted first [default: data/benchmark.db].
+  --pg-dbname=<name>        The postgres database to create; it is DROPPED first [default: harvest_benchmark].
+  --pg-host=<host>          Postgres host [default: localhost].
+  --pg-user=<user>          Postgres user [default: postgres].
+  --pg-pass=<pass>          Postgres password [default: ].
+  --output=<file>           Also write the results, with the harvest metrics of each run, to this JSON file.
+  --baseline=<file>         Compare with the results in this JSON file, exiting with status 1 on any regression.
+  --tolerance=<percent>     How much slower than the baseline a step may be before it is a regression [default: 20].
+
+"""
+
+from docopt import docopt
+import configparser
+import contextlib
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from harvester.OAIRepository import OAIRepository
+from harvester.CKANRepository import CKANRepository
+from harvester.DataverseRepository import DataverseRepository
+from harvester.DataCiteRepository import DataCiteRepository
+from harvester.DBInterface import DBInterface
+from harvester.HarvestLogger import HarvestLogger
+from harvester.HarvestMetrics import HarvestMetrics
+from harvester.HTTPClient import HTTPClient
+from harvester.ExporterGmeta import ExporterGmeta
+from harvester.ExporterDataverse import ExporterDataverse
+from mock_servers import MockRepositoryServer
+
+REPOSITORY_CLASSES = [("oai", OAIRepository), ("ckan", CKANRepository), ("dataverse", DataverseRepository),
+                      ("datacite", DataCiteRepository)]
+# Listings that only give identifiers need a pattern for the item url
+ITEM_URL_PATTERNS = {"ckan": "https://benchmark.example.org/dataset/%id%", "datacite": "https://doi.org/%id%"}
+# Settings that pick the database rather than tune it come from the command line instead
+DB_CONNECTION_KEYS = ["type", "dbname", "host", "schema", "user", "pass"]
+
+
+def get_db_params(dbtype, arguments, config):
+    params = {key: value for key, value in config["db"].items() if key not in DB_CONNECTION_KEYS} \
+        if config.has_section("db") else {}
+    if dbtype == "sqlite":
+        dbname = arguments["--sqlite-file"]
+        for filename in [dbname, dbname + "-wal", dbname + "-shm"]:
+            if os.path.exists(filename):
+                os.remove(filename)
+        params.update({"type": "sqlite", "dbname": dbname})
+    elif dbtype == "postgres":
+        import psycopg2
+        params.update({"type": "postgres", "dbname": arguments["--pg-dbname"], "host": arguments["--pg-host"],
+                       "user": arguments["--pg-user"], "pass": arguments["--pg-pass"]})
+        con = psycopg2.connect(dbname="postgres", host=params["host"], user=params["user"],
+                               password=params["pass"])
+        con.autocommit = True
+        cur = con.cursor()
+        cur.execute("DROP DATABASE IF EXISTS " + params["dbname"])
+        cur.execute("CREATE DATABASE " + params["dbname"])
+        con.close()
+    else:
+        raise ValueError("Unknown database type: {}".format(dbtype))
+    return params
+
+
+def make_repository(repository_class, protocol, server, final_config, db, logger):
+    repo = repository_class(final_config)
+    repo.setLogger(logger)
+    repo.setDatabase(db)
+    repo.setRepoParams({
+        "name": "Benchmark {}".format(protocol),
+        "type": protocol,
+        "url": server.url(protocol),
+        "set": "benchmark" if protocol == "datacite" else "",
+        "homepage_url": "https://{}.benchmark.example.org/".format(protocol),
+        "item_url_pattern": ITEM_URL_PATTERNS.get(protocol),
+        "enabled": True,
+        "repo_refresh_days": 0,
+        # Every record is stale, and all of them are refreshed in one run
+        "record_refresh_days": -1,
+        "refresh_evenly": False,
+        "max_records_updated_per_run": server.corpus.size,
+        "rate_limit_per_second": None
+    })
+    return repo
+
+
+def benchmark_record(corpus, i):
+    """ A record as a repository class would hand it to write_record() """
+    item = corpus.item(i)
+    return {
+        "identifier": "benchmark-write-{}".format(i),
+        "item_url": "https://benchmark.example.org/write/{}".format(i),
+        "title": item["title"],
+        "title_fr": "",
+        "pub_date": item["date"],
+        "series": "",
+        "creator": item["creators"],
+        "affiliation": [item["affiliation"]],
+        "tags": item["subjects"],
+        "subject": [item["subjects"][0]],
+        "publisher": item["publisher"],
+        "rights": item["rights"],
+        "access": "Public",
+        "description": item["description"]
+    }
+
+
+def count_records(db, repository_id):
+    rows = db.get_records_raw_query("SELECT count(*) AS count FROM records WHERE repository_id = {}".format(
+        int(repository_id)))
+    return int(rows[0]["count"])
+
+
+def timed(results, name, func):
+    """ Run func, which returns the number of items it handled, and record its throughput """
+    tstart = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        items = func()
+    seconds = time.time() - tstart
+    results[name] = {"items": items, "seconds": round(seconds, 3),
+                     "items_per_second": round(items / seconds, 1) if seconds > 0 else 0.0}
+    print("  {:<24} {:>8} items {:>9.2f}s {:>10.1f} items/sec".format(name, items, seconds,
+                                                                     results[name]["items_per_second"]))
+
+
+def run_benchmarks(dbtype, arguments, config, server, logger, workdir):
+    results = {}
+    metrics = HarvestMetrics()
+    final_config = {
+        "update_log_after_numitems": 1000000,
+        "abort_after_numerrors": 5,
+        "dump_on_failure": False,
+        "write_batch_size": int(config["harvest"].get("write_batch_size", 100)) if config.has_section("harvest") else 100,
+        "crawl_engine": arguments["--crawl-engine"],
+        "update_workers": int(arguments["--update-workers"]),
+        "http_retries": 0,
+        "metrics": metrics,
+        "export_file_limit_mb": 8,
+        "temp_filepath": os.path.join(workdir, "temp"),
+        "export_filepath": os.path.join(workdir, "export")
+    }
+    final_config["http_client"] = HTTPClient(final_config)
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        db = DBInterface(get_db_params(dbtype, arguments, config))
+    db.setLogger(logger)
+    db.setMetrics(metrics)
+
+    repos = [(protocol, make_repository(repository_class, protocol, server, final_config, db, logger))
+             for protocol, repository_class in REPOSITORY_CLASSES]
+    for protocol, repo in repos:
+        def crawl():
+            repo.crawl()
+            return count_records(db, repo.repository_id)
+        timed(results, "crawl " + protocol, crawl)
+    for protocol, repo in repos:
+        def refresh():
+            repo.update_stale_records({})
+            return repo.refresh_count
+        timed(results, "refresh " + protocol, refresh)
+
+    corpus = server.corpus
+    # Records written straight to the database, as the repository classes do, next to those of the OAI crawl
+    write_repo = repos[0][1]
+    write_repo.domain_metadata = {}
+
+    def write_single():
+        for i in range(corpus.size):
+            db.write_record(benchmark_record(corpus, i), write_repo)
+        return corpus.size
+    timed(results, "write_record", write_single)
+
+    def write_batched():
+        batch_size = int(final_config["write_batch_size"])
+        for start in range(0, corpus.size, batch_size):
+            db.write_records([benchmark_record(corpus, corpus.size + i)
+                              for i in range(start, min(start + batch_size, corpus.size))], write_repo)
+        return corpus.size
+    timed(results, "write_records", write_batched)
+
+    for export_format, exporter_class in [("gmeta", ExporterGmeta), ("dataverse", ExporterDataverse)]:
+        def export():
+            shutil.rmtree(final_config["export_filepath"], ignore_errors=True)
+            os.makedirs(final_config["export_filepath"])
+            exporter = exporter_class(db, logger, final_config)
+            exporter.export(export_filepath=final_config["export_filepath"], only_new_records=False,
+                            temp_filepath=final_config["temp_filepath"], export_repository_id=None,
+                            destination="file")
+            return exporter.exported_count
+        timed(results, "export " + export_format, export)
+
+    db.close()
+    return {"results": results, "metrics": metrics.as_dict()["repositories"]}
+
+
+def compare_with_baseline(output, baseline, tolerance):
+    """ Print every step that is slower than the baseline by more than tolerance percent; True if there are none """
+    if output["options"] != baseline.get("options"):
+        print("Warning: the baseline was run with different options: {}".format(baseline.get("options")))
+    ok = True
+    for dbtype, run in output["runs"].items():
+        for name, result in run["results"].items():
+            expected = baseline.get("runs", {}).get(dbtype, {}).get("results", {}).get(name)
+            if not expected or not expected["items_per_second"]:
+                continue
+            change = (result["items_per_second"] / expected["items_per_second"] - 1) * 100
+            if change < -tolerance:
+                ok = False
+                print("REGRESSION {} {}: {:.1f} items/sec, baseline {:.1f} ({:+.0f}%)".format(
+                    dbtype, name, result["items_per_second"], expected["items_per_second"], change))
+    return ok
+
+
+if __name__ == "__main__":
+    arguments = docopt(__doc__)
+    config = configparser.ConfigParser()
+    config.read(arguments["--config"])
+
+    workdir = tempfile.mkdtemp(prefix="harvest-benchmark-")
+    logger = HarvestLogger({"filename": os.path.join(workdir, "benchmark.log"), "level": "ERROR"})
+    server = MockRepositoryServer(int(arguments["--size"]), page_size=int(arguments["--page-size"]),
+                                  latency=float(arguments["--latency"])).start()
+    options = {key.lstrip("-"): arguments[key] for key in ["--size", "--page-size", "--latency", "--crawl-engine",
+                                                          "--update-workers"]}
+    runs = {}
+    try:
+        for dbtype in arguments["--db"]:
+            print("{} ({} items per repository)".format(dbtype, arguments["--size"]))
+            runs[dbtype] = run_benchmarks(dbtype, arguments, config, server, logger, workdir)
+    finally:
+        server.stop()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    output = {"options": options, "runs": runs}
+    if arguments["--output"]:
+        with open(arguments["--output"], "w") as outfile:
+            json.dump(output, outfile, indent=2)
+    if arguments["--baseline"]:
+        with open(arguments["--baseline"], "r") as infile:
+            baseline = json.load(infile)
+        if not compare_with_baseline(output, baseline, float(arguments["--tolerance"])):
+            sys.exit(1)
@@ -1,13 +1,14 @@
 """FRDR Harvester
 
 Usage:
-  harvest.py [--openrefine-import | --onlyharvest | --onlyexport | --init] [--only-new-records] [--dump-on-failure] [--export-filepath=<file>] [--export-format=<format>] [--repository-id=<id>] [--openrefine-csv=<file>]
+  harvest.py [--openrefine-import | --onlyharvest | --onlyexport | --init] [--only-new-records] [--full-resync] [--dump-on-failure] [--export-filepath=<file>] [--export-format=<format>] [--repository-id=<id>] [--openrefine-csv=<file>]
 
 Options:
   --openrefine-import       Don't harvest or export normally; import data from OpenRefine.
   --onlyharvest             Just harvest new items, do not export anything.
   --onlyexport              Just export existing items, do not harvest anything.
   --only-new-records        Only export records changed since last crawl.
+  --full-resync             Harvest every item again, even from repositories that support incremental harvesting.
   --dump-on-failure         If a record ever fails validation, print the whole record.
   --export-filepath=<file>  The path to export the data to.
   --openrefine-csv=<file>   The CSV from OpenRefine to import.
@@ -43,6 +44,11 @@ from harvester.TimeFormatter import TimeFormatter
 from harvester.Lock import Lock
 from harvester.ExporterGmeta import ExporterGmeta
 from harvester.ExporterDataverse import ExporterDataverse
+from harvester.CrawlScheduler import CrawlScheduler
+from harvester.HTTPClient import HTTPClient
+from harvester.HarvestMetrics import HarvestMetrics
+from harvester.HarvestRepository import HarvestRepository
+from harvester.RORMatcher import RORMatcher
 
 
 def get_config_json(repos_json="conf/repos.json"):
@@ -93,12 +99,31 @@ if __name__ == "__main__":
     final_config['temp_filepath'] = config['harvest'].get('temp_filepath', "temp")
     final_config['geo_files_limit_gb'] = int(config['harvest'].get('geo_files_limit_gb', 1))
     final_config['geo_files_limit_bytes'] = final_config['geo_files_limit_gb'] * 1000 * 1000 * 1000
+    final_config['crawl_workers'] = int(config['harvest'].get('crawl_workers', 1))
+    final_config['crawl_workers_per_host'] = int(config['harvest'].get('crawl_workers_per_host', 1))
+    final_config['crawl_db_mode'] = config['harvest'].get('crawl_db_mode', "serialized")
+    final_config['write_batch_size'] = int(config['harvest'].get('write_batch_size', 100))
+    final_config['incremental_overlap_hours'] = float(config['harvest'].get('incremental_overlap_hours', 24))
+    final_config['max_unlisted_fraction'] = float(config['harvest'].get('max_unlisted_fraction', 0.5))
+    final_config['full_resync'] = False
+    if arguments["--full-resync"] == True:
+        final_config['full_resync'] = True
+    final_config['http_timeout'] = float(config['harvest'].get('http_timeout', 60))
+    final_config['http_retries'] = int(config['harvest'].get('http_retries', 3))
+    final_config['http_backoff_factor'] = float(config['harvest'].get('http_backoff_factor', 1))
+    final_config['http_pool_maxsize'] = int(config['harvest'].get('http_pool_maxsize', 10))
+    final_config['http_pool_hosts'] = int(config['harvest'].get('http_pool_hosts', 50))
+    final_config['crawl_engine'] = config['harvest'].get('crawl_engine', "sync")
+    final_config['metrics'] = HarvestMetrics(config['harvest'])
     final_config['export_filepath'] = config['export'].get('export_filepath', "data")
     final_config['export_file_limit_mb'] = int(config['export'].get('export_file_limit_mb', 10))
     final_config['export_format'] = config['export'].get('export_format', "gmeta")
+    final_config['export_workers'] = int(config['export'].get('export_workers', 1))
     final_config['socrata_app_token'] = config['socrata'].get('app_token', None)
     final_config['ror_json_url'] = config['ror'].get('ror_json_url', None)
     final_config['ror_data_file'] =  "data/ror-data.json"
+    final_config['ror_match_affiliations'] = config['ror'].get('match_affiliations', "false").upper() == "TRUE"
+    final_config['ror_match_min_score'] = float(config['ror'].get('match_min_score', 0.85))
     final_config['repository_id'] = None
 
     main_log = HarvestLogger(config['logging'])
@@ -106,6 +131,7 @@ if __name__ == "__main__":
 
     dbh = DBInterface(config['db'])
     dbh.setLogger(main_log)
+    dbh.setMetrics(final_config['metrics'])
     repo_configs = get_config_json()
 
     if arguments["--openrefine-import"] == True:
@@ -133,6 +159,9 @@ if __name__ == "__main__":
 
     if run_harvest:
         # Find any new information in the repositories
+        repos = []
+        # All repositories share one pool of keep-alive connections
+        final_config['http_client'] = HTTPClient(final_config)
         for repoconfig in repo_configs['repos']:
             if repoconfig['type'] == "oai":
                 repo = OAIRepository(final_config)
@@ -159,14 +188,27 @@ if __name__ == "__main__":
             elif repoconfig['type'] == "nexus":
                 repo = NexusRepository(final_config)
             repo.setLogger(main_log)
-            if 'copyerrorstoemail' in repoconfig and not repoconfig['copyerrorstoemail']:
-                main_log.setErrorsToEmail(False)
             repo.setRepoParams(repoconfig)
-            repo.setDatabase(dbh)
-            repo.crawl()
-            repo.update_stale_records(config['db'])
-            if 'copyerrorstoemail' in repoconfig and not repoconfig['copyerrorstoemail']:
-                main_log.restoreErrorsToEmail()
+            repos.append((repo, repoconfig))
+
+        scheduler = CrawlScheduler(dbh, config['db'], main_log, final_config)
+        scheduler.run(repos)
+        if final_config['ror_match_affiliations']:
+            # Bring the ROR data up to date the same way the Dryad crawl does, then match any new affiliations
+            ror_repo = HarvestRepository(final_config)
+            ror_repo.setLogger(main_log)
+            ror_repo.setDatabase(dbh)
+            if ror_repo.load_ror_data():
+                with final_config['metrics'].timer("match", "ror"):
+                    matcher = RORMatcher(ror_repo.ror_data, final_config)
+                    matched_count = matcher.match_affiliations(
+                        dbh, main_log, int(ror_repo.ror_data.get_setting("built_timestamp") or 0))
+                final_config['metrics'].add_items("match", matched_count, "ror")
+            else:
+                main_log.error("Affiliations not matched to ROR: the ROR data could not be loaded")
+        cache_stats = dbh.get_vocabulary_cache_stats()
+        main_log.info("Vocabulary cache: {} hits, {} misses, {} entries".format(
+            cache_stats["hits"], cache_stats["misses"], cache_stats["size"]))
 
     if run_export:
         # Default output format is gmeta
@@ -193,10 +235,13 @@ if __name__ == "__main__":
         }
         if arguments["--only-new-records"] == True:
             kwargs["only_new_records"] = True
-        exporter.export(**kwargs)
+        with final_config['metrics'].timer("export", "export"):
+            exporter.export(**kwargs)
+        final_config['metrics'].add_items("export", exporter.exported_count, "export")
 
     formatter = TimeFormatter()
     dbh.set_setting("last_run_timestamp", tstart)
     main_log.info("Done after {}".format(formatter.humanize(time.time() - tstart)))
+    final_config['metrics'].write(main_log)
 
     instance_lock.unlock()
@@ -1,6 +1,5 @@
 from harvester.HarvestRepository import HarvestRepository
-import requests
-from dateutil import parser
+from harvester.DateNormalizer import DateNormalizer
 
 
 class ArcGISRepository(HarvestRepository):
@@ -36,7 +35,7 @@ class ArcGISRepository(HarvestRepository):
 
         try:
             query_url = self.url
-            response = requests.get(query_url)
+            response = self.http_get(query_url)
             records = response.json()
             self.logger.info("Found {} items in feed".format(len(records["dataset"])))
             item_count = 0
@@ -44,7 +43,7 @@ class ArcGISRepository(HarvestRepository):
                 oai_record = self.format_arcgis_to_oai(record)
                 if oai_record:
                     item_count = item_count + 1
-                    self.db.write_record(oai_record, self)
+                    self.write_record(oai_record)
             self.logger.info("Wrote {} items from feed".format(item_count))
 
 
@@ -99,7 +98,7 @@ class ArcGISRepository(HarvestRepository):
                 record["geobboxes"] = [{"westLon": coordinates[0], "southLat": coordinates[1], "eastLon": coordinates[2], "northLat": coordinates[3]}]
 
         if "issued" in arcgis_record and arcgis_record["issued"]:
-            record["pub_date"] = parser.parse(arcgis_record["issued"]).strftime('%Y-%m-%d')
+            record["pub_date"] = DateNormalizer.parse(arcgis_record["issued"])
 
         # The information in the "license" field is a link to a license that returns a 404
         # if "license" in arcgis_record and arcgis_record["license"]:
@@ -0,0 +1,182 @@
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+from harvester.HTTPClient import HTTPClient, get_host
+
+
+class AsyncCrawlEngine(object):
+    """ Fetches pages and stale records with asyncio, for repositories that describe their requests """
+
+    def __init__(self, repo):
+        self.repo = repo
+        self.backend = self.get_backend()
+        self.timeout = float(repo.http_timeout)
+        self.retries = int(getattr(repo, "http_retries", 3))
+        self.backoff_factor = float(getattr(repo, "http_backoff_factor", 1))
+        self.concurrency = max(1, int(repo.update_workers))
+        self.clients = {}
+        # The mappers and the database are not async; they all run, in order, on this one thread
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="writer")
+
+    @staticmethod
+    def get_backend():
+        """ aiohttp or httpx, whichever is installed; None if neither is """
+        try:
+            import aiohttp
+            return "aiohttp"
+        except ImportError:
+            pass
+        try:
+            import httpx
+            return "httpx"
+        except ImportError:
+            pass
+        return None
+
+    async def _get_client(self, verify):
+        if verify not in self.clients:
+            if self.backend == "aiohttp":
+                import aiohttp
+                self.clients[verify] = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout),
+                                                             connector=aiohttp.TCPConnector(ssl=None if verify else False))
+            else:
+                import httpx
+                self.clients[verify] = httpx.AsyncClient(timeout=self.timeout, verify=verify, follow_redirects=True)
+        return self.clients[verify]
+
+    async def _close_clients(self):
+        for client in self.clients.values():
+            if self.backend == "aiohttp":
+                await client.close()
+            else:
+                await client.aclose()
+        self.clients = {}
+
+    async def _send(self, request):
+        """ Make one GET request, returning a requests.Response so adapters can treat it like any other """
+        client = await self._get_client(request.get("verify", True))
+        params = request.get("params")
+        if params:
+            params = {key: str(value) for key, value in params.items()}
+        response = requests.Response()
+        if self.backend == "aiohttp":
+            async with client.get(request["url"], params=params, headers=request.get("headers")) as r:
+                response._content = await r.read()
+                response.status_code = r.status
+                response.headers = CaseInsensitiveDict(r.headers)
+                response.url = str(r.url)
+        else:
+            r = await client.get(request["url"], params=params, headers=request.get("headers"))
+            response._content = r.content
+            response.status_code = r.status_code
+            response.headers = CaseInsensitiveDict(r.headers)
+            response.url = str(r.url)
+        response.encoding = get_encoding_from_headers(response.headers)
+        return response
+
+    async def fetch(self, request):
+        """ GET under the host's rate limit, retrying with backoff on errors and on 429/5xx like HTTPClient does """
+        limiter = self.repo.http_client.rate_limiters.get(get_host(request["url"]))
+        attempt = 0
+        while True:
+            if limiter is not None:
+                await limiter.acquire_async()
+            tstart = time.time()
+            try:
+                response = await self._send(request)
+            except Exception as e:
+                response = None
+                if attempt >= self.retries:
+                    raise
+            finally:
+                self._observe(time.time() - tstart, response)
+            if response is not None and response.status_code not in HTTPClient.retry_status_codes:
+                if limiter is not None:
+                    limiter.speed_up()
+                return response
+            if response is not None and attempt >= self.retries:
+                return response
+
+            retry_after = None
+            if response is not None:
+                try:
+                    retry_after = float(response.headers.get("Retry-After"))
+                except (TypeError, ValueError):
+                    pass
+                if response.status_code == 429 and limiter is not None:
+                    limiter.slow_down(retry_after)
+            attempt += 1
+            await asyncio.sleep(retry_after if retry_after is not None else self.backoff_factor * (2 ** (attempt - 1)))
+
+    def _observe(self, seconds, response):
+        # Requests overlap, so their time is added up rather than timed as a phase of this thread
+        metrics = self.repo.metrics
+        metrics.add_time("fetch", seconds, self.repo.name)
+        if response is None:
+            metrics.observe_http(seconds, 0, None, self.repo.name)
+        else:
+            metrics.observe_http(seconds, len(response.content), response.status_code, self.repo.name)
+
+    def _in_repository(self, func, *args):
+        with self.repo.metrics.repository(self.repo.name):
+            return func(*args)
+
+    async def _in_writer(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.writer, self._in_repository, func, *args)
+
+    async def crawl_pages(self):
+        """ Same as HarvestRepository._crawl_pages(), fetching the next page while this one is written """
+        state = {}
+        item_count = 0
+        try:
+            request = self.repo.get_page_request(None, state)
+            next_page = asyncio.ensure_future(self.fetch(request)) if request else None
+            while next_page is not None:
+                page = (await next_page).json()
+                identifiers = self.repo.get_page_identifiers(page, state)
+                request = self.repo.get_page_request(page, state)
+                next_page = asyncio.ensure_future(self.fetch(request)) if request else None
+                item_count = await self._in_writer(self.repo._write_page_headers, identifiers, item_count)
+        finally:
+            if next_page is not None and not next_page.done():
+                next_page.cancel()
+            await self._close_clients()
+            self.writer.shutdown()
+        return item_count
+
+    async def _fetch_record(self, record):
+        try:
+            return record, await self.fetch(self.repo.get_record_request(record))
+        except Exception as e:
+            return record, e
+
+    async def update_records(self, records):
+        """ Fetch up to update_workers stale records at once; each is processed on the writer thread as it arrives """
+        records = iter(records)
+        running = set()
+        try:
+            while True:
+                while len(running) < self.concurrency:
+                    # Records may be streamed from the database, which is only used from the writer thread
+                    record = await self._in_writer(next, records, None)
+                    if record is None:
+                        break
+                    running.add(asyncio.ensure_future(self._fetch_record(record)))
+                if not running:
+                    break
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    record, response = task.result()
+                    status = await self._in_writer(self.repo._parse_record, self.repo.process_record_response,
+                                                   record, response)
+                    if not await self._in_writer(self.repo._count_stale_record, status):
+                        return
+        finally:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            await self._close_clients()
+            self.writer.shutdown()
@@ -1,17 +1,15 @@
 from harvester.HarvestRepository import HarvestRepository
-from harvester.rate_limited import rate_limited
 import ckanapi
-import time
 import json
 import re
 import ftfy
-import requests
 
 class CKANRepository(HarvestRepository):
     """ CKAN Repository """
 
     def setRepoParams(self, repoParams):
         self.metadataprefix = "ckan"
+        self.rate_limit_per_second = 5
         self.default_language = "en"
         self.ckan_access_field = ""
         self.ckan_api_endpoint = ""
@@ -23,7 +21,7 @@ class CKANRepository(HarvestRepository):
         self.ckan_strip_from_identifier = ""
         self.ckan_use_doi_for_item_url = False
         super(CKANRepository, self).setRepoParams(repoParams)
-        self.ckanrepo = ckanapi.RemoteCKAN(self.url)
+        self.ckanrepo = ckanapi.RemoteCKAN(self.url, session=self.http_client.new_session())
         self.domain_metadata = []
 
     def _crawl(self):
@@ -49,35 +47,32 @@ class CKANRepository(HarvestRepository):
         self.repository_id = self.db.update_repo(**kwargs)
 
         if self.ckan_api_endpoint: # Yukon
-            r = requests.get(self.url + self.ckan_api_endpoint + "/package_list")
+            r = self.http_get(self.url + self.ckan_api_endpoint + "/package_list")
             records = json.loads(r.text)["result"]
         else:
-            records = self.ckanrepo.call_action("package_list", requests_kwargs={"verify": False})
+            records = self.ckanrepo.call_action("package_list", requests_kwargs={"verify": False, "timeout": float(self.http_timeout)})
 
         # If response is limited to 1000, get all records with pagination
         if len(records) == 1000:
             offset = 0
-            records = self.ckanrepo.call_action("package_list?limit=1000&offset=" + str(offset), requests_kwargs={"verify": False})
+            records = self.ckanrepo.call_action("package_list?limit=1000&offset=" + str(offset), requests_kwargs={"verify": False, "timeout": float(self.http_timeout)})
 
             # Iterate through sets of 1000 records until no records returned
             while len(records) % 1000 == 0:
                 offset +=1000
-                response = self.ckanrepo.call_action("package_list?limit=1000&offset=" + str(offset), requests_kwargs={"verify": False})
+                response = self.ckanrepo.call_action("package_list?limit=1000&offset=" + str(offset), requests_kwargs={"verify": False, "timeout": float(self.http_timeout)})
                 if len(response) == 0:
                     break
                 records = records + response
 
-        item_count = 0
+        ckan_identifiers = []
         for ckan_identifier in records:
             if not self.ckan_include_identifier_pattern or self.ckan_include_identifier_pattern in ckan_identifier: # Yukon
                 if self.ckan_strip_from_identifier:
                     ckan_identifier = ckan_identifier.replace(self.ckan_strip_from_identifier,"")
-                self.db.write_header(ckan_identifier, self.item_url_pattern, self.repository_id)
-                item_count = item_count + 1
-                if (item_count % self.update_log_after_numitems == 0):
-                    tdelta = time.time() - self.tstart + 0.1
-                    self.logger.info("Done {} item headers after {} ({:.1f} items/sec)".format(item_count,
-                            self.formatter.humanize(tdelta), item_count / tdelta))
+                ckan_identifiers.append(ckan_identifier)
+        item_count = self._write_page_headers(ckan_identifiers, 0)
+        self.delete_unlisted_records()
 
         self.logger.info("Found {} items in feed".format(item_count))
 
@@ -547,20 +542,19 @@ class CKANRepository(HarvestRepository):
 
         return record
 
-    @rate_limited(5)
     def _update_record(self, record):
         try:
             if self.ckan_api_endpoint: # Yukon
-                r = requests.get(self.url + self.ckan_api_endpoint + "/package_show?id=" + record["local_identifier"])
+                r = self.http_get(self.url + self.ckan_api_endpoint + "/package_show?id=" + record["local_identifier"])
                 try:
                     ckan_record = json.loads(r.text)["result"][0]
                 except IndexError:
                     raise ckanapi.errors.NotFound
             else:
-                ckan_record = self.ckanrepo.call_action("package_show", {"id":record["local_identifier"]}, requests_kwargs={"verify": False})
+                ckan_record = self.ckanrepo.call_action("package_show", {"id":record["local_identifier"]}, requests_kwargs={"verify": False, "timeout": float(self.http_timeout)})
             oai_record = self.format_ckan_to_oai(ckan_record, record["local_identifier"])
             if oai_record:
-                self.db.write_record(oai_record, self)
+                self.write_record(oai_record)
             else:
                 if oai_record is False:
                     # This record is not a dataset, remove it from the results
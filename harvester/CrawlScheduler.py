@@ -0,0 +1,121 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from urllib.parse import urlparse
+from harvester.DBInterface import DBInterface
+from harvester.TimeFormatter import TimeFormatter
+
+
+class SerializedDBInterface(object):
+    """ Wraps a shared DBInterface so that only one thread at a time can use it """
+
+    def __init__(self, db):
+        self._db = db
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+
+        return locked
+
+
+class CrawlScheduler(object):
+    """ Runs crawl() and update_stale_records() for several repositories at once """
+
+    def __init__(self, db, dbparams, logger, params):
+        self.db = db
+        self.dbparams = dbparams
+        self.logger = logger
+        self.workers = max(1, int(params.get('crawl_workers', 1)))
+        self.workers_per_host = max(1, int(params.get('crawl_workers_per_host', 1)))
+        self.db_mode = params.get('crawl_db_mode', "serialized")
+        if self.db_mode not in ["serialized", "pooled"]:
+            raise ValueError('crawl_db_mode must be serialized or pooled in config file')
+        self.metrics = params.get('metrics', None)
+        self.formatter = TimeFormatter()
+        self.local = threading.local()
+        self.shared_db = None
+
+    def get_host(self, repoconfig):
+        try:
+            return urlparse(repoconfig.get('url', "")).hostname or ""
+        except Exception as e:
+            return ""
+
+    def _get_db(self):
+        if self.db_mode == "pooled" and self.db.is_pooled():
+            # Each worker thread borrows a connection from the pool, and gives it back after each repository
+            return self.db
+        if self.db_mode == "pooled":
+            # Each worker thread keeps its own connection for all of the repositories it crawls
+            if getattr(self.local, "db", None) is None:
+                self.local.db = DBInterface(self.dbparams)
+                self.local.db.setLogger(self.logger)
+                self.local.db.setMetrics(self.metrics)
+            return self.local.db
+        if self.shared_db is None:
+            self.shared_db = SerializedDBInterface(self.db)
+        return self.shared_db
+
+    def _harvest(self, repo, repoconfig, db):
+        tstart = time.time()
+        repo.setDatabase(db)
+        if 'copyerrorstoemail' in repoconfig and not repoconfig['copyerrorstoemail']:
+            self.logger.setErrorsToEmail(False)
+        try:
+            repo.crawl()
+            repo.update_stale_records(self.dbparams)
+        except Exception as e:
+            self.logger.error("Repository {} failed: {} {}".format(repoconfig.get('name'), type(e).__name__, e))
+        finally:
+            if 'copyerrorstoemail' in repoconfig and not repoconfig['copyerrorstoemail']:
+                self.logger.restoreErrorsToEmail()
+        return time.time() - tstart
+
+    def _run_worker(self, repo, repoconfig):
+        try:
+            return self._harvest(repo, repoconfig, self._get_db())
+        finally:
+            self.db.release_connection()
+
+    def run(self, repos):
+        """ Harvest a list of (repo, repoconfig) pairs, respecting the worker and per-host limits """
+        if self.workers == 1:
+            # Crawl one after another on the main connection, as before
+            for repo, repoconfig in repos:
+                self._harvest(repo, repoconfig, self.db)
+            return
+
+        self.logger.info("Crawling {} repositories with {} workers ({} per host, db mode: {})".format(
+            len(repos), self.workers, self.workers_per_host, self.db_mode))
+        pending = list(repos)
+        running = {}
+        host_counts = {}
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="crawl") as executor:
+            while pending or running:
+                # Start as many repositories as the worker and host limits allow, in config order
+                for repo, repoconfig in list(pending):
+                    if len(running) >= self.workers:
+                        break
+                    host = self.get_host(repoconfig)
+                    if host_counts.get(host, 0) >= self.workers_per_host:
+                        continue
+                    pending.remove((repo, repoconfig))
+                    host_counts[host] = host_counts.get(host, 0) + 1
+                    running[executor.submit(self._run_worker, repo, repoconfig)] = (repoconfig, host)
+
+                done, not_done = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in done:
+                    repoconfig, host = running.pop(future)
+                    host_counts[host] = host_counts[host] - 1
+                    try:
+                        self.logger.info("Finished repository {} after {}".format(
+                            repoconfig.get('name'), self.formatter.humanize(future.result())))
+                    except Exception as e:
+                        self.logger.error("Repository {} failed: {} {}".format(repoconfig.get('name'), type(e).__name__, e))
@@ -5,18 +5,154 @@ import importlib.util
 import json
 import uuid
 import re
-from psycopg2.extras import DictCursor, RealDictCursor
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from decimal import Decimal
+from psycopg2.extras import DictCursor, RealDictCursor, execute_batch, execute_values
+
+
+class ConnectionState(object):
+    """ The connection a DBInterface is using, how deeply nested its transaction() is, and the vocabulary cache
+    entries written in that transaction, which are only shared once it commits """
+
+    def __init__(self):
+        self.connection = None
+        self.transaction_depth = 0
+        self.vocabulary_pending = {}
+
+
+class ThreadConnectionState(ConnectionState, threading.local):
+    """ ConnectionState kept separately by each thread """
+
+
+class MeasuredCursor(object):
+    """ Wraps a cursor so its statements are counted and timed as the database phase of HarvestMetrics """
+
+    def __init__(self, cursor, metrics):
+        object.__setattr__(self, "_cursor", cursor)
+        object.__setattr__(self, "_metrics", metrics)
+
+    def execute(self, *args, **kwargs):
+        with self._metrics.timer("database"):
+            return self._cursor.execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        with self._metrics.timer("database"):
+            return self._cursor.executemany(*args, **kwargs)
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __setattr__(self, name, value):
+        setattr(self._cursor, name, value)
+
+
+class SQLiteConnectionPool(object):
+    """ Reuses sqlite connections, with the getconn/putconn/closeall methods of the psycopg2 pools """
+
+    def __init__(self, connect):
+        self.connect = connect
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def getconn(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return self.connect()
+
+    def putconn(self, con):
+        if con.in_transaction:
+            con.rollback()
+        with self.lock:
+            self.idle.append(con)
+
+    def closeall(self):
+        with self.lock:
+            for con in self.idle:
+                con.close()
+            self.idle = []
+
 
 class DBInterface:
+    # Related metadata written for each record: (value table, record field, extras), in the order they are written
+    related_metadata_fields = [
+        ("creators", "creator", {"is_contributor": 0}),
+        ("creators", "contributor", {"is_contributor": 1}),
+        ("publishers", "publisher", None),
+        ("affiliations", "affiliation", None),
+        ("access", "access", None),
+        ("rights", "rights", None),
+        ("tags", "tags", {"language": "en"}),
+        ("tags", "tags_fr", {"language": "fr"}),
+        ("subjects", "subject", {"language": "en"}),
+        ("subjects", "subject_fr", {"language": "fr"}),
+        ("geoplace", "geoplaces", None),
+        ("descriptions", "description", {"language": "en"}),
+        ("descriptions", "description_fr", {"language": "fr"}),
+        ("geobbox", "geobboxes", None),
+        ("geopoint", "geopoints", None),
+        ("geofile", "geofiles", None)
+    ]
+
+    # Rows that belong to a record, and are removed when it is marked as deleted
+    record_detail_tables = [
+        "records_x_access", "records_x_affiliations", "records_x_crdc", "records_x_creators",
+        "descriptions", "domain_metadata", "geobbox", "geofile", "geoplace", "geopoint",
+        "records_x_publishers", "records_x_rights", "records_x_subjects", "records_x_tags"]
+
+    # Value -> id cache for the shared vocabulary tables, used by every DBInterface in the process
+    vocabulary_tables = ["creators", "tags", "subjects", "publishers", "affiliations", "rights", "access", "domain_schemas"]
+    # (database, table) -> value key -> id, each table in least recently used order
+    vocabulary_cache = {}
+    vocabulary_cache_size = 100000
+    vocabulary_cache_stats = {"hits": 0, "misses": 0, "size": 0}
+    vocabulary_cache_lock = threading.Lock()
+
+    # sqlite PRAGMAs that may be set in the [db] config, and the values each accepts
+    sqlite_pragmas = OrderedDict([
+        ("journal_mode", r"(?i)^(delete|truncate|persist|memory|wal|off)$"),
+        ("synchronous", r"(?i)^(off|normal|full|extra|[0-3])$"),
+        ("mmap_size", r"^\d+$"),
+        ("cache_size", r"^-?\d+$"),
+        ("temp_store", r"(?i)^(default|file|memory|[0-2])$")
+    ])
+
     def __init__(self, params):
+        # Kept so a worker process can open a DBInterface of its own
+        self.params = dict(params)
         self.dbtype = params.get('type', None)
         self.dbname = params.get('dbname', None)
         self.host = params.get('host', None)
         self.schema = params.get('schema', None)
         self.user = params.get('user', None)
         self.password = params.get('pass', None)
-        self.connection = None
+        self.timeout = float(params.get('timeout', 30))
         self.logger = None
+        self.metrics = None
+        # With a pool, each thread borrows a connection of its own; without one, they all share a single connection
+        self.pool_size = int(params.get('pool_size', 0) or 0)
+        self.pool = None
+        self.pool_slots = threading.BoundedSemaphore(self.pool_size) if self.pool_size > 0 else None
+        self.pool_lock = threading.Lock()
+        self.borrowed = {}
+        self.state = ThreadConnectionState() if self.pool_size > 0 else ConnectionState()
+        self.batch_chunk_size = 500
+        self.itersize = int(params.get('itersize', 2000))
+        DBInterface.vocabulary_cache_size = int(params.get('vocabulary_cache_size', DBInterface.vocabulary_cache_size))
+        self.pragmas = []
+        if self.dbtype == "sqlite":
+            for pragma, pattern in self.sqlite_pragmas.items():
+                value = str(params.get(pragma, "") or "").strip()
+                if value == "":
+                    continue
+                if not re.match(pattern, value):
+                    raise ValueError('Unsupported value for {} in config file: {}'.format(pragma, value))
+                self.pragmas.append((pragma, value))
 
         if self.dbtype == "sqlite":
             self.dblayer = __import__('sqlite3')
@@ -76,6 +212,7 @@ class DBInterface:
                         migrator.migrate()
 
                     self.set_setting("dbversion", scriptversion)
+                    self.invalidate_vocabulary_cache()
                     dbversion = scriptversion
                     print("Updated database to version: {:d}".format(scriptversion))  # No logger yet
 
@@ -83,19 +220,158 @@ class DBInterface:
         self.tabledict = {}
         with open("sql/tables.json", 'r') as jsonfile:
             self.tabledict = json.load(jsonfile)
+        self.release_connection()
 
     def setLogger(self, l):
         self.logger = l
 
+    def setMetrics(self, m):
+        self.metrics = m
+
+    def _measured(self, cur):
+        if self.metrics is None:
+            return cur
+        return MeasuredCursor(cur, self.metrics)
+
+    @property
+    def connection(self):
+        return self.state.connection
+
+    @property
+    def transaction_depth(self):
+        return self.state.transaction_depth
+
+    @transaction_depth.setter
+    def transaction_depth(self, depth):
+        self.state.transaction_depth = depth
+
     def getConnection(self):
-        if self.connection is None:
-            if self.dbtype == "sqlite":
-                self.connection = self.dblayer.connect(self.dbname)
+        if self.state.connection is None:
+            if self.pool_size > 0:
+                self.state.connection = self._borrow_connection()
+            elif self.dbtype == "sqlite":
+                self.state.connection = self._connect_sqlite()
             elif self.dbtype == "postgres":
-                self.connection = self.dblayer.connect("dbname='%s' user='%s' password='%s' host='%s'" % (
-                    self.dbname, self.user, self.password, self.host))
-                self.connection.autocommit = True
-        return self.connection
+                self.state.connection = self._connect_postgres()
+                self.state.connection.autocommit = True
+        return self.state.connection
+
+    def _connect_sqlite(self):
+        # Connections may be shared between crawl threads (see CrawlScheduler), which serialize access
+        con = self.dblayer.connect(self.dbname, timeout=self.timeout, check_same_thread=False)
+        for pragma, value in self.pragmas:
+            con.execute("PRAGMA {} = {}".format(pragma, value))
+        return con
+
+    def _connect_postgres(self):
+        return self.dblayer.connect(self._postgres_dsn())
+
+    def _postgres_dsn(self):
+        return "dbname='%s' user='%s' password='%s' host='%s'" % (self.dbname, self.user, self.password, self.host)
+
+    def is_pooled(self):
+        return self.pool_size > 0
+
+    def _borrow_connection(self):
+        """ Take a connection from the pool for this thread, waiting up to timeout seconds for one to be free """
+        deadline = time.time() + self.timeout
+        while not self.pool_slots.acquire(timeout=0.1):
+            # Threads that finished without releasing their connection no longer need it
+            self._reclaim_connections()
+            if time.time() > deadline:
+                raise self.dblayer.OperationalError(
+                    "No free database connection after {} seconds (pool_size = {})".format(self.timeout, self.pool_size))
+        try:
+            with self.pool_lock:
+                if self.pool is None:
+                    if self.dbtype == "postgres":
+                        from psycopg2.pool import ThreadedConnectionPool
+                        self.pool = ThreadedConnectionPool(0, self.pool_size, self._postgres_dsn())
+                    elif self.dbtype == "sqlite":
+                        self.pool = SQLiteConnectionPool(self._connect_sqlite)
+            con = self.pool.getconn()
+            if self.dbtype == "postgres":
+                con.autocommit = True
+        except Exception:
+            self.pool_slots.release()
+            raise
+        with self.pool_lock:
+            self.borrowed[threading.current_thread()] = con
+        return con
+
+    def _reclaim_connections(self):
+        with self.pool_lock:
+            finished = [thread for thread in self.borrowed if not thread.is_alive()]
+            connections = [self.borrowed.pop(thread) for thread in finished]
+        for con in connections:
+            self._return_connection(con)
+
+    def _return_connection(self, con):
+        try:
+            if self.dbtype == "postgres" and not con.autocommit:
+                con.rollback()
+                con.autocommit = True
+            self.pool.putconn(con)
+        finally:
+            self.pool_slots.release()
+
+    def release_connection(self):
+        """ Give this thread's connection back to the pool, if it has one; the next statement borrows another """
+        if self.pool_size == 0 or self.state.connection is None:
+            return
+        if self.state.transaction_depth > 0:
+            raise RuntimeError("Cannot release a database connection inside a transaction")
+        con = self.state.connection
+        self.state.connection = None
+        with self.pool_lock:
+            self.borrowed.pop(threading.current_thread(), None)
+        self._return_connection(con)
+
+    @contextmanager
+    def pooled_connection(self):
+        """ Borrow a connection for the enclosed statements and give it back afterwards, e.g. for one API request """
+        borrowed_here = self.state.connection is None
+        try:
+            yield self.getConnection()
+        finally:
+            if borrowed_here:
+                self.release_connection()
+
+    def close(self):
+        """ Close the connection, or every connection in the pool """
+        if self.pool_size > 0:
+            self.release_connection()
+            self._reclaim_connections()
+            with self.pool_lock:
+                if self.pool is not None:
+                    self.pool.closeall()
+                    self.pool = None
+        elif self.state.connection is not None:
+            self.state.connection.close()
+            self.state.connection = None
+
+    def stream_query(self, sqlstring, params=(), dict_rows=True):
+        """ Iterate over the rows of a query without holding them all in memory. On postgres this is a named
+        (server side) cursor fetching itersize rows at a time, on a connection of its own so it can stay open
+        while other statements run and commit on the main one """
+        if self.dbtype == "postgres":
+            con = self._connect_postgres()
+            try:
+                cur = self._measured(con.cursor(name="stream_" + uuid.uuid4().hex,
+                                                cursor_factory=RealDictCursor if dict_rows else None))
+                cur.itersize = self.itersize
+                cur.execute(self._prep(sqlstring), params)
+                for row in cur:
+                    yield row
+            finally:
+                con.rollback()
+                con.close()
+        elif self.dbtype == "sqlite":
+            # sqlite steps through the result as it is read
+            cur = self.getDictCursor() if dict_rows else self.getRowCursor()
+            cur.execute(sqlstring, params)
+            for row in cur:
+                yield row
 
     def getDictCursor(self):
         if self.dbtype == "sqlite":
@@ -103,13 +379,13 @@ class DBInterface:
             cur = self.getConnection().cursor()
         if self.dbtype == "postgres":
             cur = self.getConnection().cursor(cursor_factory=RealDictCursor)
-        return cur
+        return self._measured(cur)
 
     def getRowCursor(self):
         if self.dbtype == "sqlite":
             self.getConnection().row_factory = Row
         cur = self.getConnection().cursor()
-        return cur
+        return self._measured(cur)
 
     def getLambdaCursor(self):
         if self.dbtype == "sqlite":
@@ -117,7 +393,7 @@ class DBInterface:
             cur = self.getConnection().cursor()
         elif self.dbtype == "postgres":
             cur = self.getConnection().cursor(cursor_factory=DictCursor)
-        return cur
+        return self._measured(cur)
 
     def getType(self):
         return self.dbtype
@@ -127,6 +403,163 @@ class DBInterface:
             return statement.replace('?', '%s')
         return statement
 
+    @contextmanager
+    def transaction(self):
+        """ Run the enclosed statements in a single transaction; nested calls join the outer transaction """
+        con = self.getConnection()
+        if self.transaction_depth == 0:
+            if self.dbtype == "postgres":
+                con.autocommit = False
+            elif not con.in_transaction:
+                # Take the write lock now: a reader that tries to write later fails at once if another connection has it
+                con.execute("BEGIN IMMEDIATE")
+        self.transaction_depth = self.transaction_depth + 1
+        try:
+            yield con
+        except Exception:
+            self.transaction_depth = self.transaction_depth - 1
+            if self.transaction_depth == 0:
+                # The ids found or inserted in the transaction were never shared, so the cache needs no cleaning
+                self.state.vocabulary_pending = {}
+                con.rollback()
+                if self.dbtype == "postgres":
+                    con.autocommit = True
+            raise
+        self.transaction_depth = self.transaction_depth - 1
+        if self.transaction_depth == 0:
+            pending, self.state.vocabulary_pending = self.state.vocabulary_pending, {}
+            con.commit()
+            if self.dbtype == "postgres":
+                con.autocommit = True
+            self._publish_vocabulary_cache(pending)
+
+    @contextmanager
+    def _commit_block(self, con):
+        """ Like `with con:`, committing on exit, except inside transaction(), which commits everything at its end """
+        if self.transaction_depth > 0:
+            yield con
+        else:
+            with con:
+                yield con
+
+    def _select_in(self, cur, sqlstring, values, params=()):
+        """ Run a select with an IN ({}) placeholder for a list of values, in chunks """
+        rows = []
+        values = list(dict.fromkeys(values))
+        for i in range(0, len(values), self.batch_chunk_size):
+            chunk = values[i:i + self.batch_chunk_size]
+            cur.execute(self._prep(sqlstring.format(",".join("?" for v in chunk))), list(params) + chunk)
+            rows.extend(cur.fetchall())
+        return rows
+
+    def _execute_many(self, cur, sqlstring, params_list):
+        if not params_list:
+            return
+        if self.dbtype == "postgres":
+            execute_batch(cur, self._prep(sqlstring), params_list, page_size=self.batch_chunk_size)
+        elif self.dbtype == "sqlite":
+            cur.executemany(sqlstring, params_list)
+
+    def _insert_many(self, cur, tablename, columns, rows, returning=None, ignore_conflicts=False):
+        """ Insert rows with multi-row VALUES (postgres) or executemany (sqlite); returns the new ids if asked """
+        if not rows:
+            return []
+        sqlstring = "INSERT INTO {} ({}) VALUES ".format(tablename, ",".join(columns))
+        if self.dbtype == "postgres":
+            values = "%s"
+            if ignore_conflicts:
+                values = values + " ON CONFLICT DO NOTHING"
+            if returning:
+                return [row[returning] for row in execute_values(cur, sqlstring + values + " RETURNING " + returning, rows,
+                                                                 page_size=self.batch_chunk_size, fetch=True)]
+            execute_values(cur, sqlstring + values, rows, page_size=self.batch_chunk_size)
+        elif self.dbtype == "sqlite":
+            sqlstring = sqlstring + "(" + ",".join("?" for c in columns) + ")"
+            if ignore_conflicts:
+                sqlstring = sqlstring.replace("INSERT INTO", "INSERT OR IGNORE INTO", 1)
+            if returning:
+                # sqlite statements do not leave the process, so one execute per row costs no round trips
+                ids = []
+                for row in rows:
+                    cur.execute(sqlstring, row)
+                    ids.append(cur.lastrowid)
+                return ids
+            cur.executemany(sqlstring, rows)
+        return []
+
+    def _vocabulary_cache_key(self, tablename, val, kwargs):
+        """ Cache key for a value lookup, or None if the lookup should always go to the database """
+        if tablename not in self.vocabulary_tables or val is None:
+            return None
+        for value in kwargs.values():
+            if value is None:
+                return None # NULL never matches in SQL, so these lookups never find a row
+        return (self.dbtype, self.dbname, self.host, self.schema, tablename, self._value_key(val),
+                tuple(sorted((k.lower(), self._value_key(v)) for k, v in kwargs.items())))
+
+    def _vocabulary_cache_get(self, key):
+        if key is None:
+            return None
+        pending = self.state.vocabulary_pending
+        with self.vocabulary_cache_lock:
+            if key in pending:
+                self.vocabulary_cache_stats["hits"] += 1
+                return pending[key]
+            table = self.vocabulary_cache.get(key[:5])
+            if table is not None and key[5:] in table:
+                table.move_to_end(key[5:])
+                self.vocabulary_cache_stats["hits"] += 1
+                return table[key[5:]]
+            self.vocabulary_cache_stats["misses"] += 1
+        return None
+
+    def _vocabulary_cache_put(self, key, row_id):
+        if key is None or row_id is None:
+            return
+        if self.transaction_depth > 0:
+            # Other connections cannot see the row until the transaction commits, and it may be rolled back
+            self.state.vocabulary_pending[key] = row_id
+            return
+        self._publish_vocabulary_cache({key: row_id})
+
+    def _publish_vocabulary_cache(self, entries):
+        """ Share committed ids with every DBInterface in the process """
+        if not entries:
+            return
+        with self.vocabulary_cache_lock:
+            for key, row_id in entries.items():
+                table = self.vocabulary_cache.setdefault(key[:5], OrderedDict())
+                if key[5:] not in table:
+                    self.vocabulary_cache_stats["size"] += 1
+                table[key[5:]] = row_id
+                table.move_to_end(key[5:])
+            while self.vocabulary_cache_stats["size"] > self.vocabulary_cache_size:
+                max(self.vocabulary_cache.values(), key=len).popitem(last=False)
+                self.vocabulary_cache_stats["size"] -= 1
+
+    def invalidate_vocabulary_cache(self, tablename=None):
+        """ Forget cached ids for this database, for one table or for all of them """
+        if tablename is not None and tablename not in self.vocabulary_tables:
+            return
+        pending = self.state.vocabulary_pending
+        for key in [key for key in pending if tablename in (None, key[4])]:
+            del pending[key]
+        database = (self.dbtype, self.dbname, self.host, self.schema)
+        with self.vocabulary_cache_lock:
+            if tablename is not None:
+                table_keys = [database + (tablename,)]
+            else:
+                table_keys = [table_key for table_key in self.vocabulary_cache if table_key[:4] == database]
+            for table_key in table_keys:
+                table = self.vocabulary_cache.pop(table_key, None)
+                if table is not None:
+                    self.vocabulary_cache_stats["size"] -= len(table)
+
+    def get_vocabulary_cache_stats(self):
+        with self.vocabulary_cache_lock:
+            return {"hits": self.vocabulary_cache_stats["hits"], "misses": self.vocabulary_cache_stats["misses"],
+                    "size": self.vocabulary_cache_stats["size"]}
+
     def get_uuid(self, url):
         if url is None:
             return None
@@ -152,7 +585,7 @@ class DBInterface:
     def set_setting(self, setting_name, new_value):
         curent_value = self.get_setting(setting_name)
         con = self.getConnection()
-        with con:
+        with self._commit_block(con):
             cur = self.getRowCursor()
             if not curent_value:
                 cur.execute(self._prep("insert into settings(setting_value, setting_name) values (?,?)"),
@@ -165,7 +598,7 @@ class DBInterface:
         for key, value in kwargs.items():
             setattr(self, key, value)
         con = self.getConnection()
-        with con:
+        with self._commit_block(con):
             cur = self.getDictCursor()
             if self.repo_id > 0:
                 # Existing repo
@@ -251,6 +684,24 @@ class DBInterface:
         self.logger.debug("Last crawl ts for repo_id {} is {}".format(repo_id, returnvalue))
         return returnvalue
 
+    def get_repo_last_refresh(self, repo_id):
+        returnvalue = 0
+        if repo_id == 0 or repo_id is None:
+            return 0
+        records = self.get_multiple_records("repositories", "last_refresh_timestamp", "repository_id", repo_id)
+        for record in records:
+            returnvalue = int(record['last_refresh_timestamp'] or 0)
+        return returnvalue
+
+    def get_repo_last_complete_listing(self, repo_id):
+        returnvalue = 0
+        if repo_id == 0 or repo_id is None:
+            return 0
+        records = self.get_multiple_records("repositories", "last_complete_listing_timestamp", "repository_id", repo_id)
+        for record in records:
+            returnvalue = int(record['last_complete_listing_timestamp'] or 0)
+        return returnvalue
+
     def get_repositories(self):
         records = self.get_multiple_records("repositories", "*", "enabled", "1", "or enabled = 'true'")
         repos = [dict(rec) for rec in records]
@@ -268,13 +719,35 @@ class DBInterface:
         return ror_affiliation_matches
 
     def write_ror_affiliation_match(self, affiliation_string, ror_id, score, country):
-        ror_affiliation_match_id = self.get_single_record_id("ror_affiliation_matches", affiliation_string)
-        if ror_affiliation_match_id is not None:
-            self.delete_rows("ror_affiliation_matches", affiliation_string, ror_affiliation_match_id)
-        extras = {"ror_id": ror_id, "score": score, "country": country, "updated_timestamp": int(time.time())}
-        self.insert_related_record("ror_affiliation_matches", affiliation_string, **extras)
+        self.write_ror_affiliation_matches([(affiliation_string, ror_id, score, country)])
         return self.get_ror_from_affiliation(affiliation_string)
 
+    def write_ror_affiliation_matches(self, matches):
+        """ Save (affiliation_string, ror_id, score, country) matches in one transaction, replacing any earlier ones """
+        if not matches:
+            return
+        updated_timestamp = int(time.time())
+        # The last match for an affiliation string wins
+        rows = list(dict((match[0], tuple(match) + (updated_timestamp,)) for match in matches).values())
+        affiliation_strings = [row[0] for row in rows]
+        with self.transaction():
+            cur = self.getRowCursor()
+            for i in range(0, len(affiliation_strings), self.batch_chunk_size):
+                chunk = affiliation_strings[i:i + self.batch_chunk_size]
+                cur.execute(self._prep("DELETE FROM ror_affiliation_matches WHERE affiliation_string IN ({})".format(
+                    ",".join("?" for a in chunk))), chunk)
+            self._insert_many(cur, "ror_affiliation_matches",
+                              ["affiliation_string", "ror_id", "score", "country", "updated_timestamp"], rows)
+
+    def get_unmatched_affiliations(self, matched_before=0):
+        """ Distinct affiliation strings that have not been matched to ROR, or were last matched before matched_before """
+        sqlstring = """SELECT DISTINCT affiliations.affiliation FROM affiliations
+            LEFT JOIN ror_affiliation_matches ON ror_affiliation_matches.affiliation_string = affiliations.affiliation
+            WHERE affiliations.affiliation IS NOT NULL AND affiliations.affiliation != ''
+            AND (ror_affiliation_matches.ror_affiliation_match_id IS NULL
+                OR ror_affiliation_matches.updated_timestamp < ?)"""
+        return [row[0] for row in self.stream_query(sqlstring, (int(matched_before),), dict_rows=False)]
+
     def update_record(self, record_uuid, fields):
         recordidcolumn = self.get_table_id_column("records")
         update_record_sql = "update records set "
@@ -288,18 +761,35 @@ class DBInterface:
         update_vals.append(record_uuid)
 
         con = self.getConnection()
-        with con:
+        with self._commit_block(con):
             cur = self.getRowCursor()
             cur.execute(self._prep(update_record_sql), update_vals)
 
     def update_last_crawl(self, repo_id):
         con = self.getConnection()
-        with con:
+        with self._commit_block(con):
             update_sql = "update repositories set last_crawl_timestamp = ? where repository_id = ?"
             update_params = (int(time.time()), repo_id)
             cur = self.getRowCursor()
             cur.execute(self._prep(update_sql), update_params)
 
+    def update_last_refresh(self, repo_id):
+        con = self.getConnection()
+        with self._commit_block(con):
+            update_sql = "update repositories set last_refresh_timestamp = ? where repository_id = ?"
+            update_params = (int(time.time()), repo_id)
+            cur = self.getRowCursor()
+            cur.execute(self._prep(update_sql), update_params)
+
+    def update_last_complete_listing(self, repo_id, listing_started):
+        """ Record that the repository was listed in full, as of when the listing started """
+        con = self.getConnection()
+        with self._commit_block(con):
+            update_sql = "update repositories set last_complete_listing_timestamp = ? where repository_id = ?"
+            update_params = (int(listing_started), repo_id)
+            cur = self.getRowCursor()
+            cur.execute(self._prep(update_sql), update_params)
+
     def set_repo_enabled(self, repo_id, enabled):
         cur = self.getRowCursor()
         cur.execute(self._prep("update repositories set enabled = ? where repository_id = ?"),
@@ -310,7 +800,7 @@ class DBInterface:
         con = self.getConnection()
         if record[recordidcolumn] == "":
             return False
-        with con:
+        with self._commit_block(con):
             delete_sql = "UPDATE records set deleted = 1, modified_timestamp = ?, upstream_modified_timestamp = ? where " + recordidcolumn + "=?"
             delete_params = (time.time(), time.time(), record[recordidcolumn])
             cur = self.getRowCursor()
@@ -321,10 +811,7 @@ class DBInterface:
                 return False
 
         try:
-            for tablename in [
-                "records_x_access", "records_x_affiliations", "records_x_crdc", "records_x_creators",
-                "descriptions", "domain_metadata", "geobbox", "geofile", "geoplace", "geopoint",
-                "records_x_publishers", "records_x_rights", "records_x_subjects", "records_x_tags" ]:
+            for tablename in self.record_detail_tables:
                 self.delete_rows(tablename, recordidcolumn, record[recordidcolumn])
         except Exception as e:
             self.logger.error(
@@ -334,9 +821,48 @@ class DBInterface:
         self.logger.debug("Marked as deleted: record local_identifier: {}".format(record['local_identifier']))
         return True
 
+    def get_unlisted_records(self, repo_id, listed_identifiers):
+        """ The ids of the live records in the repository whose identifier is not in a full listing, and how many
+        live records the repository has """
+        recordidcolumn = self.get_table_id_column("records")
+        with self.transaction():
+            cur = self.getDictCursor()
+            # The listing goes into a temporary table, so the database finds the unlisted records with one query
+            cur.execute("CREATE TEMP TABLE IF NOT EXISTS listed_identifiers (local_identifier TEXT PRIMARY KEY)")
+            cur.execute("DELETE FROM listed_identifiers")
+            self._insert_many(cur, "listed_identifiers", ["local_identifier"],
+                              [(str(local_identifier),) for local_identifier in listed_identifiers], ignore_conflicts=True)
+            cur.execute(self._prep("SELECT recs." + recordidcolumn + " FROM records recs WHERE recs.repository_id = ? "
+                                   "AND recs.deleted = 0 AND NOT EXISTS (SELECT 1 FROM listed_identifiers listed "
+                                   "WHERE listed.local_identifier = recs.local_identifier)"), (repo_id,))
+            unlisted = [row[recordidcolumn] for row in cur.fetchall()]
+            cur.execute(self._prep("SELECT count(*) AS live_count FROM records WHERE repository_id = ? AND deleted = 0"),
+                        (repo_id,))
+            live_count = int(cur.fetchone()["live_count"])
+            cur.execute("DROP TABLE listed_identifiers")
+        return unlisted, live_count
+
+    def mark_records_deleted(self, unlisted):
+        """ Mark these records as deleted and remove their details; returns how many """
+        recordidcolumn = self.get_table_id_column("records")
+        if not unlisted:
+            return 0
+
+        with self.transaction():
+            cur = self.getDictCursor()
+            for i in range(0, len(unlisted), self.batch_chunk_size):
+                chunk = unlisted[i:i + self.batch_chunk_size]
+                placeholders = ",".join("?" for u in chunk)
+                cur.execute(self._prep("UPDATE records set deleted = 1, modified_timestamp = ?, upstream_modified_timestamp = ? where " +
+                                       recordidcolumn + " IN (" + placeholders + ")"), [time.time(), time.time()] + chunk)
+                for tablename in self.record_detail_tables:
+                    cur.execute(self._prep("DELETE FROM " + tablename + " WHERE " + recordidcolumn + " IN (" + placeholders + ")"),
+                                chunk)
+        return len(unlisted)
+
     def purge_deleted_records(self):
         con = self.getConnection()
-        with con:
+        with self._commit_block(con):
             cur = self.getRowCursor()
             try:
                 sqlstring = "DELETE from records where deleted=1"
@@ -347,12 +873,13 @@ class DBInterface:
 
     def delete_rows(self, tablename, columnname, column_value, extrawhere=""):
         con = self.getConnection()
-        with con:
+        with self._commit_block(con):
             cur = self.getRowCursor()
             try:
                 delete_sql = "DELETE from {} where {}=? {}".format(tablename, columnname, extrawhere)
                 delete_params = (column_value,)
                 cur.execute(self._prep(delete_sql), delete_params)
+                self.invalidate_vocabulary_cache(tablename)
             except Exception as e:
                 self.logger.error("delete_rows() failed with sqlstring \"{}\": {}".format(delete_sql, e))
                 raise e
@@ -365,12 +892,13 @@ class DBInterface:
         update_params.append(row_id)
 
         con = self.getConnection()
-        with con:
+        with self._commit_block(con):
             cur = self.getRowCursor()
             try:
                 cur.execute(self._prep(update_sql), update_params )
             except Exception as e:
                 return False
+            self.invalidate_vocabulary_cache(tablename)
             return True
 
     def get_table_id_column(self, tablename):
@@ -414,7 +942,7 @@ class DBInterface:
             ",".join(str("?") for k in list(paramlist.keys())))
 
         con = self.getConnection()
-        with con:
+        with self._commit_block(con):
             cur = self.getDictCursor()
             try:
                 if self.dbtype == "postgres":
@@ -426,6 +954,7 @@ class DBInterface:
             except self.dblayer.IntegrityError as e:
                 self.logger.error("Record insertion problem insert_related_record: {} {}".format(e, sqlstring))
 
+        self._vocabulary_cache_put(self._vocabulary_cache_key(tablename, val, kwargs), related_record_id)
         return related_record_id
 
     def insert_cross_record(self, crosstable, relatedtable, related_id, record_uuid, **kwargs):
@@ -441,7 +970,7 @@ class DBInterface:
             ",".join(str("?") for k in list(paramlist.keys())))
 
         con = self.getConnection()
-        with con:
+        with self._commit_block(con):
             cur = self.getDictCursor()
             try:
                 if self.dbtype == "postgres":
@@ -464,7 +993,7 @@ class DBInterface:
             extrawhere = extrawhere + " and " + "=? and ".join(str(k) for k in list(paramlist.keys())) + "=?"
         sqlstring = "select {} from {} where {}=? {}".format(columnlist, tablename, given_col, extrawhere)
         con = self.getConnection()
-        with con:
+        with self._commit_block(con):
             cur = self.getDictCursor()
             cur.execute(self._prep(sqlstring), [given_val] + (list(paramlist.values())))
             if cur is not None:
@@ -474,7 +1003,7 @@ class DBInterface:
     def get_records_raw_query(self, sqlstring):
         records = []
         con = self.getConnection()
-        with con:
+        with self._commit_block(con):
             cur = self.getDictCursor()
             cur.execute(self._prep(sqlstring))
             if cur is not None:
@@ -483,12 +1012,21 @@ class DBInterface:
 
     def update_records_raw_query(self, sqlstring):
         con = self.getConnection()
-        with con:
+        with self._commit_block(con):
             cur = self.getDictCursor()
             cur.execute(self._prep(sqlstring))
+        # Any table may have changed
+        self.invalidate_vocabulary_cache()
 
     def get_single_record_id(self, tablename, val, extrawhere="", **kwargs):
         returnvalue = None
+        cache_key = None
+        if extrawhere == "":
+            cache_key = self._vocabulary_cache_key(tablename, val, kwargs)
+        if cache_key is not None:
+            returnvalue = self._vocabulary_cache_get(cache_key)
+            if returnvalue is not None:
+                return returnvalue
         idcolumn = self.get_table_id_column(tablename)
         valcolumn = self.get_table_value_column(tablename)
         records = self.get_multiple_records(tablename, idcolumn, valcolumn, val, extrawhere, **kwargs)
@@ -497,6 +1035,7 @@ class DBInterface:
                 returnvalue = str(record[idcolumn])
             else:
                 returnvalue = int(record[idcolumn])
+        self._vocabulary_cache_put(cache_key, returnvalue)
         return returnvalue
 
     def construct_local_url(self, record):
@@ -558,7 +1097,7 @@ class DBInterface:
         new_uuid = self.get_uuid(rec["item_url"])
         rec[recordidcolumn] = new_uuid
         con = self.getConnection()
-        with con:
+        with self._commit_block(con):
             cur = self.getDictCursor()
             try:
                 new_record_sql = """INSERT INTO records (""" + recordidcolumn + """,title, title_fr, pub_date, series, modified_timestamp,
@@ -573,11 +1112,133 @@ class DBInterface:
 
         return rec[recordidcolumn]
 
+    def _related_values(self, record, val_table, val_fieldname, extras):
+        """ Normalize the incoming values of one field and describe how each is looked up, inserted and linked """
+        recordidcolumn = self.get_table_id_column("records")
+        cross_extras = {}
+        if val_fieldname in ["creator", "contributor"]:
+            cross_extras = extras
+        if not isinstance(record[val_fieldname], list):
+            record[val_fieldname] = [record[val_fieldname]]
+        for value in record[val_fieldname]:
+            if value is not None:
+                if isinstance(value, str):
+                    value = value.strip()
+                # special cases
+                if val_fieldname == "geoplaces":
+                    if "country" not in value:
+                        value["country"] = ""
+                    if "province_state" not in value:
+                        value["province_state"] = ""
+                    if "city" not in value:
+                        value["city"] = ""
+                    if "other" not in value:
+                        value["other"] = ""
+                    if "place_name" not in value:
+                        value["place_name"] = ""
+                    extras = {"country": value["country"], "province_state": value["province_state"],
+                              "city": value["city"], "other": value["other"], "place_name": value["place_name"]}
+                elif val_fieldname == "geopoints":
+                    if "lat" in value and "lon" in value:
+                        try:
+                            value["lat"] = float(value["lat"])
+                            value["lon"] = float(value["lon"])
+                            # Check coordinates are valid numbers
+                            if not (self.check_lat(value.get("lat")) and self.check_long(value.get("lon"))):
+                                continue
+                            extras = {"lat": value["lat"], "lon": value["lon"]}
+                        except Exception as e:
+                            self.logger.error("Unable to update geopoint for record id {}: {}".format(record[recordidcolumn], e))
+                            continue
+                elif val_fieldname == "geobboxes":
+                    try:
+                        # Fill in any missing values
+                        if "eastLon" not in value and "westLon" in value:
+                            value["eastLon"] = value["westLon"]
+                        if "westLon" not in value and "eastLon" in value:
+                            value["westLon"] = value["eastLon"]
+                        if "northLat" not in value and "southLat" in value:
+                            value["northLat"] = value["southLat"]
+                        if "southLat" not in value and "northLat" in value:
+                            value["southLat"] = value["northLat"]
+                        # Check all coordinates are valid numbers
+                        if not (self.check_lat(value.get("northLat")) and self.check_lat(value.get("southLat")) and
+                                self.check_long(value.get("westLon")) and self.check_long(value.get("eastLon"))):
+                            continue
+                        if value["westLon"] != value["eastLon"] or value["northLat"] != value["southLat"]:
+                            # If west/east or north/south don't match, this is a box
+                            extras = {"westLon": value["westLon"], "eastLon": value["eastLon"],
+                                      "northLat": value["northLat"], "southLat": value["southLat"]}
+                        else:
+                            if "geopoints" not in record:
+                                record["geopoints"] = []
+                            record["geopoints"].append({"lat": value["northLat"], "lon": value["westLon"]})
+                            continue
+                    except Exception as e:
+                        self.logger.error("Unable to update geobbox for record id {}: {}".format(record[recordidcolumn], e))
+                        continue
+                elif val_fieldname == "geofiles":
+                    if "filename" in value and "uri" in value:
+                        extras = {"filename": value["filename"], "uri": value["uri"]}
+                elif val_fieldname == "affiliation":
+                    if isinstance(value, dict) and "affiliation_ror" in list(value.keys()):
+                        extras = {"affiliation_ror": value["affiliation_ror"]}
+                    else:
+                        extras = {"affiliation_ror": ""}
+                    if isinstance(value, dict) and "affiliation_name" in list(value.keys()):
+                        value = value["affiliation_name"]
+                elif val_fieldname in ["rights", "description", "description_fr"]:
+                    sha1 = hashlib.sha1()
+                    sha1.update(value.encode('utf-8'))
+                    original_value = value
+                    value = sha1.hexdigest()
+                    if val_fieldname == "rights":
+                        extras = {"rights": original_value}
+                    elif val_fieldname == "description":
+                        extras =  {recordidcolumn: record[recordidcolumn], "language": "en"}
+                    elif val_fieldname == "description_fr":
+                        extras = {recordidcolumn: record[recordidcolumn], "language": "fr"}
+
+                # how to find an existing value record
+                if val_fieldname in ["affiliation", "description", "description_fr"]:
+                    lookup = (value, dict(extras))
+                elif val_fieldname in ["tags", "tags_fr", "subject", "subject_fr"]:
+                    lookup = (value, dict(extras))
+                elif val_fieldname in ["geoplaces", "geopoints", "geobboxes", "geofiles"]:
+                    lookup = (record[recordidcolumn], dict(extras))
+                elif val_fieldname in ["creator"]:
+                    creator_name = value
+                    if isinstance(value, dict):
+                        creator_name = value["name"].strip()
+                        creator_orcid = self.normalize_orcid(value["orcid"])
+                        basetable_extras = {"orcid_id": creator_orcid}
+                    else:
+                        basetable_extras = {}
+                    lookup = (creator_name, basetable_extras)
+                else: # ["contributor", "publisher", "rights", "access"]
+                    lookup = (value, {})
+
+                # how to write a new value record if none was found
+                if val_fieldname in ["description", "description_fr"]:
+                    insert = (value, dict(extras, description=original_value))
+                elif val_fieldname in ["contributor", "publisher"]:
+                    insert = (value, {})
+                elif val_fieldname in ["creator"]:
+                    if isinstance(value, dict):
+                        insert = (value["name"], basetable_extras)
+                    else:
+                        insert = (value, {})
+                elif val_fieldname in ["geoplaces", "geopoints", "geobboxes", "geofiles"]:
+                    insert = (record[recordidcolumn], dict(extras))
+                else: # ["affiliation", "rights", "access", "tags", "tags_fr", "subject", "subject_fr"]:
+                    insert = (value, dict(extras))
+
+                yield {"lookup": lookup, "insert": insert, "cross_extras": cross_extras}
+
     def update_related_metadata(self, record, val_table, val_fieldname, extras=None):
         if extras is None:
             extras = {}
         extrawhere = ""
-        basetable_extras = {}
         modified_upstream = False
         val_idcol = self.get_table_id_column(val_table)
         crosstable = self.get_table_crosstable(val_table)
@@ -588,139 +1249,30 @@ class DBInterface:
 
         if crosstable:
             query_sql = "select v.{} from {} v join {} x on x.{} = v.{} where x." + recordidcolumn + " = '{}' {} "
-            existing_val_recs = self.get_records_raw_query(query_sql.format(val_idcol, val_table, crosstable, 
+            existing_val_recs = self.get_records_raw_query(query_sql.format(val_idcol, val_table, crosstable,
                                 val_idcol, val_idcol, record[recordidcolumn], extrawhere))
         else:
             existing_val_recs = self.get_multiple_records(val_table, val_idcol, recordidcolumn, record[recordidcolumn], extrawhere)
         existing_val_recs_ids = [e[val_idcol] for e in existing_val_recs]
         if val_fieldname in record:
-            if not isinstance(record[val_fieldname], list):
-                record[val_fieldname] = [record[val_fieldname]]
             new_val_recs_ids = []
-            for value in record[val_fieldname]:
-                if value is not None:
-                    if isinstance(value, str):
-                        value = value.strip()
-                    # special cases
-                    if val_fieldname == "geoplaces":
-                        if "country" not in value:
-                            value["country"] = ""
-                        if "province_state" not in value:
-                            value["province_state"] = ""
-                        if "city" not in value:
-                            value["city"] = ""
-                        if "other" not in value:
-                            value["other"] = ""
-                        if "place_name" not in value:
-                            value["place_name"] = ""
-                        extras = {"country": value["country"], "province_state": value["province_state"],
-                                  "city": value["city"], "other": value["other"], "place_name": value["place_name"]}
-                    elif val_fieldname == "geopoints":
-                        if "lat" in value and "lon" in value:
-                            try:
-                                value["lat"] = float(value["lat"])
-                                value["lon"] = float(value["lon"])
-                                # Check coordinates are valid numbers
-                                if not (self.check_lat(value.get("lat")) and self.check_long(value.get("lon"))):
-                                    continue
-                                extras = {"lat": value["lat"], "lon": value["lon"]}
-                            except Exception as e:
-                                self.logger.error("Unable to update geopoint for record id {}: {}".format(record[recordidcolumn], e))
-                                continue
-                    elif val_fieldname == "geobboxes":
-                        try:
-                            # Fill in any missing values
-                            if "eastLon" not in value and "westLon" in value:
-                                value["eastLon"] = value["westLon"]
-                            if "westLon" not in value and "eastLon" in value:
-                                value["westLon"] = value["eastLon"]
-                            if "northLat" not in value and "southLat" in value:
-                                value["northLat"] = value["southLat"]
-                            if "southLat" not in value and "northLat" in value:
-                                value["southLat"] = value["northLat"]
-                            # Check all coordinates are valid numbers
-                            if not (self.check_lat(value.get("northLat")) and self.check_lat(value.get("southLat")) and
-                                    self.check_long(value.get("westLon")) and self.check_long(value.get("eastLon"))):
-                                continue
-                            if value["westLon"] != value["eastLon"] or value["northLat"] != value["southLat"]:
-                                # If west/east or north/south don't match, this is a box
-                                extras = {"westLon": value["westLon"], "eastLon": value["eastLon"],
-                                          "northLat": value["northLat"], "southLat": value["southLat"]}
-                            else:
-                                if "geopoints" not in record:
-                                    record["geopoints"] = []
-                                record["geopoints"].append({"lat": value["northLat"], "lon": value["westLon"]})
-                                continue
-                        except Exception as e:
-                            self.logger.error("Unable to update geobbox for record id {}: {}".format(record[recordidcolumn], e))
-                            continue
-                    elif val_fieldname == "geofiles":
-                        if "filename" in value and "uri" in value:
-                            extras = {"filename": value["filename"], "uri": value["uri"]}
-                    elif val_fieldname == "affiliation":
-                        if isinstance(value, dict) and "affiliation_ror" in list(value.keys()):
-                            extras = {"affiliation_ror": value["affiliation_ror"]}
-                        else:
-                            extras = {"affiliation_ror": ""}
-                        if isinstance(value, dict) and "affiliation_name" in list(value.keys()):
-                            value = value["affiliation_name"]
-                    elif val_fieldname in ["rights", "description", "description_fr"]:
-                        sha1 = hashlib.sha1()
-                        sha1.update(value.encode('utf-8'))
-                        original_value = value
-                        value = sha1.hexdigest()
-                        if val_fieldname == "rights":
-                            extras = {"rights": original_value}
-                        elif val_fieldname == "description":
-                            extras =  {recordidcolumn: record[recordidcolumn], "language": "en"}
-                        elif val_fieldname == "description_fr":
-                            extras = {recordidcolumn: record[recordidcolumn], "language": "fr"}
-
-                    # get existing value record if it exists
-                    if val_fieldname in ["affiliation", "description", "description_fr"]:
-                        val_rec_id = self.get_single_record_id(val_table, value, **extras)
-                    elif val_fieldname in ["tags", "tags_fr", "subject", "subject_fr"]:
-                        val_rec_id = self.get_single_record_id(val_table, value, extrawhere)
-                    elif val_fieldname in ["geoplaces", "geopoints", "geobboxes", "geofiles"]:
-                        val_rec_id = self.get_single_record_id(val_table, record[recordidcolumn], **extras)
-                    elif val_fieldname in ["creator"]:
-                        creator_name = value
-                        if isinstance(value, dict):
-                            creator_name = value["name"].strip()
-                            creator_orcid = self.normalize_orcid(value["orcid"])
-                            basetable_extras = {"orcid_id": creator_orcid}
-                        else:
-                            basetable_extras = {}
-                        val_rec_id = self.get_single_record_id(val_table, creator_name, **basetable_extras)
-                    else: # ["contributor", "publisher", "rights"]
-                        val_rec_id = self.get_single_record_id(val_table, value)
-
-                    # write val_table record and crosstable records if needed
-                    if val_rec_id is None:
-                        if val_fieldname in ["description", "description_fr"]:
-                            extras["description"] = original_value
-                        if val_fieldname in ["contributor", "publisher"]:
-                            val_rec_id = self.insert_related_record(val_table, value)
-                        elif val_fieldname in ["creator"]:
-                            if isinstance(value, dict):
-                                val_rec_id = self.insert_related_record(val_table, value["name"], **basetable_extras)
-                            else:
-                                val_rec_id = self.insert_related_record(val_table, value)
-                        elif val_fieldname in ["geoplaces", "geopoints", "geobboxes", "geofiles"]:
-                            val_rec_id = self.insert_related_record(val_table, record[recordidcolumn], **extras)
-                        else: # ["affiliation", "rights", "tags", "tags_fr", "subject", "subject_fr", "description", "description_fr"]:
-                            val_rec_id = self.insert_related_record(val_table, value, **extras)
-                        if val_fieldname != "geopoints": # Remove conditional when Geodisy starts processing points
+            for related_value in self._related_values(record, val_table, val_fieldname, extras):
+                # get existing value record if it exists
+                lookup_value, lookup_extras = related_value["lookup"]
+                val_rec_id = self.get_single_record_id(val_table, lookup_value, **lookup_extras)
+
+                # write val_table record and crosstable records if needed
+                if val_rec_id is None:
+                    insert_value, insert_extras = related_value["insert"]
+                    val_rec_id = self.insert_related_record(val_table, insert_value, **insert_extras)
+                    if val_fieldname != "geopoints": # Remove conditional when Geodisy starts processing points
+                        modified_upstream = True
+                if val_rec_id is not None:
+                    if crosstable:
+                        if val_rec_id not in existing_val_recs_ids and val_rec_id not in new_val_recs_ids:
+                            self.insert_cross_record(crosstable, val_table, val_rec_id, record[recordidcolumn], **related_value["cross_extras"])
                             modified_upstream = True
-                    if val_rec_id is not None:
-                        if crosstable:
-                            if val_rec_id not in existing_val_recs_ids and val_rec_id not in new_val_recs_ids:
-                                if val_fieldname in ["creator", "contributor"]:
-                                    self.insert_cross_record(crosstable, val_table, val_rec_id, record[recordidcolumn], **extras)
-                                else:
-                                    self.insert_cross_record(crosstable, val_table, val_rec_id, record[recordidcolumn])
-                                modified_upstream = True
-                        new_val_recs_ids.append(val_rec_id)
+                    new_val_recs_ids.append(val_rec_id)
 
             for eid in existing_val_recs_ids: # delete value if no longer present in incoming record values
                 if eid not in new_val_recs_ids:
@@ -742,6 +1294,13 @@ class DBInterface:
         return modified_upstream
 
     def write_record(self, record, repo):
+        if self.dbtype == "sqlite":
+            # One commit (and fsync) per record, rather than one per statement
+            with self.transaction():
+                return self._write_record(record, repo)
+        return self._write_record(record, repo)
+
+    def _write_record(self, record, repo):
         repo_id = repo.repository_id
         domain_metadata = repo.domain_metadata
         recordidcolumn = self.get_table_id_column("records")
@@ -753,6 +1312,7 @@ class DBInterface:
         record["item_url_pattern"] = repo.item_url_pattern
         if record.get("item_url", None) is None:
             record["item_url"] = self.construct_local_url(record)
+        content_hash = self.record_content_hash(record, domain_metadata)
 
         con = self.getConnection()
 
@@ -764,12 +1324,15 @@ class DBInterface:
             records = self.get_multiple_records("records", "*", recordidcolumn, record[recordidcolumn])
             if len(records) == 1:
                 existing_record = records[0]
+                if existing_record["content_hash"] == content_hash and int(existing_record["deleted"]) == 0:
+                    # Nothing has changed upstream since this record was last written
+                    self.touch_record(record)
+                    return None
                 try:
                     for record_field in ["title", "title_fr", "pub_date", "series", "item_url"]:
                         if existing_record[record_field] != record[record_field]:
                             modified_upstream = True
                             break
-                        modified_upstream = True
                     if existing_record["local_identifier"] != record["identifier"]:
                         modified_upstream = True
                     if existing_record["files_size"] != record.get("files_size",0):
@@ -779,7 +1342,7 @@ class DBInterface:
                     self.logger.debug("AttributeError trying to access field when checking if record has changed since Geodisy last ran")
                     raise AssertionError
 
-            with con:
+            with self._commit_block(con):
                 update_sql = """UPDATE records set title=?, title_fr=?, pub_date=?, series=?, modified_timestamp=?,
                     deleted=?, local_identifier=?, item_url=?, files_size=?, files_altered=?
                     WHERE """ + recordidcolumn + """ = ?"""
@@ -791,69 +1354,9 @@ class DBInterface:
         if record[recordidcolumn] is None:
             return None
 
-        # creators
-        if self.update_related_metadata(record, "creators", "creator", {"is_contributor": 0}):
-            modified_upstream = True
-
-        # contributors
-        if self.update_related_metadata(record, "creators", "contributor", {"is_contributor": 1}):
-            modified_upstream = True
-
-        # publishers
-        if self.update_related_metadata(record, "publishers", "publisher"):
-            modified_upstream = True
-
-        # affiliations
-        if self.update_related_metadata(record, "affiliations", "affiliation"):
-            modified_upstream = True
-
-        # access
-        if self.update_related_metadata(record, "access", "access"):
-            modified_upstream = True
-
-        # rights
-        if self.update_related_metadata(record, "rights", "rights"):
-            modified_upstream = True
-
-        # tags - en
-        if self.update_related_metadata(record, "tags", "tags", {"language": "en"}):
-            modified_upstream = True
-
-        # tags - fr
-        if self.update_related_metadata(record, "tags", "tags_fr", {"language": "fr"}):
-            modified_upstream = True
-
-        # subjects - en
-        if self.update_related_metadata(record, "subjects", "subject", {"language": "en"}):
-            modified_upstream = True
-
-        # subjects - fr
-        if self.update_related_metadata(record, "subjects", "subject_fr", {"language": "fr"}):
-            modified_upstream = True
-
-        # geoplaces
-        if self.update_related_metadata(record, "geoplace", "geoplaces"):
-            modified_upstream = True
-
-        # descriptions - en
-        if self.update_related_metadata(record, "descriptions", "description", {"language": "en"}):
-            modified_upstream = True
-
-        # descriptions - fr
-        if self.update_related_metadata(record, "descriptions", "description_fr", {"language": "fr"}):
-            modified_upstream = True
-
-        # geobboxes
-        if self.update_related_metadata(record, "geobbox", "geobboxes"):
-            modified_upstream = True
-
-        # geopoints
-        if self.update_related_metadata(record, "geopoint", "geopoints"):
-            modified_upstream = True
-
-        # geofiles
-        if self.update_related_metadata(record, "geofile", "geofiles"):
-            modified_upstream = True
+        for val_table, val_fieldname, extras in self.related_metadata_fields:
+            if self.update_related_metadata(record, val_table, val_fieldname, extras):
+                modified_upstream = True
 
         # crdc
         if "crdc" in record:
@@ -930,33 +1433,496 @@ class DBInterface:
 
         if modified_upstream:
             self.update_record_upstream_modified(record)
+        # Only store the hash once everything else is written, so a failed write is retried next time
+        self.update_record_content_hash(record, content_hash)
+
+        return None
+
+    def _match_value(self, a, b):
+        """ Compare a stored column value with an incoming one the way the = operator would """
+        if a is None or b is None:
+            return False
+        if isinstance(a, (int, float, Decimal)) or isinstance(b, (int, float, Decimal)):
+            try:
+                return float(a) == float(b)
+            except (TypeError, ValueError):
+                pass
+        return str(a) == str(b)
+
+    def _value_key(self, value):
+        if isinstance(value, (int, float, Decimal)):
+            return float(value)
+        return str(value)
+
+    def _find_related_rows(self, cur, tablename, values):
+        """ Fetch the rows of a value table for many values at once, keyed by value """
+        valcolumn = self.get_table_value_column(tablename)
+        found = {}
+        rows = self._select_in(cur, "SELECT * FROM " + tablename + " WHERE " + valcolumn + " IN ({})",
+                               [v for v in values if v is not None])
+        for row in rows:
+            row = {k.lower(): row[k] for k in row.keys()}
+            found.setdefault(self._value_key(row[valcolumn.lower()]), []).append(row)
+        return found
+
+    def _match_related_row(self, tablename, rows, val, kwargs):
+        """ Return the last row matching a value and its extra columns, like get_single_record_id() """
+        if val is None:
+            return None
+        valcolumn = self.get_table_value_column(tablename).lower()
+        match = None
+        for row in rows.get(self._value_key(val), []):
+            if self._match_value(row[valcolumn], val) and \
+                    all(self._match_value(row.get(k.lower()), v) for k, v in kwargs.items()):
+                match = row
+        return match
+
+    def _insert_related_rows(self, cur, tablename, rows):
+        """ Insert pending value table rows, grouped by their columns, and fill in their new ids """
+        valcolumn = self.get_table_value_column(tablename)
+        idcolumn = self.get_table_id_column(tablename)
+        groups = {}
+        for row in rows:
+            groups.setdefault(tuple(row["_columns"].keys()), []).append(row)
+        for columns, group in groups.items():
+            new_ids = self._insert_many(cur, tablename, list(columns), [tuple(row["_columns"].values()) for row in group],
+                                        returning=idcolumn)
+            for row, new_id in zip(group, new_ids):
+                row[idcolumn.lower()] = int(new_id)
+                kwargs = {k: v for k, v in row["_columns"].items() if k != valcolumn}
+                self._vocabulary_cache_put(self._vocabulary_cache_key(tablename, row["_columns"][valcolumn], kwargs), int(new_id))
+
+    def _pending_row(self, tablename, pending, val, kwargs):
+        """ Queue a new value table row, or return the one already queued with the same value """
+        valcolumn = self.get_table_value_column(tablename)
+        row = self._match_related_row(tablename, pending, val, kwargs)
+        if row is None:
+            row = {valcolumn.lower(): val, "_columns": {valcolumn: val}}
+            for key, value in kwargs.items():
+                row[key.lower()] = value
+                row["_columns"][key] = value
+            pending.setdefault(self._value_key(val), []).append(row)
+        return row
+
+    def write_records(self, records, repo, domain_metadata_list=None):
+        """ Write a batch of records with set-based SQL, one transaction per batch; same results as write_record() """
+        if domain_metadata_list is None:
+            domain_metadata_list = [repo.domain_metadata] * len(records)
+        batch = [(r, d) for r, d in zip(records, domain_metadata_list) if r is not None]
+
+        while batch:
+            # A record can only be written once per pass, so cut the pass before any repeated identifier
+            identifiers = set()
+            cut = len(batch)
+            for i, (record, domain_metadata) in enumerate(batch):
+                if record["identifier"] in identifiers:
+                    cut = i
+                    break
+                identifiers.add(record["identifier"])
+            with self.transaction():
+                remaining, unbatched = self._write_records_pass(batch[:cut], repo)
+            # Records without a usable uuid take the single record path, which reports the problem
+            for record, domain_metadata in unbatched:
+                repo.domain_metadata = domain_metadata
+                self.write_record(record, repo)
+            batch = remaining + batch[cut:]
 
         return None
 
-    def get_stale_records(self, stale_timestamp, repo_id, max_records_updated_per_run):
+    def _write_records_pass(self, batch, repo):
+        repo_id = repo.repository_id
         recordidcolumn = self.get_table_id_column("records")
-        con = self.getConnection()
-        records = []
-        with con:
-            stale_sql = """SELECT recs.""" + recordidcolumn + """, recs.title, recs.pub_date, recs.series
-                , recs.modified_timestamp, recs.local_identifier, recs.item_url
-                , repos.repository_id, repos.repository_type, recs.geodisy_harvested, recs.files_size, recs.files_altered
-                FROM records recs, repositories repos
-                where recs.repository_id = repos.repository_id and recs.modified_timestamp < ?
-                and repos.repository_id = ? and recs.deleted = 0
-                LIMIT ?"""
-            stale_params = (stale_timestamp, repo_id, max_records_updated_per_run)
-            cur = self.getDictCursor()
-            cur.execute(self._prep(stale_sql), stale_params)
-            if cur is not None:
-                records = cur.fetchall()
+        cur = self.getDictCursor()
+        modified_upstream = {}  # Track whether metadata changed since last crawl, by record uuid
+
+        existing_records = {}
+        for row in self._select_in(cur, "SELECT * FROM records WHERE repository_id = ? AND local_identifier IN ({})",
+                                   [record["identifier"] for record, domain_metadata in batch], (repo_id,)):
+            existing_records[row["local_identifier"]] = row
+
+        # Work out every uuid first; stop the pass at a uuid seen earlier in it so that writes stay in order
+        uuids = set()
+        unbatched = []
+        content_hashes = {}
+        for i, (record, domain_metadata) in enumerate(batch):
+            record["item_url_pattern"] = repo.item_url_pattern
+            if record.get("item_url", None) is None:
+                record["item_url"] = self.construct_local_url(record)
+            content_hashes[record["identifier"]] = self.record_content_hash(record, domain_metadata)
+            if record["identifier"] in existing_records:
+                record[recordidcolumn] = str(existing_records[record["identifier"]][recordidcolumn])
+            else:
+                if record["item_url"] == "":
+                    record["item_url"] = self.construct_local_url(record)
+                record[recordidcolumn] = self.get_uuid(record["item_url"])
+                if record[recordidcolumn] is None:
+                    unbatched.append((record, domain_metadata))
+                    continue
+            if record[recordidcolumn] in uuids:
+                remaining = batch[i:]
+                batch = batch[:i]
+                break
+            uuids.add(record[recordidcolumn])
+        else:
+            remaining = []
+        batch = [(r, d) for r, d in batch if r[recordidcolumn] is not None]
+
+        new_uuids = [record[recordidcolumn] for record, domain_metadata in batch if record["identifier"] not in existing_records]
+        taken_uuids = [str(row[recordidcolumn]) for row in self._select_in(cur,
+                       "SELECT " + recordidcolumn + " FROM records WHERE " + recordidcolumn + " IN ({})", new_uuids)]
+
+        # Records whose content hash matches what was last written only need a touch
+        touch_params = []
+        changed = []
+        for record, domain_metadata in batch:
+            existing_record = existing_records.get(record["identifier"])
+            if existing_record is not None and existing_record["content_hash"] == content_hashes[record["identifier"]] \
+                    and int(existing_record["deleted"]) == 0:
+                touch_params.append((time.time(), record[recordidcolumn]))
+            else:
+                changed.append((record, domain_metadata))
+        batch = changed
+        self._execute_many(cur, "UPDATE records set modified_timestamp = ? where " + recordidcolumn + " = ?", touch_params)
+
+        new_record_rows = []
+        update_params = []
+        for record, domain_metadata in batch:
+            if record["identifier"] not in existing_records:
+                modified_upstream[record[recordidcolumn]] = True # New record has new metadata
+                if record[recordidcolumn] in taken_uuids:
+                    self.logger.error("Record insertion problem write_records: record_uuid {} already exists".format(
+                        record[recordidcolumn]))
+                    continue
+                new_record_rows.append((record[recordidcolumn], record["title"], record["title_fr"], record["pub_date"],
+                    record["series"], time.time(), 0, record["identifier"], record["item_url"], repo_id, time.time(),
+                    record.get("files_size", 0), record.get("files_altered", 1), content_hashes[record["identifier"]]))
+            else:
+                # Compare title, title_fr, pub_date, series, item_url, local_identifier for changes
+                existing_record = existing_records[record["identifier"]]
+                modified_upstream[record[recordidcolumn]] = False
+                for record_field in ["title", "title_fr", "pub_date", "series", "item_url"]:
+                    if existing_record[record_field] != record[record_field]:
+                        modified_upstream[record[recordidcolumn]] = True
+                        break
+                if existing_record["local_identifier"] != record["identifier"]:
+                    modified_upstream[record[recordidcolumn]] = True
+                if existing_record["files_size"] != record.get("files_size", 0):
+                    record["files_altered"] = 1
+                    modified_upstream[record[recordidcolumn]] = True
+                update_params.append((record["title"], record["title_fr"], record["pub_date"], record["series"], time.time(),
+                    0, record["identifier"], record["item_url"], record.get("files_size", 0), record.get("files_altered", 1),
+                    content_hashes[record["identifier"]], record[recordidcolumn]))
+
+        self._insert_many(cur, "records", [recordidcolumn, "title", "title_fr", "pub_date", "series", "modified_timestamp",
+            "deleted", "local_identifier", "item_url", "repository_id", "upstream_modified_timestamp", "files_size",
+            "files_altered", "content_hash"], new_record_rows)
+        self._execute_many(cur, """UPDATE records set title=?, title_fr=?, pub_date=?, series=?, modified_timestamp=?,
+            deleted=?, local_identifier=?, item_url=?, files_size=?, files_altered=?, content_hash=?
+            WHERE """ + recordidcolumn + """ = ?""", update_params)
+
+        records = [record for record, domain_metadata in batch]
+        for val_table, val_fieldname, extras in self.related_metadata_fields:
+            for record_uuid in self._update_related_metadata_batch(cur, records, val_table, val_fieldname, extras):
+                modified_upstream[record_uuid] = True
+        for record_uuid in self._update_crdc_batch(cur, records):
+            modified_upstream[record_uuid] = True
+        for record_uuid in self._update_domain_metadata_batch(cur, batch):
+            modified_upstream[record_uuid] = True
+
+        self._execute_many(cur, "UPDATE records set upstream_modified_timestamp = ?, geodisy_harvested = 0 where " +
+                           recordidcolumn + " = ?", [(time.time(), u) for u in modified_upstream if modified_upstream[u]])
+        return remaining, unbatched
+
+    def _update_related_metadata_batch(self, cur, records, val_table, val_fieldname, extras=None):
+        """ update_related_metadata() for many records at once; returns the uuids of the records that changed """
+        if extras is None:
+            extras = {}
+        extrawhere = ""
+        modified_upstream = set()
+        val_idcol = self.get_table_id_column(val_table)
+        crosstable = self.get_table_crosstable(val_table)
+        extracolumn = self.get_table_extracolumn(val_table)
+        recordidcolumn = self.get_table_id_column("records")
+        if extracolumn:
+            extrawhere = "and " + extracolumn + "='" + str(extras[extracolumn]) + "'"
 
+        existing_val_recs_ids = {record[recordidcolumn]: [] for record in records}
+        if crosstable:
+            query_sql = "select x." + recordidcolumn + ", v." + val_idcol + " from " + val_table + " v join " + crosstable + \
+                " x on x." + val_idcol + " = v." + val_idcol + " where x." + recordidcolumn + " IN ({}) " + extrawhere
+        else:
+            query_sql = "select " + recordidcolumn + ", " + val_idcol + " from " + val_table + " where " + \
+                recordidcolumn + " IN ({}) " + extrawhere
+        for row in self._select_in(cur, query_sql, list(existing_val_recs_ids.keys())):
+            existing_val_recs_ids[str(row[recordidcolumn])].append(row[val_idcol])
+
+        # Look up every incoming value with one query, and queue an insert for each value not found
+        related_values = {}
+        for record in records:
+            if val_fieldname in record:
+                related_values[record[recordidcolumn]] = list(self._related_values(record, val_table, val_fieldname, extras))
+        lookup_values = []
+        for values in related_values.values():
+            for related_value in values:
+                lookup_value, lookup_extras = related_value["lookup"]
+                related_value["cache_key"] = self._vocabulary_cache_key(val_table, lookup_value, lookup_extras)
+                related_value["row"] = None
+                if related_value["cache_key"] is not None:
+                    cached_id = self._vocabulary_cache_get(related_value["cache_key"])
+                    if cached_id is not None:
+                        related_value["row"] = {val_idcol.lower(): cached_id}
+                if related_value["row"] is None:
+                    lookup_values.append(lookup_value)
+        found = self._find_related_rows(cur, val_table, lookup_values)
+        pending = {}
+        for record_uuid, values in related_values.items():
+            for related_value in values:
+                if related_value["row"] is not None:
+                    continue
+                lookup_value, lookup_extras = related_value["lookup"]
+                related_value["row"] = self._match_related_row(val_table, found, lookup_value, lookup_extras)
+                if related_value["row"] is not None:
+                    self._vocabulary_cache_put(related_value["cache_key"], int(related_value["row"][val_idcol.lower()]))
+                else:
+                    # A value queued by an earlier record is found by later ones, as it would be in the database
+                    related_value["row"] = self._match_related_row(val_table, pending, lookup_value, lookup_extras)
+                if related_value["row"] is None:
+                    insert_value, insert_extras = related_value["insert"]
+                    if insert_value is not None:
+                        related_value["row"] = self._pending_row(val_table, pending, insert_value, insert_extras)
+                    if val_fieldname != "geopoints": # Remove conditional when Geodisy starts processing points
+                        modified_upstream.add(record_uuid)
+        self._insert_related_rows(cur, val_table, [row for rows in pending.values() for row in rows])
+
+        cross_rows = {}
+        delete_params = []
+        delete_all_params = []
+        for record in records:
+            record_uuid = record[recordidcolumn]
+            existing_ids = existing_val_recs_ids[record_uuid]
+            if record_uuid in related_values:
+                new_val_recs_ids = []
+                for related_value in related_values[record_uuid]:
+                    if related_value["row"] is None:
+                        continue
+                    val_rec_id = int(related_value["row"][val_idcol.lower()])
+                    if crosstable:
+                        if val_rec_id not in existing_ids and val_rec_id not in new_val_recs_ids:
+                            cross_extras = related_value["cross_extras"]
+                            cross_rows.setdefault(tuple(cross_extras.keys()), []).append(
+                                tuple([record_uuid, val_rec_id] + list(cross_extras.values())))
+                            modified_upstream.add(record_uuid)
+                    new_val_recs_ids.append(val_rec_id)
+
+                for eid in existing_ids: # delete value if no longer present in incoming record values
+                    if eid not in new_val_recs_ids:
+                        modified_upstream.add(record_uuid)
+                        if crosstable:
+                            delete_params.append((record_uuid, eid))
+                        else:
+                            delete_params.append((eid,))
+
+            elif existing_ids: # delete metadata if the field is no longer present at all in incoming record
+                modified_upstream.add(record_uuid)
+                if crosstable:
+                    delete_all_params.append((record_uuid,))
+                else:
+                    delete_params.extend((eid,) for eid in existing_ids)
+
+        if crosstable:
+            for cross_columns, rows in cross_rows.items():
+                self._insert_many(cur, crosstable, [recordidcolumn, val_idcol] + list(cross_columns), rows)
+            # Delete the cross table rows but leave the related value table rows, they may be used elsewhere
+            self._execute_many(cur, "DELETE from " + crosstable + " where " + recordidcolumn + "=? and " + val_idcol + "=?",
+                               delete_params)
+            self._execute_many(cur, "DELETE from " + crosstable + " where " + recordidcolumn + "=?", delete_all_params)
+        else:
+            self._execute_many(cur, "DELETE from " + val_table + " where " + val_idcol + "=?", delete_params)
+
+        return modified_upstream
+
+    def _update_crdc_batch(self, cur, records):
+        """ The crdc part of write_record() for many records at once; returns the uuids of the records that changed """
+        modified_upstream = set()
+        recordidcolumn = self.get_table_id_column("records")
+        crdc_key_list = ["crdc_code", "crdc_group_en", "crdc_group_fr", "crdc_class_en", "crdc_class_fr", "crdc_field_en", "crdc_field_fr"]
+        records = [record for record in records if "crdc" in record]
+        if not records:
+            return modified_upstream
+
+        existing_crdc_recs = {record[recordidcolumn]: [] for record in records}
+        for row in self._select_in(cur, "SELECT * FROM records_x_crdc WHERE " + recordidcolumn + " IN ({})",
+                                   list(existing_crdc_recs.keys())):
+            existing_crdc_recs[str(row[recordidcolumn])].append(row)
+        found = self._find_related_rows(cur, "crdc", [crdc.get("crdc_code") for record in records for crdc in record["crdc"]])
+        pending = {}
+        crdc_updates = {}
+        new_crdc = {}
+        for record in records:
+            new_crdc[record[recordidcolumn]] = []
+            for crdc in record["crdc"]:
+                all_crdc_keys_found = True
+                for key in crdc_key_list:
+                    if key not in crdc:
+                        all_crdc_keys_found = False
+                        break
+                if all_crdc_keys_found:
+                    crdc_row = self._match_related_row("crdc", found, crdc["crdc_code"], {}) or \
+                        self._match_related_row("crdc", pending, crdc["crdc_code"], {})
+                    extras = crdc.copy()
+                    extras.pop("crdc_code")
+                    if crdc_row is not None:
+                        # check if the existing CRDC entry matches - if not, update
+                        for key in crdc_key_list:
+                            if crdc[key] != crdc_row[key]:
+                                if "_columns" in crdc_row:
+                                    crdc_row["_columns"].update(extras)
+                                else:
+                                    crdc_updates[crdc_row["crdc_id"]] = extras
+                                for extra_key, value in extras.items():
+                                    crdc_row[extra_key.lower()] = value
+                                modified_upstream.add(record[recordidcolumn])
+                                break
+                    else:
+                        crdc_row = self._pending_row("crdc", pending, crdc["crdc_code"], extras)
+                        modified_upstream.add(record[recordidcolumn])
+                    new_crdc[record[recordidcolumn]].append(crdc_row)
+
+        for crdc_id, extras in crdc_updates.items():
+            self._execute_many(cur, "UPDATE crdc set " + "=?, ".join(extras.keys()) + "=? where crdc_id=?",
+                               [tuple(extras.values()) + (crdc_id,)])
+        self._insert_related_rows(cur, "crdc", [row for rows in pending.values() for row in rows])
+
+        cross_rows = []
+        delete_params = []
+        for record in records:
+            record_uuid = record[recordidcolumn]
+            existing_crdc_ids = [e["crdc_id"] for e in existing_crdc_recs[record_uuid]]
+            new_crdc_ids = []
+            for crdc_row in new_crdc[record_uuid]:
+                crdc_id = int(crdc_row["crdc_id"])
+                new_crdc_ids.append(crdc_id)
+                if crdc_id not in existing_crdc_ids:
+                    cross_rows.append((record_uuid, crdc_id))
+                    modified_upstream.add(record_uuid)
+            for eid in existing_crdc_ids:
+                if eid not in new_crdc_ids:
+                    records_x_crdc_id = [e for e in existing_crdc_recs[record_uuid] if e["crdc_id"] == eid][0]["records_x_crdc_id"]
+                    delete_params.append((records_x_crdc_id,))
+                    modified_upstream.add(record_uuid)
+        self._insert_many(cur, "records_x_crdc", [recordidcolumn, "crdc_id"], cross_rows)
+        self._execute_many(cur, "DELETE from records_x_crdc where records_x_crdc_id=?", delete_params)
+        return modified_upstream
+
+    def _update_domain_metadata_batch(self, cur, batch):
+        """ The domain metadata part of write_record() for many records at once; returns the uuids of the records that changed """
+        modified_upstream = set()
+        recordidcolumn = self.get_table_id_column("records")
+
+        existing_metadata_recs = {record[recordidcolumn]: [] for record, domain_metadata in batch}
+        for row in self._select_in(cur, "SELECT metadata_id, " + recordidcolumn + " FROM domain_metadata WHERE " +
+                                   recordidcolumn + " IN ({})", list(existing_metadata_recs.keys())):
+            existing_metadata_recs[str(row[recordidcolumn])].append(row["metadata_id"])
+
+        # Domain schemas are shared between records; insert the ones we have not seen before
+        schemas = set()
+        for record, domain_metadata in batch:
+            if len(domain_metadata) > 0:
+                for field_uri in domain_metadata:
+                    schemas.add(field_uri.split("#")[0])
+        schema_ids = {}
+        for domain_schema in schemas:
+            schema_ids[domain_schema] = self._vocabulary_cache_get(self._vocabulary_cache_key("domain_schemas", domain_schema, {}))
+        found = self._find_related_rows(cur, "domain_schemas", [k for k, v in schema_ids.items() if v is None])
+        pending = {}
+        for domain_schema in schemas:
+            if schema_ids[domain_schema] is None:
+                schema_row = self._match_related_row("domain_schemas", found, domain_schema, {})
+                if schema_row is None:
+                    schema_row = self._pending_row("domain_schemas", pending, domain_schema, {})
+                schema_ids[domain_schema] = schema_row
+        self._insert_related_rows(cur, "domain_schemas", [row for rows in pending.values() for row in rows])
+        for domain_schema, schema_row in schema_ids.items():
+            if isinstance(schema_row, dict):
+                schema_ids[domain_schema] = int(schema_row["schema_id"])
+                self._vocabulary_cache_put(self._vocabulary_cache_key("domain_schemas", domain_schema, {}), schema_ids[domain_schema])
+
+        found_values = {}
+        for row in self._select_in(cur, "SELECT * FROM domain_metadata WHERE " + recordidcolumn + " IN ({})",
+                                   list(existing_metadata_recs.keys())):
+            row = {k.lower(): row[k] for k in row.keys()}
+            found_values.setdefault(self._value_key(row["schema_id"]), []).append(row)
+        pending_values = {}
+        delete_params = []
+        for record, domain_metadata in batch:
+            record_uuid = record[recordidcolumn]
+            existing_metadata_ids = existing_metadata_recs[record_uuid]
+            if len(domain_metadata) > 0:
+                new_metadata_ids = []
+                for field_uri in domain_metadata:
+                    field_pieces = field_uri.split("#")
+                    domain_schema = field_pieces[0]
+                    field_name = field_pieces[1]
+                    schema_id = schema_ids[domain_schema]
+                    if not isinstance(domain_metadata[field_uri], list):
+                        domain_metadata[field_uri] = [domain_metadata[field_uri]]
+                    for field_value in domain_metadata[field_uri]:
+                        extras = {recordidcolumn: record_uuid, "field_name": field_name, "field_value": field_value}
+                        metadata_row = self._match_related_row("domain_metadata", found_values, schema_id, extras)
+                        if metadata_row is None:
+                            metadata_row = self._pending_row("domain_metadata", pending_values, schema_id, extras)
+                        else:
+                            new_metadata_ids.append(metadata_row["metadata_id"])
+                for eid in existing_metadata_ids:
+                    if eid not in new_metadata_ids:
+                        delete_params.append((eid,))
+                        modified_upstream.add(record_uuid)
+            elif existing_metadata_ids:
+                for eid in existing_metadata_ids:
+                    delete_params.append((eid,))
+                    modified_upstream.add(record_uuid)
+
+        self._insert_related_rows(cur, "domain_metadata", [row for rows in pending_values.values() for row in rows])
+        self._execute_many(cur, "DELETE from domain_metadata where metadata_id=?", delete_params)
+        return modified_upstream
+
+    def get_refresh_counts(self, stale_timestamp, repo_id):
+        """ How many live records the repository has, how many are headers never populated, and how many are stale """
+        cur = self.getDictCursor()
+        cur.execute(self._prep("""SELECT count(*) as live,
+            sum(CASE WHEN modified_timestamp = 0 THEN 1 ELSE 0 END) as new,
+            sum(CASE WHEN modified_timestamp < ? THEN 1 ELSE 0 END) as stale
+            FROM records WHERE repository_id = ? and deleted = 0"""), (stale_timestamp, repo_id))
+        row = cur.fetchone()
+        return {"live": int(row["live"] or 0), "new": int(row["new"] or 0), "stale": int(row["stale"] or 0)}
+
+    def get_stale_records(self, stale_timestamp, repo_id, max_records_updated_per_run, include_fresh=False):
+        """ Records due for a refresh: new headers first, then the oldest stale records, then (if include_fresh)
+        records that are not stale yet, the most recently changed upstream first """
+        recordidcolumn = self.get_table_id_column("records")
+        stale_sql = """SELECT recs.""" + recordidcolumn + """, recs.title, recs.pub_date, recs.series
+            , recs.modified_timestamp, recs.local_identifier, recs.item_url
+            , repos.repository_id, repos.repository_type, recs.geodisy_harvested, recs.files_size, recs.files_altered
+            FROM records recs, repositories repos
+            where recs.repository_id = repos.repository_id """ + ("" if include_fresh else "and recs.modified_timestamp < ?") + """
+            and repos.repository_id = ? and recs.deleted = 0
+            ORDER BY CASE WHEN recs.modified_timestamp = 0 THEN 0 WHEN recs.modified_timestamp < ? THEN 1 ELSE 2 END,
+            CASE WHEN recs.modified_timestamp < ? THEN recs.modified_timestamp ELSE 0 END,
+            recs.upstream_modified_timestamp DESC, recs.modified_timestamp
+            LIMIT ?"""
+        stale_params = (repo_id, stale_timestamp, stale_timestamp, max_records_updated_per_run)
+        if not include_fresh:
+            stale_params = (stale_timestamp,) + stale_params
+        records = self.stream_query(stale_sql, stale_params)
+        if self.dbtype == "sqlite":
+            # The refresh writes on the same connection, possibly from other crawl threads, while it reads these
+            records = list(records)
         return records
 
     def touch_record(self, record):
         recordidcolumn = self.get_table_id_column("records")
         con = self.getConnection()
-        with con:
+        with self._commit_block(con):
             touch_sql = "UPDATE records set modified_timestamp = ? where " + recordidcolumn + " = ?"
             touch_params = (time.time(), record[recordidcolumn])
             cur = self.getDictCursor()
@@ -969,9 +1935,15 @@ class DBInterface:
         return True
 
     def write_header(self, local_identifier, item_url_pattern, repo_id):
+        self.write_headers([local_identifier], item_url_pattern, repo_id)
+        return None
+
+    def write_headers(self, local_identifiers, item_url_pattern, repo_id):
+        """ Add a header for each identifier not already in the repository, and bring back any that were marked as
+        deleted, in one transaction """
         recordidcolumn = self.get_table_id_column("records")
-        record_id = self.get_single_record_id("records", local_identifier, "and repository_id=" + str(repo_id))
-        if record_id is None:
+        rows = []
+        for local_identifier in dict.fromkeys(local_identifiers):
             new_record = {
                 "local_identifier": local_identifier,
                 "item_url_pattern": item_url_pattern
@@ -983,23 +1955,53 @@ class DBInterface:
                 self.logger.error("write_header failed for item {} in repo {}".format(
                     local_identifier,str(repo_id)))
             else:
-                con = self.getConnection()
-                with con:
-                    cur = self.getDictCursor()
-                    try:
-                        header_sql = """INSERT INTO records (""" + recordidcolumn + """,title, title_fr, pub_date, series, modified_timestamp, local_identifier,
-                            item_url, repository_id, upstream_modified_timestamp, files_size, files_altered) VALUES(?,?,?,?,?,?,?,?,?,?,?,?)"""
-                        header_params = (new_uuid, "", "", "", "", 0, local_identifier, "", repo_id, time.time(), 0, 1)
-                        cur.execute(self._prep(header_sql), header_params)
-                    except self.dblayer.IntegrityError as e:
-                        self.logger.error("Error creating record header: {}".format(e))
+                rows.append((new_uuid, "", "", "", "", 0, local_identifier, "", repo_id, time.time(), 0, 1))
+
+        if rows:
+            # Headers that already exist are left alone by the records_by_repository index
+            columns = [recordidcolumn, "title", "title_fr", "pub_date", "series", "modified_timestamp", "local_identifier",
+                       "item_url", "repository_id", "upstream_modified_timestamp", "files_size", "files_altered"]
+            with self.transaction():
+                cur = self.getDictCursor()
+                self._insert_many(cur, "records", columns, rows, ignore_conflicts=True)
+                # A listed record that was deleted is live again; it is stale, and its content hash no longer
+                # matches the details it has left, so it is fetched and written in full by the next refresh
+                listed = [row[6] for row in rows]
+                for i in range(0, len(listed), self.batch_chunk_size):
+                    chunk = listed[i:i + self.batch_chunk_size]
+                    cur.execute(self._prep("UPDATE records set deleted = 0, modified_timestamp = 0, content_hash = NULL "
+                                           "where repository_id = ? and deleted = 1 and local_identifier IN (" +
+                                           ",".join("?" for l in chunk) + ")"), [repo_id] + chunk)
+        return None
 
+    def record_content_hash(self, record, domain_metadata):
+        """ Hash of everything write_record() stores for a record, to tell whether it has changed since it was written """
+        recordidcolumn = self.get_table_id_column("records")
+        content = {}
+        for key in record:
+            if key not in [recordidcolumn, "item_url_pattern"]:
+                content[key] = record[key]
+        content["domain_metadata"] = {}
+        for field_uri in domain_metadata or []:
+            values = domain_metadata[field_uri]
+            content["domain_metadata"][field_uri] = values if isinstance(values, list) else [values]
+        sha1 = hashlib.sha1()
+        sha1.update(json.dumps(content, sort_keys=True, default=str).encode('utf-8'))
+        return sha1.hexdigest()
+
+    def update_record_content_hash(self, record, content_hash):
+        recordidcolumn = self.get_table_id_column("records")
+        con = self.getConnection()
+        with self._commit_block(con):
+            cur = self.getDictCursor()
+            cur.execute(self._prep("UPDATE records set content_hash = ? where " + recordidcolumn + " = ?"),
+                        (content_hash, record[recordidcolumn]))
         return None
 
     def update_record_upstream_modified(self, record):
         recordidcolumn = self.get_table_id_column("records")
         con = self.getConnection()
-        with con:
+        with self._commit_block(con):
             update_sql = "UPDATE records set upstream_modified_timestamp = ?, geodisy_harvested = 0 where " + recordidcolumn + " = ?"
             update_params = (time.time(), record[recordidcolumn])
             cur = self.getDictCursor()
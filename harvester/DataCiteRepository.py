@@ -1,6 +1,4 @@
 from harvester.HarvestRepository import HarvestRepository
-import requests
-import time
 import json
 
 
@@ -13,6 +11,37 @@ class DataCiteRepository(HarvestRepository):
         super(DataCiteRepository, self).setRepoParams(repoParams)
         self.domain_metadata = []
         self.headers = {'accept': 'application/vnd.api+json'}
+        self.page_size = 1000
+
+    def get_page_request(self, page, state):
+        querystring = {"client-id": self.set, "page[size]": str(self.page_size)}
+        if page is None:
+            state["page_number"] = 1
+            querystring["page[number]"] = "1"
+            return {"url": self.url, "params": querystring, "headers": self.headers}
+        if state["cursor"]:
+            if "page_number" in state:
+                # Start over from the first cursor page
+                del state["page_number"]
+                querystring["page[cursor]"] = "1"
+                return {"url": self.url, "params": querystring, "headers": self.headers}
+            next = page.get("links", {}).get("next")
+            if next:
+                return {"url": next, "headers": self.headers}
+            return None
+        state["page_number"] += 1
+        if state["page_number"] > page['meta']['totalPages']:
+            return None
+        querystring["page[number]"] = str(state["page_number"])
+        return {"url": self.url, "params": querystring, "headers": self.headers}
+
+    def get_page_identifiers(self, page, state):
+        if "cursor" not in state:
+            # Use page numbers for less than 10K DOIs, otherwise page through them with a cursor instead
+            state["cursor"] = (page['meta']['totalPages'] * self.page_size) >= 10000
+            if state["cursor"]:
+                return []
+        return [record["id"] for record in page["data"]]
 
     def _crawl(self):
         kwargs = {
@@ -30,46 +59,8 @@ class DataCiteRepository(HarvestRepository):
         self.repository_id = self.db.update_repo(**kwargs)
 
         try:
-            page_number = 1
-            page_size = 1000
-            totalPages = 1
-            item_count = 0
-            while page_number <= totalPages:
-                querystring = {"client-id": self.set, "page[number]": str(page_number), "page[size]": str(page_size)}
-                response = requests.request("GET", self.url, headers=self.headers, params=querystring)
-                response = response.json()
-                totalPages = response['meta']['totalPages']
-                if (totalPages * page_size) < 10000: # use page numbers for less than 10K DOIs
-                    page_number += 1
-                    for record in response["data"]:
-                        item_identifier = record["id"]
-                        self.db.write_header(item_identifier, self.item_url_pattern, self.repository_id)
-                        item_count = item_count + 1
-                        if (item_count % self.update_log_after_numitems == 0):
-                            tdelta = time.time() - self.tstart + 0.1
-                            self.logger.info("Done {} item headers after {} ({:.1f} items/sec)".format(item_count,self.formatter.humanize(tdelta),item_count / tdelta))
-                else: # use cursor
-                    querystring = {"client-id": self.set, "page[cursor]": str(page_number), "page[size]": str(page_size)}
-                    response = requests.request("GET", self.url, headers=self.headers, params=querystring)
-                    response = response.json()
-                    next = response["links"]["next"]
-                    while next:
-                        page_number = page_number + 1
-                        for record in response["data"]:
-                            item_identifier = record["id"]
-                            self.db.write_header(item_identifier, self.item_url_pattern, self.repository_id)
-                            item_count = item_count + 1
-                            if (item_count % self.update_log_after_numitems == 0):
-                                tdelta = time.time() - self.tstart + 0.1
-                                self.logger.info("Done {} item headers after {} ({:.1f} items/sec)".format(item_count, self.formatter.humanize(tdelta), item_count / tdelta))
-                        response = requests.request("GET", next, headers=self.headers)
-                        response = response.json()
-                        try:
-                            next = response["links"]["next"]
-                        except Exception as e:
-                            next = None
-                    break # exit while page_number < totalPages loop
-
+            item_count = self._crawl_pages()
+            self.delete_unlisted_records()
             self.logger.info("Found {} items in feed".format(item_count))
             return True
 
@@ -219,19 +210,23 @@ class DataCiteRepository(HarvestRepository):
 
         return record
 
-    def _update_record(self, record):
+    def get_record_request(self, record):
+        return {"url": self.url + "/" + record["local_identifier"]}
+
+    def process_record_response(self, record, response):
         try:
             record_url = self.url + "/" + record["local_identifier"]
             try:
-                item_response = requests.get(record_url)
-                datacite_record = json.loads(item_response.text)["data"]
+                if isinstance(response, Exception):
+                    raise response
+                datacite_record = json.loads(response.text)["data"]
             except Exception as e:
                 # Exception means this URL was not found
                 self.logger.error("Fetching record {} failed: {} {}".format(record_url, type(e).__name__, e))
                 return True
             oai_record = self.format_datacite_to_oai(datacite_record)
             if oai_record:
-                self.db.write_record(oai_record, self)
+                self.write_record(oai_record)
             else:
                 if oai_record is False:
                     # This record is not a dataset, remove it from the results
@@ -1,10 +1,6 @@
 from harvester.HarvestRepository import HarvestRepository
-from harvester.rate_limited import rate_limited
-import urllib
-from dateutil import parser
-import time
+from harvester.DateNormalizer import DateNormalizer
 import json
-import requests
 
 
 class DataStreamRepository(HarvestRepository):
@@ -12,9 +8,24 @@ class DataStreamRepository(HarvestRepository):
 
     def setRepoParams(self, repoParams):
         self.metadataprefix = "datastream"
+        self.rate_limit_per_second = 5
         super(DataStreamRepository, self).setRepoParams(repoParams)
         self.domain_metadata = []
         self.headers = {'accept': 'application/vnd.api+json'}
+        self.page_size = 1000
+
+    def get_page_request(self, page, state):
+        if page is None:
+            state["page_number"] = 1
+        else:
+            state["page_number"] += 1
+            if state["page_number"] > page['meta']['totalPages']:
+                return None
+        querystring = {"client-id": self.set, "page[number]": str(state["page_number"]), "page[size]": str(self.page_size)}
+        return {"url": self.url, "params": querystring, "headers": self.headers}
+
+    def get_page_identifiers(self, page, state):
+        return [record["attributes"]["url"] for record in page["data"]]
 
     def _crawl(self):
         kwargs = {
@@ -39,24 +50,7 @@ class DataStreamRepository(HarvestRepository):
         self.repository_id = self.db.update_repo(**kwargs)
 
         try:
-            page_number = 1
-            page_size = 1000
-            totalPages = 1
-            item_count = 0
-            while page_number <= totalPages:
-                querystring = {"client-id": self.set, "page[number]": str(page_number), "page[size]": str(page_size)}
-                response = requests.request("GET", self.url, headers=self.headers, params=querystring)
-                response = response.json()
-                totalPages = response['meta']['totalPages']
-                page_number += 1
-                for record in response["data"]:
-                    item_identifier = record["attributes"]["url"]
-                    self.db.write_header(item_identifier, self.item_url_pattern, self.repository_id)
-                    item_count = item_count + 1
-                    if (item_count % self.update_log_after_numitems == 0):
-                        tdelta = time.time() - self.tstart + 0.1
-                        self.logger.info("Done {} item headers after {} ({:.1f} items/sec)".format(
-                            item_count, self.formatter.humanize(tdelta), item_count / tdelta))
+            item_count = self._crawl_pages()
             self.logger.info("Found {} items in feed".format(item_count))
 
             return True
@@ -95,7 +89,7 @@ class DataStreamRepository(HarvestRepository):
                 record["publisher"] = datastream_record["publisher"]["name"]
 
         if ("datePublished" in datastream_record) and datastream_record["datePublished"]:
-            record["pub_date"] = parser.parse(datastream_record["datePublished"]).strftime('%Y-%m-%d')
+            record["pub_date"] = DateNormalizer.parse(datastream_record["datePublished"])
 
         if ("identifier" in datastream_record) and datastream_record["identifier"]:
             if ("url" in datastream_record["identifier"]) and datastream_record["identifier"]["url"]:
@@ -124,23 +118,25 @@ class DataStreamRepository(HarvestRepository):
 
         return record
 
-    @rate_limited(5)
-    def _update_record(self, record):
+    def get_record_request(self, record):
+        return {"url": record['local_identifier'] + ".dcat.json"}
+
+    def process_record_response(self, record, response):
         try:
-            identifier = record['local_identifier']
-            item_dcat_json_url = identifier + ".dcat.json"
             try:
-                item_response = urllib.request.urlopen(item_dcat_json_url)
+                if isinstance(response, Exception):
+                    raise response
+                response.raise_for_status()
             except Exception as e:
                 # Exception means this URL was not found
                 self.db.delete_record(record)
                 return True
-            item_response_content = item_response.read().decode('utf-8')
+            item_response_content = response.content.decode('utf-8')
             item_json = json.loads(item_response_content)
 
             oai_record = self.format_datastream_to_oai(item_json)
             if oai_record:
-                self.db.write_record(oai_record, self)
+                self.write_record(oai_record)
             return True
         except Exception as e:
             self.logger.error("Updating record {} failed: {} {}".format(record['local_identifier'], type(e).__name__, e))
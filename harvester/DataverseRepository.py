@@ -1,6 +1,4 @@
 from harvester.HarvestRepository import HarvestRepository
-import requests
-import time
 
 
 class DataverseRepository(HarvestRepository):
@@ -12,6 +10,8 @@ class DataverseRepository(HarvestRepository):
         self.domain_metadata = []
         self.params = {
         }
+        # Sub-dataverse names, looked up once per crawl rather than once per dataset in them
+        self.dataverse_names = {}
 
     def _crawl(self):
         kwargs = {
@@ -46,6 +46,7 @@ class DataverseRepository(HarvestRepository):
                 # If a single set is specified, use the specified set as the dataverse_id
                 dataverse_id = self.set
             item_count = self.get_datasets_from_dataverse_id(dataverse_id, str(dataverse_id), 0, self.dataverses_list)
+            self.delete_unlisted_records()
             self.logger.info("Found {} items in feed".format(item_count))
             return True
         except Exception as e:
@@ -57,38 +58,46 @@ class DataverseRepository(HarvestRepository):
         return False
 
     def get_datasets_from_dataverse_id(self, dataverse_id, dataverse_hierarchy, item_count, dataverses_list=None):
-        response = requests.get(self.url.replace("%id%", str(dataverse_id)), verify=False)
+        response = self.http_get(self.url.replace("%id%", str(dataverse_id)), verify=False)
+        # A dataverse that cannot be listed must not look empty, or its datasets would be marked as deleted
+        response.raise_for_status()
         records = response.json()
-        if "data" in records:
-            for record in records["data"]:
-                if record["type"] == "dataset":
-                    item_identifier = record["id"]
-                    combined_identifier = str(item_identifier)
-                    dataverse_hierarchy_split = [x.strip() for x in dataverse_hierarchy.split("_")]
-                    if len(dataverse_hierarchy_split) > 1:
-                        # Write dataverse_hierarchy - minus the repository id - plus identifier as local_identifier
-                        dataverse_hierarchy_string = "_".join(dataverse_hierarchy_split[1:])
-                        combined_identifier = combined_identifier + "_" + dataverse_hierarchy_string
-                    self.db.write_header(combined_identifier, self.item_url_pattern, self.repository_id)
-                    item_count = item_count + 1
-                    if (item_count % self.update_log_after_numitems == 0):
-                        tdelta = time.time() - self.tstart + 0.1
-                        self.logger.info("Done {} item headers after {} ({:.1f} items/sec)".format(
-                            item_count,self.formatter.humanize(tdelta),item_count / tdelta))
-                elif record["type"] == "dataverse":
-                    if dataverses_list and record["id"] not in dataverses_list:
-                        # If a dataverses_list is specified, ignore any dataverses not in it
-                        pass
-                    else:
-                        # Recursive call to get children of this dataverse
-                        # Append the dataverse id to the overall dataverse_hierarchy
+        if records.get("status") != "OK" or "data" not in records:
+            raise ValueError("Listing dataverse {} failed: {}".format(dataverse_id, records.get("message", records.get("status"))))
+        combined_identifiers = []
+        for record in records["data"]:
+            if record["type"] == "dataset":
+                item_identifier = record["id"]
+                combined_identifier = str(item_identifier)
+                dataverse_hierarchy_split = [x.strip() for x in dataverse_hierarchy.split("_")]
+                if len(dataverse_hierarchy_split) > 1:
+                    # Write dataverse_hierarchy - minus the repository id - plus identifier as local_identifier
+                    dataverse_hierarchy_string = "_".join(dataverse_hierarchy_split[1:])
+                    combined_identifier = combined_identifier + "_" + dataverse_hierarchy_string
+                combined_identifiers.append(combined_identifier)
+            elif record["type"] == "dataverse":
+                if dataverses_list and record["id"] not in dataverses_list:
+                    # If a dataverses_list is specified, ignore any dataverses not in it
+                    pass
+                else:
+                    # Recursive call to get children of this dataverse
+                    # Append the dataverse id to the overall dataverse_hierarchy
+                    try:
                         item_count = self.get_datasets_from_dataverse_id(record["id"], dataverse_hierarchy + "_" + str(record["id"]), item_count)
+                    except Exception as e:
+                        # Carry on with the other dataverses, but do not look for deleted items in this listing
+                        self.logger.error("Listing dataverse {} failed, skipping it: {} {}".format(record["id"], type(e).__name__, e))
+                        self.listing_incomplete = True
+        item_count = self._write_page_headers(combined_identifiers, item_count)
         return item_count
 
     def get_dataverse_name_from_dataverse_id(self, dataverse_id):
+        if dataverse_id in self.dataverse_names:
+            return self.dataverse_names[dataverse_id]
         try:
-            response = requests.get(self.url.replace("%id%/contents", str(dataverse_id)), verify=False)
+            response = self.http_get(self.url.replace("%id%/contents", str(dataverse_id)), verify=False)
             record = response.json()
+            self.dataverse_names[dataverse_id] = record["data"]["name"]
             return record["data"]["name"]
         except Exception as e:
             self.logger.error("Fetching dataverse_name for dataverse_id {} failed: {} {}".format(str(dataverse_id), type(e).__name__, e))
@@ -275,16 +284,21 @@ class DataverseRepository(HarvestRepository):
 
         return record
 
-    def _update_record(self, record):
+    def get_record_request(self, record):
+        item_identifier = record['local_identifier'].split("_")[0]
+        return {"url": self.url.replace("dataverses/%id%/contents", "datasets/") + item_identifier}
+
+    def process_record_response(self, record, response):
         try:
             identifier_split = record['local_identifier'].split("_")
             item_identifier = identifier_split[0]
             dataverse_record = None
             oai_record = None
             record_url = self.url.replace("dataverses/%id%/contents", "datasets/") + item_identifier
-            #self.logger.info("Record URL: {}".format(record_url))
             try:
-                item_response = requests.get(record_url).json()
+                if isinstance(response, Exception):
+                    raise response
+                item_response = response.json()
                 if "status" in item_response and item_response["status"].lower() == "error":
                     self.db.delete_record(record)
                 if "data" in item_response:
@@ -299,9 +313,10 @@ class DataverseRepository(HarvestRepository):
             if dataverse_record:
                 oai_record = self.format_dataverse_to_oai(dataverse_record)
             if oai_record:
-                self.db.write_record(oai_record, self)
+                self.write_record(oai_record)
                 if "deleted" in oai_record:
-                    # This record has been deaccessioned, remove it from the results
+                    # This record has been deaccessioned, remove it from the results once it is written
+                    self.flush_records()
                     self.db.delete_record(record)
             else:
                 # Some other problem, this record will be updated by a future crawl
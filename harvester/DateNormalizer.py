@@ -0,0 +1,83 @@
+import calendar
+import datetime
+import re
+from functools import lru_cache
+
+
+class DateNormalizer(object):
+    """ Turns the date strings repositories give into YYYY-MM-DD, shared by every repository in the process.
+    The usual shapes (ISO 8601 dates and timestamps, YYYY, YYYY-MM, YYYYMMDD) are read with a regular expression;
+    anything else goes to dateparser or dateutil, as the repository did before, and every result is cached """
+
+    DATEPARSER = "dateparser"
+    DATEUTIL = "dateutil"
+
+    # YYYY, YYYY-MM or YYYY-MM-DD (or with slashes), and a time and time zone after a full date
+    iso_pattern = re.compile(r"^(\d{4})(?:([-/])(\d{1,2})(?:\2(\d{1,2})"
+                             r"(?:[T ](\d{1,2}):(\d{2})(?::(\d{2})(?:[.,]\d+)?)?(?:Z|[+-]\d{2}:?\d{2})?)?)?)?$")
+    compact_pattern = re.compile(r"^(\d{4})(\d{2})(\d{2})$")
+
+    @classmethod
+    def normalize(cls, datestring, fallback=DATEPARSER):
+        """ The date as YYYY-MM-DD, or None if it cannot be parsed """
+        if datestring is None:
+            return None
+        return cls._normalize_cached(str(datestring).strip(), fallback)
+
+    @classmethod
+    def parse(cls, datestring, fallback=DATEUTIL):
+        """ Like normalize(), but raises ValueError for a date that cannot be parsed, as dateutil does """
+        date = cls.normalize(datestring, fallback)
+        if date is None:
+            raise ValueError("Unknown date format: {}".format(datestring))
+        return date
+
+    @staticmethod
+    def cache_info():
+        return DateNormalizer._normalize_cached.cache_info()
+
+    @staticmethod
+    @lru_cache(maxsize=100000)
+    def _normalize_cached(datestring, fallback):
+        date = DateNormalizer._fast_path(datestring)
+        if date is not None:
+            return date
+        try:
+            if fallback == DateNormalizer.DATEUTIL:
+                from dateutil import parser
+                return parser.parse(datestring).strftime("%Y-%m-%d")
+            # dateparser is slow to import, and only needed for unusual dates
+            import dateparser
+            date_object = dateparser.parse(datestring)
+            if date_object is None:
+                date_object = dateparser.parse(datestring, date_formats=["%Y%m%d"])
+            return date_object.strftime("%Y-%m-%d")
+        except Exception:
+            return None
+
+    @staticmethod
+    def _fast_path(datestring):
+        """ The date for the shapes both parsers read the same way, or None to leave it to them """
+        match = DateNormalizer.compact_pattern.match(datestring)
+        if match:
+            year, month, day = int(match.group(1)), int(match.group(2)), int(match.group(3))
+        else:
+            match = DateNormalizer.iso_pattern.match(datestring)
+            if not match:
+                return None
+            year = int(match.group(1))
+            month = int(match.group(3)) if match.group(3) else None
+            day = int(match.group(4)) if match.group(4) else None
+            hour, minute, second = match.group(5), match.group(6), match.group(7)
+            if hour is not None and (int(hour) > 23 or int(minute) > 59 or int(second or 0) > 59):
+                return None
+            # Like the parsers, fill in a missing month or day from today
+            today = datetime.date.today()
+            if month is None:
+                month = today.month
+            if day is None and 1 <= month <= 12 and year >= 1:
+                day = min(today.day, calendar.monthrange(year, month)[1])
+        try:
+            return datetime.date(year, month, day).strftime("%Y-%m-%d")
+        except (TypeError, ValueError):
+            return None
@@ -1,6 +1,4 @@
 from harvester.HarvestRepository import HarvestRepository
-from harvester.rate_limited import rate_limited
-import requests
 import time
 import json
 from datetime import datetime
@@ -12,6 +10,7 @@ class DryadRepository(HarvestRepository):
 
     def setRepoParams(self, repoParams):
         self.metadataprefix = "dryad"
+        self.rate_limit_per_second = 5
         self.default_language = "en"
         super(DryadRepository, self).setRepoParams(repoParams)
         self.domain_metadata = []
@@ -21,6 +20,27 @@ class DryadRepository(HarvestRepository):
         }
         self.ror_data = None
 
+    def get_page_request(self, page, state):
+        if page is None:
+            # Check for records updated since a week before the last crawl
+            mod_since = self.last_crawl - 60*60*24*7 if self.last_crawl - 60*60*24*7 >= 0 else 0
+            state["querystring"] = {"per_page": str(100), "modifiedSince": datetime.strftime(datetime.fromtimestamp(mod_since), '%Y-%m-%dT%H:%M:%SZ')}
+            state["item_count"] = 0
+            url = self.url + "/search/"
+        elif state["item_count"] < page['total'] and 'next' in page['_links']:
+            url = self.url.replace("/api/v2", "") + page['_links']['next']['href']
+        else:
+            return None
+        return {"url": url, "params": state["querystring"], "headers": self.headers}
+
+    def get_page_identifiers(self, page, state):
+        item_identifiers = []
+        for record in page['_embedded']['stash:datasets']:
+            if '_links' in record and record['_links']:
+                item_identifiers.append(record["identifier"])
+        state["item_count"] += len(item_identifiers)
+        return item_identifiers
+
     def _crawl(self):
         if not self.load_ror_data():
             self.logger.error("ROR data could not be fetched from remote")
@@ -52,36 +72,7 @@ class DryadRepository(HarvestRepository):
         self.repository_id = self.db.update_repo(**kwargs)
 
         try:
-            # Initial API call
-            url = self.url + "/search/"
-            # Check for records updated in the past 30 days
-            mod_since = self.last_crawl - 60*60*24*7 if self.last_crawl - 60*60*24*7 >= 0 else 0
-            querystring = {"per_page": str(100), "modifiedSince": datetime.strftime(datetime.fromtimestamp(mod_since), '%Y-%m-%dT%H:%M:%SZ')}
-            r = requests.request("GET", url, headers=self.headers, params=querystring)
-            response = r.json()
-            records = response['_embedded']['stash:datasets']
-
-            item_count = 0
-            total_dryad_item_count = response['total'] # hardcode 1000 for testing
-
-            while item_count < total_dryad_item_count:
-                for record in records:
-                    if '_links' in record and record['_links']:
-                        item_identifier = record["identifier"]
-                        self.db.write_header(item_identifier, self.item_url_pattern, self.repository_id)
-                        item_count = item_count + 1
-                        if (item_count % self.update_log_after_numitems == 0):
-                            tdelta = time.time() - self.tstart + 0.1
-                            self.logger.info("Done {} item headers after {} ({:.1f} items/sec)".format(
-                                item_count, self.formatter.humanize(tdelta), item_count / tdelta))
-                if 'next' in response['_links']:
-                    url = self.url.replace("/api/v2", "") + response['_links']['next']['href']
-                    r = requests.request("GET", url, headers=self.headers, params=querystring)
-                    response = r.json()
-                    records = response['_embedded']['stash:datasets']
-                else:
-                    break
-
+            item_count = self._crawl_pages()
             self.logger.info("Found {} items in feed".format(item_count))
             return True
 
@@ -159,14 +150,17 @@ class DryadRepository(HarvestRepository):
 
         return record
 
-    @rate_limited(5)
-    def _update_record(self, record):
+    def get_record_request(self, record):
+        return {"url": self.url + "/datasets/" + urllib.parse.quote_plus(record["local_identifier"])}
+
+    def process_record_response(self, record, response):
         try:
             record_url = self.url + "/datasets/" + urllib.parse.quote_plus(record["local_identifier"])
             try:
-                item_response = requests.get(record_url)
-                if (item_response.status_code == 200): # Dryad sends code 429 for rate limiting
-                    dryad_record = json.loads(item_response.text)
+                if isinstance(response, Exception):
+                    raise response
+                if (response.status_code == 200): # Dryad sends code 429 for rate limiting
+                    dryad_record = json.loads(response.text)
                 else:
                     dryad_record = {}
             except Exception as e:
@@ -175,7 +169,7 @@ class DryadRepository(HarvestRepository):
                 return True
             oai_record = self.format_dryad_to_oai(dryad_record)
             if oai_record:
-                self.db.write_record(oai_record, self)
+                self.write_record(oai_record)
             else:
                 if oai_record is False:
                     # This dataset is not Canadian, remove it from the results
@@ -11,6 +11,7 @@ class Exporter(object):
         self.destination = finalconfig.get('destination', "file")
         self.export_limit = finalconfig.get('export_file_limit_mb', 10)
         self.records_per_loop = 50
+        self.exported_count = 0
         if self.db.dbtype == "postgres":
             import psycopg2
             global DictRow
@@ -72,6 +73,69 @@ class Exporter(object):
             #print(output)
             return output
 
+    def _gmeta_header_footer(self):
+        """ The text around the entries of a gmeta file, exactly as json.dumps() writes it for the whole batch """
+        output = json.dumps({"@datatype": "GIngest", "@version": "2016-11-09",
+                             "ingest_type": "GMetaList",
+                             "ingest_data": {"@datatype": "GMetaList", "@version": "2016-11-09",
+                                             "gmeta": []}})
+        split_at = output.index("[]") + 1
+        return output[:split_at].encode("utf-8"), output[split_at:].encode("utf-8")
+
+    def _open_batch_file(self):
+        """ Start writing the next gmeta file in the temp directory """
+        try:
+            os.mkdir(self.temp_filepath)
+        except Exception as e:
+            pass
+        self.batch_basename = "gmeta_" + str(self.batch_number) + ".json"
+        self.batch_file = open(os.path.join(self.temp_filepath, self.batch_basename), "wb")
+        header, self.batch_footer = self._gmeta_header_footer()
+        self.batch_file.write(header)
+        self.batch_entries = 0
+        self.buffer_size = len(header) + len(self.batch_footer)
+
+    def _write_batch_entry(self, entry, limit):
+        """ Serialize one GMetaEntry into the current file, starting a new file first if it would go over limit bytes """
+        data = json.dumps(entry).encode("utf-8")
+        if self.batch_file is not None and self.batch_entries and self.buffer_size + len(b", ") + len(data) > limit:
+            self._close_batch_file()
+        if self.batch_file is None:
+            self._open_batch_file()
+        if self.batch_entries:
+            self.batch_file.write(b", ")
+            self.buffer_size += len(b", ")
+        self.batch_file.write(data)
+        self.buffer_size += len(data)
+        self.batch_entries += 1
+
+    def _close_batch_file(self):
+        """ Finish the current gmeta file and move it into the export directory """
+        if self.batch_file is None:
+            return
+        self.logger.debug("Writing batch {} to output file".format(self.batch_number))
+        temp_filename = self.batch_file.name
+        try:
+            self.batch_file.write(self.batch_footer)
+            self.batch_file.close()
+        except Exception as e:
+            self.logger.error("Unable to write output data to temporary file: {}".format(temp_filename))
+        self.batch_file = None
+        self.batch_number += 1
+        self.buffer_size = 0
+
+        try:
+            os.remove(os.path.join(self.export_filepath, self.batch_basename))
+        except Exception as e:
+            pass
+
+        try:
+            os.rename(temp_filename, os.path.join(self.export_filepath, self.batch_basename))
+        except Exception as e:
+            self.logger.error("Unable to move temp file: {} to output file: {}".format(temp_filename,
+                                                                                       os.path.join(self.export_filepath,
+                                                                                                    self.batch_basename)))
+
     def _write_to_file(self, output, export_filepath, temp_filepath):
         try:
             os.mkdir(temp_filepath)
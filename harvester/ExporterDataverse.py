@@ -20,18 +20,13 @@ class ExporterDataverse(Exporter.Exporter):
         self.logger.info("Maximum {} records per batch".format(self.records_per_loop))
         recordidcolumn = self.db.get_table_id_column("records")
 
-        records_con = self.db.getConnection()
-        with records_con:
-            records_cursor = records_con.cursor()
         records_sql = """SELECT recs.""" + recordidcolumn + """, recs.item_url, recs.pub_date, recs.title, recs.title_fr, recs.item_url, recs.series, 
             recs.repository_id, recs.files_altered, reps.repository_url, reps.repository_name, reps.repository_name_fr, reps.repository_type
             FROM records recs
             JOIN repositories reps on reps.repository_id = recs.repository_id
             WHERE recs.geodisy_harvested = 0 AND recs.deleted = 0 AND (recs.title <>''OR recs.title_fr <> '') LIMIT ?"""
-        records_cursor.execute(self.db._prep(records_sql), (self.records_per_loop,))
-
         records = []
-        for row in records_cursor:
+        for row in self.db.stream_query(records_sql, (self.records_per_loop,), dict_rows=False):
             record = (dict(zip([recordidcolumn,'item_url','pub_date','title', 'title_fr','item_url','series','repository_id', 'files_altered', 
                 'repository_url', 'repository_name', 'repository_name_fr', 'repository_type'], row)))
             records.append(record)
@@ -52,14 +47,13 @@ class ExporterDataverse(Exporter.Exporter):
                     FROM records recs
                     JOIN repositories reps on reps.repository_id = recs.repository_id
                     WHERE geodisy_harvested = 0 AND deleted = 1 LIMIT ?"""
-        records_cursor.execute(self.db._prep(deleted_sql), (self.records_per_loop,))
-
         deleted = []
-        for row in records_cursor:
+        for row in self.db.stream_query(deleted_sql, (self.records_per_loop,), dict_rows=False):
             deleted_record = (
                 dict(zip([recordidcolumn, 'item_url', 'item_url', 'repository_id', 'repository_url'], row)))
             deleted.append(deleted_record)
         self.get_batch_deleted_records(0, len(records), deleted)
+        self.exported_count = len(records)
 
         # self.get_batch_record_metadata(0, len(records), records)
         return self.get_batch_record_metadata(0, total_records, records)
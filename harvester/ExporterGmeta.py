@@ -1,7 +1,11 @@
 import re
-import json
+import os
+import math
+import shutil
+import itertools
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import harvester.Exporter as Exporter
-from psycopg2.extras import DictCursor
 
 
 class ExporterGmeta(Exporter.Exporter):
@@ -10,26 +14,97 @@ class ExporterGmeta(Exporter.Exporter):
     def __init__(self, db, log, finalconfig):
         self.export_format = "gmeta"
         super().__init__(db, log, finalconfig)
-
-    def _generate(self, only_new_records):
-        self.logger.info("Exporter: generate called for gmeta")
-        self.output_buffer = []
-        deleted = []
+        self.records_per_chunk = 1000
+        # With more than one worker, the records are split into uuid ranges, each exported by its own process
+        self.export_workers = int(finalconfig.get('export_workers', 1))
+        self.shard_start = None
+        self.shard_end = None
+
+    def _values_to_list(self, values):
+        """ Same list _rows_to_list() makes from a single column cursor: sqlite rows with empty values are dropped """
+        if self.db.getType() == "sqlite":
+            return [value for value in values if value]
+        return list(values)
+
+    def _get_related_metadata(self, record_uuids):
+        """ Fetch the related metadata for a chunk of records, grouped by record and then by output field """
         recordidcolumn = self.db.get_table_id_column("records")
+        related = {}
+        if not record_uuids:
+            return related
+
+        # (output field, query, value column or None for whole rows); rows are sorted the way the record indexes return them
+        queries = [
+            ("geobbox", """SELECT """ + recordidcolumn + """, westLon, eastLon, northLat, southLat FROM geobbox
+                WHERE """ + recordidcolumn + """ IN ({}) ORDER BY geobbox_id""", None),
+            ("geopoint", "SELECT " + recordidcolumn + ", lat, lon FROM geopoint WHERE " + recordidcolumn + " IN ({}) ORDER BY geopoint_id", None),
+            ("geoplace", """SELECT """ + recordidcolumn + """, country, province_state, city, other, place_name FROM geoplace
+                WHERE """ + recordidcolumn + """ IN ({}) ORDER BY geoplace_id""", None),
+            ("crdc", """SELECT records_x_crdc.""" + recordidcolumn + """, crdc.crdc_code, crdc.crdc_group_en, crdc.crdc_group_fr,
+                crdc.crdc_class_en, crdc.crdc_class_fr, crdc.crdc_field_en, crdc.crdc_field_fr
+                FROM crdc JOIN records_x_crdc on records_x_crdc.crdc_id = crdc.crdc_id
+                WHERE records_x_crdc.""" + recordidcolumn + """ IN ({}) ORDER BY records_x_crdc.crdc_id""", None),
+            ("dc_contributor_author", """SELECT records_x_creators.""" + recordidcolumn + """, creators.creator AS value
+                FROM creators JOIN records_x_creators on records_x_creators.creator_id = creators.creator_id
+                WHERE records_x_creators.""" + recordidcolumn + """ IN ({}) AND records_x_creators.is_contributor=0
+                ORDER BY records_x_creators_id asc""", "value"),
+            ("datacite_creatorAffiliation", """SELECT records_x_affiliations.""" + recordidcolumn + """, affiliations.affiliation AS value
+                FROM affiliations JOIN records_x_affiliations on records_x_affiliations.affiliation_id = affiliations.affiliation_id
+                WHERE records_x_affiliations.""" + recordidcolumn + """ IN ({}) ORDER BY records_x_affiliations.affiliation_id""", "value"),
+            ("dc_contributor", """SELECT records_x_creators.""" + recordidcolumn + """, creators.creator AS value
+                FROM creators JOIN records_x_creators on records_x_creators.creator_id = creators.creator_id
+                WHERE records_x_creators.""" + recordidcolumn + """ IN ({}) AND records_x_creators.is_contributor=1
+                ORDER BY records_x_creators_id asc""", "value"),
+            ("frdr_subject_", """SELECT records_x_subjects.""" + recordidcolumn + """, subjects.subject AS value, subjects.language
+                FROM subjects JOIN records_x_subjects on records_x_subjects.subject_id = subjects.subject_id
+                WHERE records_x_subjects.""" + recordidcolumn + """ IN ({}) and subjects.language in ('en', 'fr')
+                ORDER BY records_x_subjects.subject_id""", "value"),
+            ("dc_publisher", """SELECT records_x_publishers.""" + recordidcolumn + """, publishers.publisher AS value
+                FROM publishers JOIN records_x_publishers on records_x_publishers.publisher_id = publishers.publisher_id
+                WHERE records_x_publishers.""" + recordidcolumn + """ IN ({}) ORDER BY records_x_publishers.publisher_id""", "value"),
+            ("dc_rights", """SELECT records_x_rights.""" + recordidcolumn + """, rights.rights AS value
+                FROM rights JOIN records_x_rights on records_x_rights.rights_id = rights.rights_id
+                WHERE records_x_rights.""" + recordidcolumn + """ IN ({}) ORDER BY records_x_rights.rights_id""", "value"),
+            ("dc_description_", """SELECT """ + recordidcolumn + """, description AS value, language FROM descriptions
+                WHERE """ + recordidcolumn + """ IN ({}) and language in ('en', 'fr') ORDER BY description_id""", "value"),
+            ("frdr_keyword_", """SELECT records_x_tags.""" + recordidcolumn + """, tags.tag AS value, tags.language
+                FROM tags JOIN records_x_tags on records_x_tags.tag_id = tags.tag_id
+                WHERE records_x_tags.""" + recordidcolumn + """ IN ({}) and tags.language in ('en', 'fr')
+                ORDER BY records_x_tags.tag_id""", "value"),
+            ("frdr_access", """SELECT records_x_access.""" + recordidcolumn + """, access.access AS value
+                FROM access JOIN records_x_access on records_x_access.access_id = access.access_id
+                WHERE records_x_access.""" + recordidcolumn + """ IN ({}) ORDER BY records_x_access.access_id""", "value"),
+            ("domain_metadata", """SELECT dm.""" + recordidcolumn + """, ds.namespace, dm.field_name, dm.field_value
+                FROM domain_metadata dm, domain_schemas ds WHERE dm.schema_id=ds.schema_id and dm.""" + recordidcolumn + """ IN ({})
+                ORDER BY dm.schema_id, dm.metadata_id""", None)
+        ]
+
+        con = self.db.getConnection()
+        with con:
+            cur = self.db.getDictCursor()
+            for field, sqlstring, valuecolumn in queries:
+                for row in self.db._select_in(cur, sqlstring, record_uuids):
+                    if field.endswith("_"):
+                        # Fields split by language: frdr_subject_en, frdr_subject_fr, etc.
+                        row_field = field + row["language"]
+                    else:
+                        row_field = field
+                    record_fields = related.setdefault(str(row[recordidcolumn]), {})
+                    if valuecolumn:
+                        record_fields.setdefault(row_field, []).append(row[valuecolumn])
+                    else:
+                        record_fields.setdefault(row_field, []).append(row)
+        return related
 
+    def _records_filter(self, only_new_records):
+        """ The FROM and WHERE clauses, and their arguments, that pick the records to export """
+        recordidcolumn = self.db.get_table_id_column("records")
         try:
             lastrun_timestamp = int(self.db.get_setting("last_run_timestamp"))
         except Exception as e:
             lastrun_timestamp = 0
 
-        records_con = self.db.getConnection()
-        with records_con:
-            records_cursor = self.db.getRowCursor()
-
-        records_sql = """SELECT recs.""" + recordidcolumn + """, recs.title, recs.title_fr, recs.pub_date, recs.series,
-            recs.deleted, recs.local_identifier, recs.item_url, recs.modified_timestamp,
-            repos.repository_url, repos.repository_name, repos.repository_name_fr, repos.repository_thumbnail, repos.item_url_pattern, repos.last_crawl_timestamp
-            FROM records recs, repositories repos WHERE recs.repository_id = repos.repository_id"""
+        records_sql = " FROM records recs, repositories repos WHERE recs.repository_id = repos.repository_id"
         records_args = ()
 
         if self.export_repository_id:
@@ -40,10 +115,93 @@ class ExporterGmeta(Exporter.Exporter):
             records_sql += " AND recs.modified_timestamp >= ?"
             records_args = records_args + (lastrun_timestamp,)
 
-        if len(records_args):
-            records_cursor.execute(self.db._prep(records_sql), records_args)
-        else:
-            records_cursor.execute(self.db._prep(records_sql))
+        if self.shard_start is not None:
+            records_sql += " AND recs." + recordidcolumn + " >= ?"
+            records_args = records_args + (self.shard_start,)
+
+        if self.shard_end is not None:
+            records_sql += " AND recs." + recordidcolumn + " < ?"
+            records_args = records_args + (self.shard_end,)
+
+        return records_sql, records_args
+
+    def _generate(self, only_new_records):
+        self.logger.info("Exporter: generate called for gmeta")
+        if self.export_workers > 1 and self.destination == "file":
+            return self._generate_parallel(only_new_records)
+        return self._generate_records(only_new_records)
+
+    def _shard_bounds(self, only_new_records):
+        """ Record uuids that split the records to export into ranges of about the same size """
+        recordidcolumn = self.db.get_table_id_column("records")
+        records_filter, records_args = self._records_filter(only_new_records)
+        cur = self.db.getLambdaCursor()
+        cur.execute(self.db._prep("SELECT count(*)" + records_filter), records_args)
+        counts = self._rows_to_list(cur)
+        total_records = int(counts[0]) if counts else 0
+        # A few ranges per worker, so one slow range does not hold up the rest
+        shard_count = min(self.export_workers * 4, int(math.ceil(total_records / self.records_per_chunk)))
+        bounds = []
+        for shard in range(1, shard_count):
+            cur.execute(self.db._prep("SELECT recs." + recordidcolumn + records_filter + " ORDER BY recs." + recordidcolumn +
+                                      " LIMIT 1 OFFSET ?"), records_args + (total_records * shard // shard_count,))
+            bound = self._rows_to_list(cur)
+            if bound and bound[0] not in bounds:
+                bounds.append(bound[0])
+        return [None] + bounds, bounds + [None]
+
+    def _generate_parallel(self, only_new_records):
+        """ Export each uuid range in a worker process, then number the files of all ranges in order """
+        shard_starts, shard_ends = self._shard_bounds(only_new_records)
+        self.logger.info("Exporter: {} record ranges across {} workers".format(len(shard_starts), self.export_workers))
+        shard_config = {"export_file_limit_mb": self.export_limit}
+        shard_paths = [os.path.join(self.temp_filepath, "shard_" + str(shard)) for shard in range(len(shard_starts))]
+        deleted = []
+        records_assembled = 0
+        batch_number = 1
+        try:
+            # Spawned rather than forked, as the harvest may have other threads (and connections) open
+            with ProcessPoolExecutor(max_workers=self.export_workers,
+                                     mp_context=multiprocessing.get_context("spawn")) as pool:
+                shards = [pool.submit(export_shard, self.db.params, shard_config, shard_start, shard_end, shard_path,
+                                      self.export_repository_id, only_new_records)
+                          for shard_start, shard_end, shard_path in zip(shard_starts, shard_ends, shard_paths)]
+                results = [shard.result() for shard in shards]
+
+            for result in results:
+                for level, message in result["log"]:
+                    getattr(self.logger, level)(message)
+                for filename in result["files"]:
+                    export_filename = os.path.join(self.export_filepath, "gmeta_" + str(batch_number) + ".json")
+                    try:
+                        os.replace(filename, export_filename)
+                    except Exception as e:
+                        self.logger.error("Unable to move temp file: {} to output file: {}".format(filename, export_filename))
+                    batch_number += 1
+                deleted.extend(result["deleted"])
+                records_assembled += result["records_assembled"]
+        finally:
+            for shard_path in shard_paths:
+                shutil.rmtree(shard_path, ignore_errors=True)
+                shutil.rmtree(shard_path + "_temp", ignore_errors=True)
+
+        self.exported_count = records_assembled
+        self.logger.info("Export complete: {} items in {} files".format(records_assembled, batch_number - 1))
+        return deleted
+
+    def _generate_records(self, only_new_records):
+        """ Export the records one chunk at a time, into gmeta files numbered from batch_number 1 """
+        self.batch_file = None
+        deleted = []
+        recordidcolumn = self.db.get_table_id_column("records")
+
+        records_filter, records_args = self._records_filter(only_new_records)
+        records_sql = """SELECT recs.""" + recordidcolumn + """, recs.title, recs.title_fr, recs.pub_date, recs.series,
+            recs.deleted, recs.local_identifier, recs.item_url, recs.modified_timestamp,
+            repos.repository_url, repos.repository_name, repos.repository_name_fr, repos.repository_thumbnail, repos.item_url_pattern, repos.last_crawl_timestamp""" + records_filter
+
+        # Streamed, so only records_per_chunk records are held at once however many there are
+        records_rows = self.db.stream_query(records_sql, records_args, dict_rows=False)
 
         buffer_limit = int(self.export_limit) * 1024 * 1024
         self.logger.info("Exporter: output file size limited to {} MB each".format(int(self.export_limit)))
@@ -51,61 +209,59 @@ class ExporterGmeta(Exporter.Exporter):
         records_assembled = 0
         self.batch_number = 1
         self.buffer_size = 0
-        for row in records_cursor:
-            if self.buffer_size > buffer_limit:
-                self._write_batch()
-
-            record = (dict(zip(
-                [recordidcolumn, 'title', 'title_fr', 'pub_date', 'series', 'deleted', 'local_identifier',
-                 'item_url', 'modified_timestamp',
-                 'repository_url', 'repository_name', 'repository_name_fr','repository_thumbnail', 'item_url_pattern',
-                 'last_crawl_timestamp'], row)))
-            record["deleted"] = int(record["deleted"])
-
-            if record["item_url"] == "" and record["modified_timestamp"] != 0:
-                record["item_url"] = self.db.construct_local_url(record)
-
-            if record.get("item_url") is None:
-                continue
-                
-            if record["deleted"] == 1:
-                deleted.append(record["item_url"])
-                continue
-
-            if ((record["title"] is None or len(record["title"]) == 0) and 
-                (record["title_fr"] is None or len(record["title_fr"]) == 0)):
-                continue
-
-            con = self.db.getConnection()
-            with con:
-                litecur = self.db.getDictCursor()
-
-                litecur.execute(self.db._prep("""SELECT geobbox.westLon, geobbox.eastLon, geobbox.northLat, geobbox.southLat
-                                    FROM geobbox WHERE geobbox.""" + recordidcolumn + """=?"""), (record[recordidcolumn],))
-                geobboxes = litecur.fetchall()
-                if len(geobboxes) > 0:
+        while True:
+            rows = list(itertools.islice(records_rows, self.records_per_chunk))
+            if not rows:
+                break
+
+            records = []
+            for row in rows:
+                record = (dict(zip(
+                    [recordidcolumn, 'title', 'title_fr', 'pub_date', 'series', 'deleted', 'local_identifier',
+                     'item_url', 'modified_timestamp',
+                     'repository_url', 'repository_name', 'repository_name_fr','repository_thumbnail', 'item_url_pattern',
+                     'last_crawl_timestamp'], row)))
+                record["deleted"] = int(record["deleted"])
+
+                if record["item_url"] == "" and record["modified_timestamp"] != 0:
+                    record["item_url"] = self.db.construct_local_url(record)
+
+                if record.get("item_url") is None:
+                    continue
+
+                if record["deleted"] == 1:
+                    deleted.append(record["item_url"])
+                    continue
+
+                if ((record["title"] is None or len(record["title"]) == 0) and
+                    (record["title_fr"] is None or len(record["title_fr"]) == 0)):
+                    continue
+
+                records.append(record)
+
+            # Fetch the related metadata for the whole chunk, one query per table
+            related = self._get_related_metadata([record[recordidcolumn] for record in records])
+
+            for record in records:
+                record_related = related.get(str(record[recordidcolumn]), {})
+
+                if record_related.get("geobbox"):
                     record["datacite_geoLocationBox"] = []
-                    for geobbox in geobboxes:
+                    for geobbox in record_related["geobbox"]:
                         record["datacite_geoLocationBox"].append({"westBoundLongitude": float(geobbox["westlon"]),
                                                                   "eastBoundLongitude": float(geobbox["eastlon"]),
                                                                   "northBoundLatitude": float(geobbox["northlat"]),
                                                                   "southBoundLatitude": float(geobbox["southlat"])})
 
-
-                litecur.execute(self.db._prep("SELECT geopoint.lat, geopoint.lon FROM geopoint WHERE geopoint." + recordidcolumn + "=?"), (record[recordidcolumn],))
-                geopoints = litecur.fetchall()
-                if len(geopoints) > 0:
+                if record_related.get("geopoint"):
                     record["datacite_geoLocationPoint"] = []
-                    for geopoint in geopoints:
+                    for geopoint in record_related["geopoint"]:
                         record["datacite_geoLocationPoint"].append({"pointLatitude": float(geopoint["lat"]),
                                                                     "pointLongitude": float(geopoint["lon"])})
 
-                litecur.execute(self.db._prep("""SELECT geoplace.country, geoplace.province_state, geoplace.city, geoplace.other, geoplace.place_name
-                    FROM geoplace WHERE geoplace.""" + recordidcolumn + """=?"""), (record[recordidcolumn],))
-                geoplaces = litecur.fetchall()
-                if len(geoplaces) > 0:
+                if record_related.get("geoplace"):
                     record["datacite_geoLocationPlace"] = []
-                    for geoplace in geoplaces:
+                    for geoplace in record_related["geoplace"]:
                         if geoplace["place_name"]:
                             record["datacite_geoLocationPlace"].append({"place_name": geoplace["place_name"]})
                         elif geoplace["country"] or geoplace["province_state"] or geoplace["city"] or geoplace["other"]:
@@ -115,93 +271,24 @@ class ExporterGmeta(Exporter.Exporter):
                                                                         "additional": geoplace["other"]})
 
                 # CRDC (FRDR records only)
-                litecur.execute(self.db._prep("""SELECT crdc.crdc_code, crdc.crdc_group_en, crdc.crdc_group_fr, 
-                                                    crdc.crdc_class_en, crdc.crdc_class_fr, crdc.crdc_field_en, crdc.crdc_field_fr
-                                                    FROM crdc JOIN records_x_crdc on records_x_crdc.crdc_id = crdc.crdc_id
-                                                    WHERE records_x_crdc.""" + recordidcolumn + """=?"""),
-                                (record[recordidcolumn],))
-                crdc_entries = litecur.fetchall()
-                if len(crdc_entries) > 0:
+                if record_related.get("crdc"):
                     record["crdc"] = []
-                    for crdc_entry in crdc_entries:
+                    for crdc_entry in record_related["crdc"]:
                         record["crdc"].append({"crdc_code": crdc_entry["crdc_code"],
                                                "crdc_group_en": crdc_entry["crdc_group_en"], "crdc_group_fr": crdc_entry["crdc_group_fr"],
                                                "crdc_class_en": crdc_entry["crdc_class_en"], "crdc_class_fr": crdc_entry["crdc_class_fr"],
                                                "crdc_field_en": crdc_entry["crdc_field_en"], "crdc_field_fr": crdc_entry["crdc_field_fr"] })
 
-            with con:
-                litecur = self.db.getLambdaCursor()
-
                 # attach the other values to the dict
-                litecur.execute(self.db._prep("""SELECT creators.creator FROM creators JOIN records_x_creators on records_x_creators.creator_id = creators.creator_id
-                    WHERE records_x_creators.""" + recordidcolumn + """=? AND records_x_creators.is_contributor=0 order by records_x_creators_id asc"""),
-                                (record[recordidcolumn],))
-                record["dc_contributor_author"] = self._rows_to_list(litecur)
-
-                litecur.execute(self.db._prep("""SELECT affiliations.affiliation FROM affiliations JOIN records_x_affiliations on records_x_affiliations.affiliation_id = affiliations.affiliation_id
-                    WHERE records_x_affiliations.""" + recordidcolumn + """=?"""), (record[recordidcolumn],))
-                record["datacite_creatorAffiliation"] = self._rows_to_list(litecur)
-
-                litecur.execute(self.db._prep("""SELECT creators.creator FROM creators JOIN records_x_creators on records_x_creators.creator_id = creators.creator_id
-                    WHERE records_x_creators.""" + recordidcolumn + """=? AND records_x_creators.is_contributor=1 order by records_x_creators_id asc"""),
-                                (record[recordidcolumn],))
-                record["dc_contributor"] = self._rows_to_list(litecur)
-
-                litecur.execute(self.db._prep("""SELECT subjects.subject FROM subjects JOIN records_x_subjects on records_x_subjects.subject_id = subjects.subject_id
-                    WHERE records_x_subjects.""" + recordidcolumn + """=? and subjects.language='en'"""), (record[recordidcolumn],))
-                record["frdr_subject_en"] = self._rows_to_list(litecur)
-
-
-                litecur.execute(self.db._prep("""SELECT subjects.subject FROM subjects JOIN records_x_subjects on records_x_subjects.subject_id = subjects.subject_id
-                    WHERE records_x_subjects.""" + recordidcolumn + """=? and subjects.language='fr'"""), (record[recordidcolumn],))
-                record["frdr_subject_fr"] = self._rows_to_list(litecur)
-
-                litecur.execute(self.db._prep("""SELECT publishers.publisher FROM publishers JOIN records_x_publishers on records_x_publishers.publisher_id = publishers.publisher_id
-                    WHERE records_x_publishers.""" + recordidcolumn + """=?"""), (record[recordidcolumn],))
-                record["dc_publisher"] = self._rows_to_list(litecur)
-
-                litecur.execute(self.db._prep("""SELECT rights.rights FROM rights JOIN records_x_rights on records_x_rights.rights_id = rights.rights_id
-                                                       WHERE records_x_rights.""" + recordidcolumn + """=?"""), (record[recordidcolumn],))
-                record["dc_rights"] = self._rows_to_list(litecur)
-
-                litecur.execute(
-                    self.db._prep("SELECT description FROM descriptions WHERE " + recordidcolumn + "=? and language='en' "),
-                    (record[recordidcolumn],))
-                record["dc_description_en"] = self._rows_to_list(litecur)
-
-                litecur.execute(
-                    self.db._prep("SELECT description FROM descriptions WHERE " + recordidcolumn + "=? and language='fr' "),
-                    (record[recordidcolumn],))
-                record["dc_description_fr"] = self._rows_to_list(litecur)
-
-                litecur.execute(self.db._prep("""SELECT tags.tag FROM tags JOIN records_x_tags on records_x_tags.tag_id = tags.tag_id
-                    WHERE records_x_tags.""" + recordidcolumn + """=? and tags.language = 'en' """), (record[recordidcolumn],))
-                record["frdr_keyword_en"] = self._rows_to_list(litecur)
-
-                litecur.execute(self.db._prep("""SELECT tags.tag FROM tags JOIN records_x_tags on records_x_tags.tag_id = tags.tag_id
-                    WHERE records_x_tags.""" + recordidcolumn + """=? and tags.language = 'fr' """), (record[recordidcolumn],))
-                record["frdr_keyword_fr"] = self._rows_to_list(litecur)
-
-                litecur.execute(self.db._prep("""SELECT access.access FROM access JOIN records_x_access on records_x_access.access_id = access.access_id
-                    WHERE records_x_access.""" + recordidcolumn + """=?"""), (record[recordidcolumn],))
-                record["frdr_access"] = self._rows_to_list(litecur)
-
-            with con:
-                if self.db.getType() == "sqlite":
-                    from sqlite3 import Row
-                    con.row_factory = Row
-                    litecur = con.cursor()
-                elif self.db.getType() == "postgres":
-                    litecur = con.cursor(cursor_factory=DictCursor)
-
-                litecur.execute(self.db._prep(
-                    """SELECT ds.namespace, dm.field_name, dm.field_value 
-                    FROM domain_metadata dm, domain_schemas ds WHERE dm.schema_id=ds.schema_id and dm.""" + recordidcolumn + """=?"""),
-                                (record[recordidcolumn],))
-                for row2 in litecur:
-                    domain_namespace = str(row2["namespace"])
-                    field_name = str(row2["field_name"])
-                    field_value = str(row2["field_value"])
+                for field in ["dc_contributor_author", "datacite_creatorAffiliation", "dc_contributor", "frdr_subject_en",
+                              "frdr_subject_fr", "dc_publisher", "dc_rights", "dc_description_en", "dc_description_fr",
+                              "frdr_keyword_en", "frdr_keyword_fr", "frdr_access"]:
+                    record[field] = self._values_to_list(record_related.get(field, []))
+
+                for domain_row in record_related.get("domain_metadata", []):
+                    domain_namespace = str(domain_row["namespace"])
+                    field_name = str(domain_row["field_name"])
+                    field_value = str(domain_row["field_value"])
                     if domain_namespace == "http://datacite.org/schema/kernel-4":
                         custom_label = "datacite_" + field_name
                     else:
@@ -213,64 +300,62 @@ class ExporterGmeta(Exporter.Exporter):
                             record[custom_label] = [record[custom_label]]
                         record[custom_label].append(field_value)
 
-            # Check for bilingual domain names
-            repo_name = record["repository_name"]
-            if (record["repository_name_fr"] is not None and record["repository_name_fr"] != record["repository_name"]):
-                repo_name = record["repository_name"] + " / " + record["repository_name_fr"]
-
-            # Convert friendly column names into dc element names
-            record["dc_title_en"] = record["title"]
-            record["dc_title_fr"] = record["title_fr"]
-            record["dc_date"] = record["pub_date"]
-            record["frdr_series"] = record["series"]
-            record["frdr_origin_id"] = repo_name
-            record["frdr_origin_icon"] = record["repository_thumbnail"]
-            gmeta_subject = record[recordidcolumn]
-
-            # Concatenate EN and FR into multi-language fields for Globus search
-            record["dc_title_multi"] = str(record["dc_title_en"]) + " " + str(record["dc_title_fr"])
-            record["dc_title_multi"] = record["dc_title_multi"].strip()
-            record["dc_description_multi"] = []
-            record["dc_description_multi"].extend(record["dc_description_en"])
-            record["dc_description_multi"].extend(record["dc_description_fr"])
-            record["frdr_subject_multi"] = []
-            record["frdr_subject_multi"].extend(record["frdr_subject_en"])
-            record["frdr_subject_multi"].extend(record["frdr_subject_fr"])
-            record["frdr_keyword_multi"] = []
-            record["frdr_keyword_multi"].extend(record["frdr_keyword_en"])
-            record["frdr_keyword_multi"].extend(record["frdr_keyword_fr"])
-
-            # remove unneeded columns from output
-            record.pop("contact", None)
-            record.pop("deleted", None)
-            record.pop("item_url_pattern", None)
-            record.pop("last_crawl_timestamp", None)
-            record.pop("local_identifier", None)
-            record.pop("modified_timestamp", None)
-            record.pop("pub_date", None)
-            record.pop(recordidcolumn, None)
-            record.pop("repository_name", None)
-            record.pop("repository_name_fr", None)
-            record.pop("repository_thumbnail", None)
-            record.pop("repository_url", None)
-            record.pop("series", None)
-            record.pop("title", None)
-            record.pop("title_fr", None)
-
-            record["datacite_resourceTypeGeneral"] = "dataset"
-            gmeta_data = {"@datatype": "GMetaEntry", "@version": "2016-11-09",
-                          "subject": gmeta_subject, "visible_to": ["public"], "mimetype": "application/json",
-                          "content": record}
-            self.output_buffer.append(gmeta_data)
-
-            self.buffer_size = self.buffer_size + len(json.dumps(gmeta_data))
-            records_assembled += 1
-            if (records_assembled % 1000 == 0):
-                self.logger.info("Done processing {} records for export".format(records_assembled))
-
-        if self.output_buffer:
-            self._write_batch()
-
+                # Check for bilingual domain names
+                repo_name = record["repository_name"]
+                if (record["repository_name_fr"] is not None and record["repository_name_fr"] != record["repository_name"]):
+                    repo_name = record["repository_name"] + " / " + record["repository_name_fr"]
+
+                # Convert friendly column names into dc element names
+                record["dc_title_en"] = record["title"]
+                record["dc_title_fr"] = record["title_fr"]
+                record["dc_date"] = record["pub_date"]
+                record["frdr_series"] = record["series"]
+                record["frdr_origin_id"] = repo_name
+                record["frdr_origin_icon"] = record["repository_thumbnail"]
+                gmeta_subject = record[recordidcolumn]
+
+                # Concatenate EN and FR into multi-language fields for Globus search
+                record["dc_title_multi"] = str(record["dc_title_en"]) + " " + str(record["dc_title_fr"])
+                record["dc_title_multi"] = record["dc_title_multi"].strip()
+                record["dc_description_multi"] = []
+                record["dc_description_multi"].extend(record["dc_description_en"])
+                record["dc_description_multi"].extend(record["dc_description_fr"])
+                record["frdr_subject_multi"] = []
+                record["frdr_subject_multi"].extend(record["frdr_subject_en"])
+                record["frdr_subject_multi"].extend(record["frdr_subject_fr"])
+                record["frdr_keyword_multi"] = []
+                record["frdr_keyword_multi"].extend(record["frdr_keyword_en"])
+                record["frdr_keyword_multi"].extend(record["frdr_keyword_fr"])
+
+                # remove unneeded columns from output
+                record.pop("contact", None)
+                record.pop("deleted", None)
+                record.pop("item_url_pattern", None)
+                record.pop("last_crawl_timestamp", None)
+                record.pop("local_identifier", None)
+                record.pop("modified_timestamp", None)
+                record.pop("pub_date", None)
+                record.pop(recordidcolumn, None)
+                record.pop("repository_name", None)
+                record.pop("repository_name_fr", None)
+                record.pop("repository_thumbnail", None)
+                record.pop("repository_url", None)
+                record.pop("series", None)
+                record.pop("title", None)
+                record.pop("title_fr", None)
+
+                record["datacite_resourceTypeGeneral"] = "dataset"
+                gmeta_data = {"@datatype": "GMetaEntry", "@version": "2016-11-09",
+                              "subject": gmeta_subject, "visible_to": ["public"], "mimetype": "application/json",
+                              "content": record}
+                self._write_batch_entry(gmeta_data, buffer_limit)
+                records_assembled += 1
+                if (records_assembled % 1000 == 0):
+                    self.logger.info("Done processing {} records for export".format(records_assembled))
+
+        self._close_batch_file()
+
+        self.exported_count = records_assembled
         self.logger.info("Export complete: {} items in {} files".format(records_assembled, self.batch_number))
         return deleted
 
@@ -299,3 +384,40 @@ class ExporterGmeta(Exporter.Exporter):
         else:
             return obj
         return new
+
+
+class ShardLogger(object):
+    """ Keeps the log messages of an export worker, for the coordinator to write to the harvest log """
+
+    def __init__(self):
+        self.messages = []
+
+    def debug(self, message):
+        self.messages.append(("debug", message))
+
+    def info(self, message):
+        self.messages.append(("info", message))
+
+    def error(self, message):
+        self.messages.append(("error", message))
+
+
+def export_shard(db_params, finalconfig, shard_start, shard_end, shard_path, export_repository_id, only_new_records):
+    """ Export one uuid range to gmeta files in shard_path, on a database connection of its own; runs in a worker process """
+    from harvester.DBInterface import DBInterface
+    logger = ShardLogger()
+    db = DBInterface(dict(db_params, pool_size=0))
+    db.setLogger(logger)
+    exporter = ExporterGmeta(db, logger, finalconfig)
+    exporter.shard_start = shard_start
+    exporter.shard_end = shard_end
+    exporter.export_repository_id = export_repository_id
+    exporter.export_filepath = shard_path
+    exporter.temp_filepath = shard_path + "_temp"
+    os.makedirs(shard_path, exist_ok=True)
+    try:
+        deleted = exporter._generate_records(only_new_records)
+    finally:
+        db.close()
+    files = [os.path.join(shard_path, "gmeta_" + str(batch_number) + ".json") for batch_number in range(1, exporter.batch_number)]
+    return {"files": files, "deleted": deleted, "records_assembled": exporter.exported_count, "log": logger.messages}
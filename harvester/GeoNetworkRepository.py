@@ -1,10 +1,8 @@
 from harvester.HarvestRepository import HarvestRepository
-from harvester.rate_limited import rate_limited
 import time
-import requests
 import lxml.etree as ET
 from rdflib import Graph, DCAT
-from dateutil import parser
+from harvester.DateNormalizer import DateNormalizer
 import urllib
 import re
 
@@ -13,6 +11,7 @@ class GeoNetworkRepository(HarvestRepository):
 
     def setRepoParams(self, repoParams):
         self.metadataprefix = "geonetwork"
+        self.rate_limit_per_second = 5
         super(GeoNetworkRepository, self).setRepoParams(repoParams)
         self.domain_metadata = []
         self.headers = {'accept': 'application/rdf+xml'}
@@ -52,16 +51,12 @@ class GeoNetworkRepository(HarvestRepository):
                     self.logger.info("Trying again to fetch records at {}: {}".format(self.url, e))
                     time.sleep(3)
 
-            item_count = 0
+            identifiers = []
             for s, p, o in g.triples((None, None, DCAT.CatalogRecord)):
                 # Get record identifier
                 identifier = s.split("https://hecate.hakai.org/geonetwork/srv/metadata//records/")[-1]
-                self.db.write_header(identifier, self.item_url_pattern, self.repository_id)
-                item_count = item_count + 1
-                if (item_count % self.update_log_after_numitems == 0):
-                    tdelta = time.time() - self.tstart + 0.1
-                    self.logger.info("Done {} item headers after {} ({:.1f} items/sec)".format(
-                        item_count, self.formatter.humanize(tdelta), item_count / tdelta))
+                identifiers.append(identifier)
+            item_count = self._write_page_headers(identifiers, 0)
             self.logger.info("Found {} items in feed".format(item_count))
             return True
 
@@ -167,9 +162,9 @@ class GeoNetworkRepository(HarvestRepository):
             try:
                 date_value = ""
                 if find_ns(find_ns(ci_date, "gmd:date"), "gco:Date") is not None:
-                    date_value = parser.parse(find_ns(find_ns(ci_date, "gmd:date"), "gco:Date").text).strftime('%Y-%m-%d')
+                    date_value = DateNormalizer.parse(find_ns(find_ns(ci_date, "gmd:date"), "gco:Date").text)
                 elif find_ns(find_ns(ci_date, "gmd:date"), "gco:DateTime") is not None:
-                    date_value = parser.parse(find_ns(find_ns(ci_date, "gmd:date"), "gco:DateTime").text).strftime('%Y-%m-%d')
+                    date_value = DateNormalizer.parse(find_ns(find_ns(ci_date, "gmd:date"), "gco:DateTime").text)
                 date_type = find_ns(find_ns(ci_date, "gmd:dateType"), "gmd:CI_DateTypeCode").attrib["codeListValue"]
                 citation_dates[date_type] = date_value
             except AttributeError as e:
@@ -276,14 +271,13 @@ class GeoNetworkRepository(HarvestRepository):
 
         return record
 
-    @rate_limited(5)
     def _update_record(self, record):
         request_success = False
         request_count = 0
         while not request_success and request_count < 5:
             try:
                 xml_record_url = "https://hecate.hakai.org/geonetwork/srv/api/records/{}/formatters/xml".format(record["local_identifier"])
-                response = requests.request("GET", xml_record_url)
+                response = self.http_request("GET", xml_record_url)
                 if response.status_code == 200:
                     request_success = True
                 elif response.status_code == 400:
@@ -308,7 +302,7 @@ class GeoNetworkRepository(HarvestRepository):
 
             if oai_record:
                 try:
-                    self.db.write_record(oai_record, self)
+                    self.write_record(oai_record)
                 except Exception as e:
                     self.logger.error(
                         "Updating record {} failed: {} {}".format(record['local_identifier'], type(e).__name__, e))
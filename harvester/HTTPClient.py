@@ -0,0 +1,167 @@
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib.parse import urlparse
+from urllib3.util.retry import Retry
+from harvester.TokenBucket import TokenBucket
+
+
+def get_host(url):
+    """ Hostname of a URL, which may be given without the scheme """
+    if url is None:
+        return None
+    if "//" not in url:
+        url = "//" + url
+    return urlparse(url).hostname
+
+
+class RateLimitedRetry(Retry):
+    """ Retry that waits for a token from the host's bucket before each retried attempt, so retries (which urllib3
+    makes inside the adapter's send) are rate limited too, and slows the bucket down on each 429 """
+
+    def __init__(self, rate_limiters=None, **kwargs):
+        self.rate_limiters = rate_limiters if rate_limiters is not None else {}
+        # The bucket of the host being retried, set by increment() on the Retry used for the next attempt
+        self.limiter = None
+        self.sleeping = False
+        super(RateLimitedRetry, self).__init__(**kwargs)
+
+    def new(self, **kwargs):
+        retry = super(RateLimitedRetry, self).new(**kwargs)
+        retry.rate_limiters = self.rate_limiters
+        return retry
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        retry = super(RateLimitedRetry, self).increment(method, url, response=response, error=error, _pool=_pool,
+                                                        _stacktrace=_stacktrace)
+        retry.limiter = self.rate_limiters.get(getattr(_pool, "host", None))
+        if retry.limiter is not None and response is not None and response.status == 429:
+            retry.limiter.slow_down(self.get_retry_after(response))
+        return retry
+
+    def sleep(self, response=None):
+        # sleep() may call sleep_for_retry(); take only one token for the attempt
+        self.sleeping = True
+        try:
+            super(RateLimitedRetry, self).sleep(response)
+        finally:
+            self.sleeping = False
+        self._acquire()
+
+    def sleep_for_retry(self, response):
+        slept = super(RateLimitedRetry, self).sleep_for_retry(response)
+        if not self.sleeping:
+            self._acquire()
+        return slept
+
+    def _acquire(self):
+        if self.limiter is not None:
+            self.limiter.acquire()
+
+
+class RateLimitedAdapter(HTTPAdapter):
+    """ HTTPAdapter that waits for a token from the host's bucket before sending, and slows down on 429 """
+
+    def __init__(self, rate_limiters, metrics=None, **kwargs):
+        self.rate_limiters = rate_limiters
+        self.metrics = metrics
+        super(RateLimitedAdapter, self).__init__(**kwargs)
+
+    def send(self, request, **kwargs):
+        if self.metrics is None:
+            return self._send(request, **kwargs)
+        tstart = time.time()
+        status = None
+        nbytes = 0
+        with self.metrics.timer("fetch"):
+            try:
+                response = self._send(request, **kwargs)
+                status = response.status_code
+                if kwargs.get("stream"):
+                    nbytes = int(response.headers.get("Content-Length") or 0)
+                else:
+                    # Read the body now, as the session would right after this, so its download time is counted
+                    nbytes = len(response.content or b"")
+            finally:
+                self.metrics.observe_http(time.time() - tstart, nbytes, status)
+        return response
+
+    def _send(self, request, **kwargs):
+        limiter = self.rate_limiters.get(get_host(request.url))
+        if limiter is None:
+            return super(RateLimitedAdapter, self).send(request, **kwargs)
+        limiter.acquire()
+        response = super(RateLimitedAdapter, self).send(request, **kwargs)
+        # Any retries urllib3 made took their own tokens, and slowed the bucket down on a 429
+        retries = getattr(response.raw, "retries", None)
+        history = getattr(retries, "history", None) or ()
+        if response.status_code == 429:
+            retry_after = None
+            try:
+                retry_after = float(response.headers.get("Retry-After"))
+            except (TypeError, ValueError):
+                pass
+            limiter.slow_down(retry_after)
+        elif not [h for h in history if h.status == 429]:
+            limiter.speed_up()
+        return response
+
+
+class HTTPClient(object):
+    """ Pooled HTTP connections shared by all of the repositories being harvested """
+
+    retry_status_codes = [429, 500, 502, 503, 504]
+
+    def __init__(self, params):
+        self.timeout = float(params.get('http_timeout', 60))
+        # One adapter, so keep-alive connections to each host are reused by every session
+        self.rate_limiters = {}
+        retry = RateLimitedRetry(
+            rate_limiters=self.rate_limiters,
+            total=int(params.get('http_retries', 3)),
+            backoff_factor=float(params.get('http_backoff_factor', 1)),
+            status_forcelist=self.retry_status_codes,
+            respect_retry_after_header=True,
+            raise_on_status=False  # Hand the last response back so callers can check status_code as before
+        )
+        self.adapter = RateLimitedAdapter(
+            self.rate_limiters,
+            metrics=params.get('metrics', None),
+            pool_connections=int(params.get('http_pool_hosts', 50)),
+            pool_maxsize=int(params.get('http_pool_maxsize', 10)),
+            max_retries=retry
+        )
+        self.local = threading.local()
+
+    def set_rate_limit(self, url, rate, burst=1):
+        """ Limit requests to the host of this URL; repositories on the same host share the slowest limit """
+        host = get_host(url)
+        if not host or not rate:
+            return
+        limiter = self.rate_limiters.get(host)
+        if limiter is None or float(rate) < limiter.max_rate:
+            self.rate_limiters[host] = TokenBucket(rate, burst)
+
+    def new_session(self):
+        """ A session that uses the shared connection pool, for API clients that want to own one """
+        session = requests.Session()
+        session.mount("https://", self.adapter)
+        session.mount("http://", self.adapter)
+        session.headers.update({"Accept-Encoding": "gzip, deflate"})
+        return session
+
+    def get_session(self):
+        """ requests.Session is not thread safe, so each thread gets its own, all sharing the connection pool """
+        session = getattr(self.local, "session", None)
+        if session is None:
+            session = self.new_session()
+            self.local.session = session
+        return session
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        return self.get_session().request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
@@ -1,6 +1,7 @@
 import os
 import logging
 import sys
+import threading
 from logging.handlers import RotatingFileHandler
 from harvester.BufferingSMTPHandler import BufferingSMTPHandler
 
@@ -30,7 +31,8 @@ class HarvestLogger:
             self.logger.addHandler(logging.StreamHandler(sys.stdout))
 
         self.copyerrorstoemail = False
-        self.previouserrorstate = False
+        # Repositories crawled in parallel threads can each turn email copies off for themselves
+        self.local = threading.local()
         self.mailto = False
         self.mailfrom = False
         if 'copyerrorstoemail' in params and params.get("copyerrorstoemail").upper() == "TRUE":
@@ -40,7 +42,6 @@ class HarvestLogger:
             self.mailsubject = params.get("mailsubject", "Error log")
             if self.mailto != "" and self.mailfrom != "":
                 self.copyerrorstoemail = True
-                self.previouserrorstate = True
                 self.mailusessl = False
                 if 'mailusessl' in params and params.get("mailusessl").upper() == "TRUE":
                     self.mailusessl = True
@@ -55,11 +56,10 @@ class HarvestLogger:
                 self.mailLogger.setLevel(logging.ERROR)
 
     def setErrorsToEmail(self, newState):
-        self.previouserrorstate = self.copyerrorstoemail
-        self.copyerrorstoemail = newState
+        self.local.copyerrorstoemail = newState
 
     def restoreErrorsToEmail(self):
-        self.copyerrorstoemail = self.previouserrorstate
+        self.local.__dict__.pop("copyerrorstoemail", None)
 
     def debug(self, message):
         self.logger.debug(message)
@@ -69,5 +69,5 @@ class HarvestLogger:
 
     def error(self, message):
         self.logger.error(message)
-        if self.copyerrorstoemail:
+        if getattr(self.local, "copyerrorstoemail", self.copyerrorstoemail):
             self.mailLogger.error(message)
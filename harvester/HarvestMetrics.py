@@ -0,0 +1,193 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+
+class HarvestMetrics(object):
+    """ Time, item counts, HTTP latency and database statements for each repository and phase of a harvest run """
+
+    # Upper bounds, in seconds, of the HTTP latency histogram buckets
+    latency_buckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+    def __init__(self, params=None):
+        params = params or {}
+        self.json_file = params.get('metrics_json_file', None) or None
+        self.prometheus_file = params.get('metrics_prometheus_file', None) or None
+        self.tstart = time.time()
+        self.repositories = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def _stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = []
+            self.local.stack = stack
+        return stack
+
+    def current_repository(self):
+        """ The repository this thread is working on, or "(none)" outside of any repository """
+        stack = self._stack()
+        return stack[-1][0] if stack else "(none)"
+
+    def _repository(self, repository):
+        # Call with the lock held
+        if repository not in self.repositories:
+            self.repositories[repository] = {
+                "phases": OrderedDict(),
+                "http": {"requests": 0, "errors": 0, "bytes": 0, "seconds": 0.0,
+                         "buckets": [0] * (len(self.latency_buckets) + 1)}
+            }
+        return self.repositories[repository]
+
+    def _phase(self, repository, phase):
+        phases = self._repository(repository)["phases"]
+        if phase not in phases:
+            phases[phase] = {"seconds": 0.0, "calls": 0, "items": 0}
+        return phases[phase]
+
+    @contextmanager
+    def timer(self, phase, repository=None):
+        """ Time the enclosed block as a phase. Time spent in phases timed inside it on the same thread (such as
+        fetch or database) is counted only there, so the phases of a repository add up to its wall time """
+        if repository is None:
+            repository = self.current_repository()
+        stack = self._stack()
+        frame = [repository, phase, time.time(), 0.0]
+        stack.append(frame)
+        try:
+            yield
+        finally:
+            stack.pop()
+            elapsed = time.time() - frame[2]
+            if stack:
+                stack[-1][3] = stack[-1][3] + elapsed
+            if phase is not None:
+                self.add_time(phase, elapsed - frame[3], repository)
+
+    def repository(self, repository):
+        """ Count whatever is done in the enclosed block (on this thread) towards this repository """
+        return self.timer(None, repository)
+
+    def add_time(self, phase, seconds, repository=None, calls=1):
+        if repository is None:
+            repository = self.current_repository()
+        with self.lock:
+            entry = self._phase(repository, phase)
+            entry["seconds"] = entry["seconds"] + seconds
+            entry["calls"] = entry["calls"] + calls
+
+    def add_items(self, phase, count, repository=None):
+        if repository is None:
+            repository = self.current_repository()
+        with self.lock:
+            entry = self._phase(repository, phase)
+            entry["items"] = entry["items"] + count
+
+    def observe_http(self, seconds, nbytes, status=None, repository=None):
+        """ Add one HTTP request to the latency histogram; status is None if it failed without a response """
+        if repository is None:
+            repository = self.current_repository()
+        bucket = len(self.latency_buckets)
+        for i, upper_bound in enumerate(self.latency_buckets):
+            if seconds <= upper_bound:
+                bucket = i
+                break
+        with self.lock:
+            http = self._repository(repository)["http"]
+            http["requests"] = http["requests"] + 1
+            http["seconds"] = http["seconds"] + seconds
+            http["bytes"] = http["bytes"] + (nbytes or 0)
+            http["buckets"][bucket] = http["buckets"][bucket] + 1
+            if status is None or status >= 400:
+                http["errors"] = http["errors"] + 1
+
+    def as_dict(self):
+        with self.lock:
+            repositories = OrderedDict()
+            for name, repository in self.repositories.items():
+                http = repository["http"]
+                histogram = OrderedDict()
+                cumulative = 0
+                for upper_bound, count in zip(self.latency_buckets + ["+Inf"], http["buckets"]):
+                    cumulative = cumulative + count
+                    histogram[str(upper_bound)] = cumulative
+                repositories[name] = {
+                    "phases": OrderedDict((phase, {"seconds": round(entry["seconds"], 3), "calls": entry["calls"],
+                                                   "items": entry["items"]})
+                                          for phase, entry in repository["phases"].items()),
+                    "http": {"requests": http["requests"], "errors": http["errors"], "bytes": http["bytes"],
+                             "seconds": round(http["seconds"], 3), "latency_buckets": histogram},
+                    "db_statements": repository["phases"].get("database", {}).get("calls", 0)
+                }
+        return {"started": int(self.tstart), "duration": round(time.time() - self.tstart, 3),
+                "repositories": repositories}
+
+    def as_prometheus(self):
+        """ The metrics in the Prometheus text format, for the node_exporter textfile collector """
+        metrics = self.as_dict()
+        repositories = list(metrics["repositories"].items())
+        lines = []
+
+        def label(name):
+            return 'repository="{}"'.format(name.replace("\\", "\\\\").replace('"', '\\"'))
+
+        def add(name, kind, help_text, samples):
+            lines.append("# HELP {} {}".format(name, help_text))
+            lines.append("# TYPE {} {}".format(name, kind))
+            for labels, value in samples:
+                lines.append("{}{{{}}} {}".format(name, labels, value) if labels else "{} {}".format(name, value))
+
+        add("harvest_last_run_start_timestamp_seconds", "gauge", "When the last harvest run started",
+            [("", metrics["started"])])
+        add("harvest_last_run_duration_seconds", "gauge", "How long the last harvest run took",
+            [("", metrics["duration"])])
+        for field, help_text in [("seconds", "Time spent in each phase, not counting phases timed inside it"),
+                                 ("calls", "Times each phase was entered"),
+                                 ("items", "Items handled in each phase")]:
+            add("harvest_phase_" + field, "gauge", help_text,
+                [('{},phase="{}"'.format(label(name), phase), entry[field])
+                 for name, repository in repositories for phase, entry in repository["phases"].items()])
+        for field, help_text in [("requests", "HTTP requests made"),
+                                 ("errors", "HTTP requests that failed or got a 4xx/5xx response"),
+                                 ("bytes", "Bytes of HTTP responses downloaded")]:
+            add("harvest_http_" + field, "gauge", help_text,
+                [(label(name), repository["http"][field]) for name, repository in repositories])
+        add("harvest_db_statements", "gauge", "Database statements executed",
+            [(label(name), repository["db_statements"]) for name, repository in repositories])
+
+        name = "harvest_http_request_duration_seconds"
+        lines.append("# HELP {} HTTP request latency, including the response body".format(name))
+        lines.append("# TYPE {} histogram".format(name))
+        for repository_name, repository in repositories:
+            http = repository["http"]
+            for upper_bound, count in http["latency_buckets"].items():
+                lines.append('{}_bucket{{{},le="{}"}} {}'.format(name, label(repository_name), upper_bound, count))
+            lines.append("{}_sum{{{}}} {}".format(name, label(repository_name), http["seconds"]))
+            lines.append("{}_count{{{}}} {}".format(name, label(repository_name), http["requests"]))
+        return "\n".join(lines) + "\n"
+
+    def write(self, logger=None):
+        """ Write the metrics to metrics_json_file and metrics_prometheus_file, whichever are set """
+        try:
+            if self.json_file:
+                # The file name may include strftime codes, to keep a file per run
+                self._write_file(time.strftime(self.json_file), json.dumps(self.as_dict(), indent=2))
+            if self.prometheus_file:
+                self._write_file(self.prometheus_file, self.as_prometheus())
+        except Exception as e:
+            if logger is not None:
+                logger.error("Unable to write harvest metrics: {} {}".format(type(e).__name__, e))
+
+    def _write_file(self, path, contents):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Write then rename, so a collector never reads a partial file
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as outfile:
+            outfile.write(contents)
+        os.replace(temp_path, path)
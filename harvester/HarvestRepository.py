@@ -1,7 +1,15 @@
 import time
+import math
+import itertools
 import re
-import requests
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 from harvester.TimeFormatter import TimeFormatter
+from harvester.HTTPClient import HTTPClient
+from harvester.HarvestMetrics import HarvestMetrics
+from harvester.AsyncCrawlEngine import AsyncCrawlEngine
+from harvester.RORStore import RORStore
 from zipfile import ZipFile
 import urllib3
 import os
@@ -10,6 +18,31 @@ import json
 urllib3.disable_warnings()  # We are not loading any unsafe sites, just repos we trust
 
 
+class QueuedDBInterface(object):
+    """ Stands in for the database while worker threads refresh stale records, queueing their changes for the writer """
+
+    queued_methods = ["delete_record", "touch_record"]
+
+    def __init__(self, db, local):
+        self._db = db
+        self._local = local
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._db, name)
+        if not callable(attr):
+            return attr
+        outbox = getattr(self._local, "outbox", None)
+        if outbox is not None and name in self.queued_methods:
+            return lambda *args, **kwargs: outbox.append((name, args, kwargs))
+
+        def locked(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+
+        return locked
+
+
 class HarvestRepository(object):
     """ Top level representation of a repository """
 
@@ -26,6 +59,19 @@ class HarvestRepository(object):
             'update_log_after_numitems': 100,
             'record_refresh_days': 30,
             'repo_refresh_days': 7,
+            'write_batch_size': 100,
+            'header_batch_size': 1000,
+            'update_workers': 1,
+            'oai_record_workers': 1,
+            'oai_parse_processes': 0,
+            'refresh_evenly': True,
+            'crawl_engine': "sync",
+            'rate_limit_per_second': None,
+            'rate_limit_burst': 1,
+            'incremental_overlap_hours': 24,
+            'max_unlisted_fraction': 0.5,
+            'full_resync': False,
+            'http_timeout': 60,
             'item_url_pattern': None,
             'prune_non_dataset_items': False,
             'enabled': False,
@@ -33,6 +79,8 @@ class HarvestRepository(object):
             'error_count': 0,
             'db': None,
             'logger': None,
+            'http_client': None,
+            'metrics': None,
             'dataverses_list': None,
             'repo_registry_uri': ""
         }
@@ -42,6 +90,16 @@ class HarvestRepository(object):
         for key, value in globalParams.items():
             setattr(self, key, value)
         self.repository_id = 0
+        self.listed_identifiers = set()
+        # Set when part of a full listing was skipped, so the items missing from it may still exist
+        self.listing_incomplete = False
+        self.pending_writes = []
+        self.refresh_local = threading.local()
+        self.refreshing = False
+        if self.metrics is None:
+            self.metrics = HarvestMetrics()
+        if self.http_client is None:
+            self.http_client = HTTPClient(dict(globalParams, metrics=self.metrics))
 
     def setRepoParams(self, repoParams):
         """ Set local repo params and let them override the global config """
@@ -53,9 +111,36 @@ class HarvestRepository(object):
             repo_oai_name = repo_oai_name[:-1]
         repo_oai_name = re.sub('[^0-9a-zA-Z\-\.]+', '-', repo_oai_name)
         setattr(self, "repo_oai_name", repo_oai_name)
+        # Crawl and refresh share this budget, along with any other repository on the same host
+        self.http_client.set_rate_limit(self.url, self.rate_limit_per_second, self.rate_limit_burst)
         setattr(self, "geofile_extensions", [".tif", ".tiff",".xyz", ".png", ".aux.xml",".tab",".twf",".tifw", ".tiffw",".wld",
                                   ".tif.prj",".tfw", ".geojson",".shp",".gpkg", ".shx", ".dbf", ".sbn",".prj", ".csv", ".txt", ".zip"])
 
+    def http_request(self, method, url, **kwargs):
+        """ Make a request through the shared connection pool, with this repository's timeout """
+        kwargs.setdefault("timeout", float(self.http_timeout))
+        return self.http_client.request(method, url, **kwargs)
+
+    def http_get(self, url, **kwargs):
+        return self.http_request("GET", url, **kwargs)
+
+    def fetch_request(self, request):
+        """ Make a request described by get_page_request() or get_record_request() """
+        return self.http_get(request["url"], params=request.get("params"), headers=request.get("headers"),
+                             verify=request.get("verify", True))
+
+    def use_async_engine(self, hook):
+        """ True if crawl_engine is async, and this repository describes its requests with the given hook """
+        if self.crawl_engine != "async":
+            return False
+        if getattr(type(self), hook) is getattr(HarvestRepository, hook):
+            return False
+        if AsyncCrawlEngine.get_backend() is None:
+            self.logger.error("crawl_engine is async but neither aiohttp nor httpx is installed, using sync")
+            self.crawl_engine = "sync"
+            return False
+        return True
+
     def setLogger(self, l):
         self.logger = l
 
@@ -80,32 +165,80 @@ class HarvestRepository(object):
 
         if (self.enabled):
             if (self.last_crawl + self.repo_refresh_days * 86400) < self.tstart:
-                try:
-                    self._crawl()
-                    self.db.update_last_crawl(self.repository_id)
-                except Exception as e:
-                    self.logger.error("Repository {} unable to be harvested: {} {}".format(self.name, type(e).__name__, e))
+                self.listed_identifiers = set()
+                self.listing_incomplete = False
+                with self.metrics.timer("listing", self.name):
+                    try:
+                        self._crawl()
+                        self.flush_records()
+                        self.db.update_last_crawl(self.repository_id)
+                    except Exception as e:
+                        self.logger.error("Repository {} unable to be harvested: {} {}".format(self.name, type(e).__name__, e))
+                    # Keep whatever was harvested before a failure
+                    self.flush_records()
             else:
                 self.logger.info("This repo is not yet due to be harvested")
         else:
             self.logger.info("This repo is not enabled for harvesting")
             self.db.set_repo_enabled(self.repository_id, self.enabled)
 
+    def write_record(self, record, domain_metadata=None):
+        """ Queue a record and its domain metadata; records are written to the database in batches """
+        if record is None:
+            return
+        if domain_metadata is None:
+            domain_metadata = self.domain_metadata
+        outbox = getattr(self.refresh_local, "outbox", None)
+        if outbox is not None:
+            # Called from a refresh worker, leave it for the writer
+            outbox.append(("write_record", (record, domain_metadata), {}))
+            return
+        if not self.refreshing:
+            self.metrics.add_items("listing", 1, self.name)
+        self.pending_writes.append((record, domain_metadata))
+        if len(self.pending_writes) >= int(self.write_batch_size):
+            self.flush_records()
+
+    def flush_records(self):
+        """ Write all queued records to the database """
+        outbox = getattr(self.refresh_local, "outbox", None)
+        if outbox is not None:
+            outbox.append(("flush_records", (), {}))
+            return
+        if not self.pending_writes:
+            return
+        pending_writes = self.pending_writes
+        self.pending_writes = []
+        self.metrics.add_items("database", len(pending_writes), self.name)
+        try:
+            self.db.write_records([r for r, d in pending_writes], self, [d for r, d in pending_writes])
+        except Exception as e:
+            # The batch was rolled back; write the records one at a time so one bad record does not lose the rest
+            self.logger.error("Batch write of {} records failed, retrying one at a time: {} {}".format(
+                len(pending_writes), type(e).__name__, e))
+            for record, domain_metadata in pending_writes:
+                self.domain_metadata = domain_metadata
+                try:
+                    self.db.write_record(record, self)
+                except Exception as e:
+                    self.logger.error("Writing record {} failed: {} {}".format(record.get("identifier"), type(e).__name__, e))
+
     def load_ror_data(self):
         # Check if we have the most current ROR data saved locally
         # Given a Figshare URL to the data, follow it to Amazon, download the ZIP and extract the JSON data
         current_ror_json_url = self.db.get_setting("ror_json_url")
+        ror_store_file = RORStore.store_filename(self.ror_data_file)
         if self.ror_json_url:
             if current_ror_json_url != self.ror_json_url:
                 try:
                     ror_zipfile = self.ror_data_file + ".zip"
                     zip_files = []
                     self.logger.info("Fetching ROR data from {}".format(self.ror_json_url))
-                    res = requests.get(self.ror_json_url, allow_redirects=False)
+                    res = self.http_get(self.ror_json_url, allow_redirects=False)
                     if res.status_code == 302: # Redirect on first request to Figshare is expected
                         cj = res.cookies
                         redir_url = res.headers["Location"]
-                        ror_json = requests.get(redir_url, cookies = cj)
+                        ror_json = self.http_get(redir_url, cookies = cj)
                         with open(ror_zipfile,"wb") as f:
                             f.write(ror_json.content)
                         with ZipFile(ror_zipfile,"r") as zip_ref:
@@ -117,6 +250,8 @@ class HarvestRepository(object):
                                     os.rename("data/" + filename, self.ror_data_file)
                                     self.db.set_setting("ror_json_file", filename)
                         os.remove(ror_zipfile)
+                        # Convert it once, here, rather than loading the whole JSON file on every run
+                        self.build_ror_store(ror_store_file)
                         self.db.set_setting("ror_json_url",self.ror_json_url)
                     else:
                         self.logger.error("Expected a 302 redirect on the ror_json_url but instead got {}".format(res.status_code))
@@ -126,22 +261,103 @@ class HarvestRepository(object):
         else:
             self.logger.error("Function to load ROR data was called but ror_json_url missing from config")
 
-        # Load the ROR data
+        # Open the ROR data
         try:
-            with open(self.ror_data_file,"r") as f:
-                ror_data_list = json.load(f)
-                self.ror_data = {}
-                for ror_entry in ror_data_list:
-                    self.ror_data[ror_entry["id"]] = ror_entry
+            if not os.path.exists(ror_store_file):
+                # ROR data downloaded before there was a store
+                self.build_ror_store(ror_store_file)
+            self.ror_data = RORStore(ror_store_file)
             return True
         except Exception as e:
             self.logger.error("Error in loading or parsing ROR data file {}".format(self.ror_data_file))
             return False
 
-    def _update_record(self, record):
-        """ This method to be overridden """
+    def build_ror_store(self, ror_store_file):
+        self.logger.info("Converting ROR data file {} to {}".format(self.ror_data_file, ror_store_file))
+        count = RORStore.build(ror_store_file, self.ror_data_file, self.db.get_setting("ror_json_file"))
+        self.logger.info("Saved {} ROR entries".format(count))
+
+    def get_page_request(self, page, state):
+        """ The request for the page after this one (or the first page if None), or None after the last page """
+        return None
+
+    def get_page_identifiers(self, page, state):
+        """ The item identifiers on a page fetched for get_page_request() """
+        return []
+
+    def _write_page_headers(self, identifiers, item_count):
+        """ Add headers for a page of item identifiers, a transaction per header_batch_size; returns the new item count """
+        identifiers = list(identifiers)
+        batch_size = int(self.header_batch_size)
+        for i in range(0, len(identifiers), batch_size):
+            batch = identifiers[i:i + batch_size]
+            self.db.write_headers(batch, self.item_url_pattern, self.repository_id)
+            self.metrics.add_items("listing", len(batch), self.name)
+            self.metrics.add_items("database", len(batch), self.name)
+            self.listed_identifiers.update(batch)
+            previous_count = item_count
+            item_count = item_count + len(batch)
+            if (item_count // self.update_log_after_numitems > previous_count // self.update_log_after_numitems):
+                tdelta = time.time() - self.tstart + 0.1
+                self.logger.info("Done {} item headers after {} ({:.1f} items/sec)".format(
+                    item_count, self.formatter.humanize(tdelta), item_count / tdelta))
+        return item_count
+
+    def _crawl_pages(self):
+        """ Write a header for every item in a paged API described by get_page_request(); returns the item count """
+        if self.use_async_engine("get_page_request"):
+            return asyncio.run(AsyncCrawlEngine(self).crawl_pages())
+        state = {}
+        item_count = 0
+        request = self.get_page_request(None, state)
+        while request:
+            page = self.fetch_request(request).json()
+            identifiers = self.get_page_identifiers(page, state)
+            request = self.get_page_request(page, state)
+            item_count = self._write_page_headers(identifiers, item_count)
+        return item_count
+
+    def delete_unlisted_records(self):
+        """ Called after a full listing: mark records that are no longer listed as deleted, rather than waiting for a 404 """
+        if not self.listed_identifiers:
+            # An empty listing is more likely a broken feed than an empty repository
+            self.logger.info("No items listed, not looking for deleted items")
+            return 0
+        if self.listing_incomplete:
+            self.logger.info("Part of the listing failed, not looking for deleted items")
+            return 0
+        unlisted, live_count = self.db.get_unlisted_records(self.repository_id, self.listed_identifiers)
+        if not unlisted:
+            return 0
+        if len(unlisted) > float(self.max_unlisted_fraction) * live_count:
+            # Most likely part of the listing failed, rather than that many items being removed at once
+            self.logger.error("{} of {} items were not listed, more than max_unlisted_fraction ({}) allows; "
+                              "not marking them as deleted".format(len(unlisted), live_count, self.max_unlisted_fraction))
+            return 0
+        deleted_count = self.db.mark_records_deleted(unlisted)
+        if deleted_count:
+            self.logger.info("Marked {} items no longer listed as deleted".format(deleted_count))
+        return deleted_count
+
+    def get_record_request(self, record):
+        """ The request that fetches a stale record, for repositories that use process_record_response() """
+        return None
+
+    def process_record_response(self, record, response):
+        """ Update a stale record from its response, or from the exception raised while fetching it """
         return True
 
+    def _update_record(self, record):
+        """ This method to be overridden, or get_record_request() and process_record_response() instead """
+        request = self.get_record_request(record)
+        if request is None:
+            return True
+        try:
+            response = self.fetch_request(request)
+        except Exception as e:
+            response = e
+        return self.process_record_response(record, response)
+
     def update_stale_records(self, dbparams):
         """ This method will be called by a child class only, so that it uses its own _update_record() method """
         if self.enabled != True:
@@ -149,35 +365,138 @@ class HarvestRepository(object):
         if self.db is None:
             self.logger.error("Database configuration is not complete")
             return False
-        record_count = 0
-        tstart = time.time()
+        self.refresh_count = 0
+        self.refresh_tstart = time.time()
         self.logger.info("Looking for stale records to update")
         stale_timestamp = int(time.time() - self.record_refresh_days * 86400)
 
-        records = self.db.get_stale_records(stale_timestamp, self.repository_id, self.max_records_updated_per_run)
+        with self.metrics.timer("refresh", self.name):
+            self.refreshing = True
+            budget = self.get_refresh_budget(stale_timestamp)
+            records = self.db.get_stale_records(stale_timestamp, self.repository_id, budget, include_fresh=self.refresh_evenly)
+            try:
+                # Records may be streamed from the database, so only look at the first one to see if there are any
+                pending = iter(records)
+                first_record = next(pending, None)
+                if first_record is not None:
+                    self.logger.info("Started processing for up to {} records".format(budget))
+                    pending = itertools.chain([first_record], pending)
+                    if self.use_async_engine("get_record_request"):
+                        asyncio.run(AsyncCrawlEngine(self).update_records(pending))
+                    elif int(self.update_workers) > 1:
+                        self._update_stale_records_parallel(pending)
+                    else:
+                        self._update_stale_records_serial(pending)
+            finally:
+                self.refreshing = False
+                if hasattr(records, "close"):
+                    records.close()
+
+            self.flush_records()
+            self.db.update_last_refresh(self.repository_id)
+        self.metrics.add_items("refresh", self.refresh_count, self.name)
+        self.logger.info("Updated {} items in {} ({:.1f} items/sec)".format(self.refresh_count, self.formatter.humanize(
+            time.time() - self.refresh_tstart), self.refresh_count / (time.time() - self.refresh_tstart + 0.1)))
+
+    def get_refresh_budget(self, stale_timestamp):
+        """ How many records to refresh this run: every new header, plus this run's share of the repository, so that
+        all of it is refreshed once every record_refresh_days at an even pace; never more than max_records_updated_per_run """
+        if not self.refresh_evenly:
+            return self.max_records_updated_per_run
+        counts = self.db.get_refresh_counts(stale_timestamp, self.repository_id)
+        refresh_period = max(float(self.record_refresh_days), 1) * 86400
+        last_refresh = self.db.get_repo_last_refresh(self.repository_id)
+        if last_refresh:
+            since_last_refresh = min(max(time.time() - last_refresh, 0), refresh_period)
+        else:
+            since_last_refresh = 86400
+        share = int(math.ceil((counts["live"] - counts["new"]) * since_last_refresh / refresh_period))
+        budget = min(int(self.max_records_updated_per_run), counts["new"] + share)
+        self.logger.info("Refresh budget {} of {} items ({} new, {} stale)".format(
+            budget, counts["live"], counts["new"], counts["stale"]))
+        return budget
+
+    def _count_stale_record(self, status):
+        """ Log progress after each refreshed record; returns False if the refresh should stop """
+        if not status:
+            self.logger.error(
+                "Aborting due to errors after {} items updated in {} ({:.1f} items/sec)".format(
+                    self.refresh_count,
+                    self.formatter.humanize(time.time() - self.refresh_tstart),
+                    self.refresh_count / (time.time() - self.refresh_tstart + 0.1))
+                )
+            return False
+
+        self.refresh_count = self.refresh_count + 1
+        if (self.refresh_count % self.update_log_after_numitems == 0):
+            tdelta = time.time() - self.refresh_tstart + 0.1
+            self.logger.info(
+                "Done {} items after {} ({:.1f} items/sec)".format(self.refresh_count, self.formatter.humanize(tdelta),
+                                                                   (self.refresh_count / tdelta)))
+        return True
+
+    def _parse_record(self, func, *args):
+        """ Call _update_record() or process_record_response(), timing it as the parse phase """
+        with self.metrics.timer("parse", self.name):
+            self.metrics.add_items("parse", 1, self.name)
+            return func(*args)
+
+    def _update_stale_records_serial(self, records):
         for record in records:
-            if record_count == 0:
-                self.logger.info("Started processing for {} records".format(len(records)))
-
-            status = self._update_record(record)
-            if not status:
-                self.logger.error(
-                    "Aborting due to errors after {} items updated in {} ({:.1f} items/sec)".format(
-                        record_count, 
-                        self.formatter.humanize(time.time() - tstart), 
-                        record_count / (time.time() - tstart + 0.1))
-                    )
+            if not self._count_stale_record(self._parse_record(self._update_record, record)):
                 break
 
-            record_count = record_count + 1
-            if (record_count % self.update_log_after_numitems == 0):
-                tdelta = time.time() - tstart + 0.1
-                self.logger.info(
-                    "Done {} items after {} ({:.1f} items/sec)".format(record_count, self.formatter.humanize(tdelta),
-                                                                       (record_count / tdelta)))
+    def _refresh_record(self, record):
+        """ Run _update_record() in a worker, collecting its database changes instead of making them """
+        self.refresh_local.outbox = []
+        try:
+            status = self._parse_record(self._update_record, record)
+            return status, self.refresh_local.outbox
+        finally:
+            self.refresh_local.outbox = None
+
+    def _apply_refresh_outbox(self, outbox):
+        """ The single writer: make the database changes a worker collected for one record """
+        for name, args, kwargs in outbox:
+            if name == "write_record":
+                self.write_record(*args, **kwargs)
+            elif name == "flush_records":
+                self.flush_records()
+            else:
+                getattr(self.db, name)(*args, **kwargs)
+
+    def _update_stale_records_parallel(self, records):
+        """ Fetch records with update_workers threads, while this thread does all the database writes """
+        workers = int(self.update_workers)
+        self.logger.info("Updating with {} workers".format(workers))
+        db = self.db
+        self.db = QueuedDBInterface(db, self.refresh_local)
+        pending = iter(records)
+        running = set()
+        aborted = False
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="refresh") as executor:
+                while True:
+                    while not aborted and len(running) < workers:
+                        record = next(pending, None)
+                        if record is None:
+                            break
+                        running.add(executor.submit(self._refresh_record, record))
+                    if not running:
+                        break
 
-        self.logger.info("Updated {} items in {} ({:.1f} items/sec)".format(record_count, self.formatter.humanize(
-            time.time() - tstart), record_count / (time.time() - tstart + 0.1)))
+                    done, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        try:
+                            status, outbox = future.result()
+                        except Exception as e:
+                            self.logger.error("Updating record failed: {} {}".format(type(e).__name__, e))
+                            status, outbox = False, []
+                        self._apply_refresh_outbox(outbox)
+                        if not aborted and not self._count_stale_record(status):
+                            aborted = True
+        finally:
+            self.db = db
 
     def check_for_dms(self, coordinate):
         lowercase = coordinate.lower()
@@ -1,5 +1,4 @@
 from harvester.HarvestRepository import HarvestRepository
-import requests
 import re
 
 
@@ -52,7 +51,7 @@ class MarkLogicRepository(HarvestRepository):
                 self.params["start"] = offset
                 paramstring = "requestURL=" + self.query + "%26" + "%26".join(
                     "{}%3D{}".format(k, v) for (k, v) in self.params.items())
-                response = requests.get(self.url, params=paramstring,
+                response = self.http_get(self.url, params=paramstring,
                                         verify=False)  # Needs to be string not dict to force specific urlencoding
                 records = response.json()
                 if not records["results"]:
@@ -60,7 +59,7 @@ class MarkLogicRepository(HarvestRepository):
                 for record in records["results"]:
                     oai_record = self.format_marklogic_to_oai(record)
                     if oai_record:
-                        self.db.write_record(oai_record, self)
+                        self.write_record(oai_record)
                 offset += self.records_per_request
 
             return True
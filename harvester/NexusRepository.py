@@ -1,8 +1,5 @@
 from harvester.HarvestRepository import HarvestRepository
-from harvester.rate_limited import rate_limited
-from dateutil import parser
-import time
-import requests
+from harvester.DateNormalizer import DateNormalizer
 
 
 class NexusRepository(HarvestRepository):
@@ -10,10 +7,24 @@ class NexusRepository(HarvestRepository):
 
     def setRepoParams(self, repoParams):
         self.metadataprefix = "nexus"
+        self.rate_limit_per_second = 5
         super(NexusRepository, self).setRepoParams(repoParams)
         self.domain_metadata = []
         self.headers = {"accept": "application/ld+json"}
 
+    def get_page_request(self, page, state):
+        if page is None:
+            query_url = self.url
+        elif "_next" in page:
+            query_url = page["_next"]
+        else:
+            return None
+        querystring = {"type": "https://schema.org/Dataset"}
+        return {"url": query_url, "params": querystring, "headers": self.headers}
+
+    def get_page_identifiers(self, page, state):
+        return [record["_self"] for record in page["_results"]]
+
     def _crawl(self):
         kwargs = {
             "repo_id": self.repository_id,
@@ -37,28 +48,8 @@ class NexusRepository(HarvestRepository):
         self.repository_id = self.db.update_repo(**kwargs)
 
         try:
-            item_count = 0
-            query_url = self.url
-            while query_url:
-                querystring = {"type": "https://schema.org/Dataset"}
-                response = requests.request("GET", query_url, headers=self.headers, params=querystring)
-                response = response.json()
-
-                for record in response["_results"]:
-                    item_identifier = record["_self"]
-                    self.db.write_header(item_identifier, self.item_url_pattern, self.repository_id)
-                    item_count = item_count + 1
-                    if (item_count % self.update_log_after_numitems == 0):
-                        tdelta = time.time() - self.tstart + 0.1
-                        self.logger.info("Done {} item headers after {} ({:.1f} items/sec)".format(item_count,
-                                                                                                   self.formatter.humanize(
-                                                                                                       tdelta),
-                                                                                                   item_count / tdelta))
-
-                if "_next" in response:
-                    query_url = response["_next"]
-                else:
-                    break
+            item_count = self._crawl_pages()
+            self.delete_unlisted_records()
             self.logger.info("Found {} items in feed".format(item_count))
 
             return True
@@ -195,7 +186,7 @@ class NexusRepository(HarvestRepository):
 
         # Publication date
         if ("_createdAt" in nexus_record) and nexus_record["_createdAt"]:
-            record["pub_date"] = parser.parse(nexus_record["_createdAt"]).strftime('%Y-%m-%d')
+            record["pub_date"] = DateNormalizer.parse(nexus_record["_createdAt"])
 
         # Prefer more specific dates if available
         dates_list = []
@@ -221,7 +212,7 @@ class NexusRepository(HarvestRepository):
                     date_type = date_type.lower().strip()
 
                     try:
-                        date = parser.parse(date).strftime('%Y-%m-%d')
+                        date = DateNormalizer.parse(date)
                         if date_type in ["date created", "release date", "first published", "publication date"]:
                             record["pub_date"] = date
                         elif date_type in ["date modified", "last update date", "conp dats json fileset creation date"]:
@@ -246,13 +237,15 @@ class NexusRepository(HarvestRepository):
                     record["geoplaces"].append({"place_name": place["name"]})
         return record
 
-    @rate_limited(5)
-    def _update_record(self, record):
+    def get_record_request(self, record):
+        return {"url": record['local_identifier'], "headers": self.headers}
+
+    def process_record_response(self, record, response):
         try:
-            identifier = record['local_identifier']
             try:
-                item_response = requests.request("GET", identifier, headers=self.headers)
-                item_response = item_response.json()
+                if isinstance(response, Exception):
+                    raise response
+                item_response = response.json()
             except Exception as e:
                 # Exception means this URL was not found
                 self.db.delete_record(record)
@@ -260,7 +253,7 @@ class NexusRepository(HarvestRepository):
 
             oai_record = self.format_nexus_to_oai(item_response)
             if oai_record:
-                self.db.write_record(oai_record, self)
+                self.write_record(oai_record)
             else:
                 if oai_record is False:
                     # This record is deprecated, remove it from the results
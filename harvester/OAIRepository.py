@@ -1,51 +1,198 @@
-import requests as requests
 from harvester.HarvestRepository import HarvestRepository
-from harvester.rate_limited import rate_limited
+from harvester.DateNormalizer import DateNormalizer
 from sickle import Sickle
+from sickle import oaiexceptions
 from sickle.iterator import BaseOAIIterator
-from sickle.models import OAIItem, Header
+from sickle.models import ResumptionToken
 from sickle.oaiexceptions import IdDoesNotExist
-from collections import defaultdict
-import re
-import dateparser
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from lxml import etree
+import io
 import time
 import json
+import multiprocessing
+import queue
+import threading
 
 
 # import dateparser
 # from time import strftime
 
-class FRDRRecord(OAIItem):
-    """ Override Sickle OAIItem to handle stripping only known namespaces """
-
-    def __init__(self, record_element, strip_ns=False):
-        super(FRDRRecord, self).__init__(record_element, strip_ns=strip_ns)
-        self.header = Header(self.xml.find('.//' + self._oai_namespace + 'header'))
+OAI_NAMESPACE = "{http://www.openarchives.org/OAI/2.0/}"
+FRDR_NAMESPACE = "{https://www.frdr-dfdr.ca/schema/1.0/}"
+DATACITE_NAMESPACE = "{http://datacite.org/schema/kernel-4}"
+XML_LANG = "{http://www.w3.org/XML/1998/namespace}lang"
+
+
+class FRDRHeader(object):
+    """ The parts of an OAI header the harvester uses """
+
+    def __init__(self, header_element):
+        self.deleted = header_element.get("status") == "deleted"
+        self.identifier = None
+        self.datestamp = None
+        self.setSpecs = []
+        for element in header_element:
+            if element.tag == OAI_NAMESPACE + "identifier":
+                self.identifier = element.text
+            elif element.tag == OAI_NAMESPACE + "datestamp":
+                self.datestamp = element.text
+            elif element.tag == OAI_NAMESPACE + "setSpec":
+                self.setSpecs.append(element.text)
+
+
+class FRDRRecord(object):
+    """ An OAI record, mapped to a metadata dict in one pass over its XML, stripping only known namespaces """
+
+    namespaces_to_strip = [
+        'http://purl.org/dc/elements/1.1/',
+        'https://schema.datacite.org/meta/kernel-3/',
+        'http://www.openarchives.org/OAI/2.0/'
+    ]
+    # Element tag -> metadata key, for every tag seen so far
+    tag_keys = {}
+
+    def __init__(self, record_element):
+        self.header = FRDRHeader(record_element.find(OAI_NAMESPACE + "header"))
         self.deleted = self.header.deleted
+        # The creators, affiliations and CRDC codes of an FRDR record, which need more than the element text
+        self.frdr = None
         if not self.deleted:
-            self.metadata = self.xml_to_dict(self.xml.find('.//' + self._oai_namespace + 'metadata').getchildren()[0])
-
-    def xml_to_dict(self, tree, paths=None):
-        """ Modified from Sickle.utils to strip only some namespaces """
-        namespaces_to_strip = [
-            'http://purl.org/dc/elements/1.1/',
-            'https://schema.datacite.org/meta/kernel-3/',
-            'http://www.openarchives.org/OAI/2.0/'
-        ]
-        paths = paths or ['.//']
+            self.metadata = self.xml_to_dict(record_element.find(OAI_NAMESPACE + "metadata")[0])
+
+    @classmethod
+    def tag_key(cls, tag):
+        key = cls.tag_keys.get(tag)
+        if key is None:
+            if tag.startswith("{"):
+                tag_namespace, local_name = tag[1:].split("}", 1)
+                key = local_name if tag_namespace in cls.namespaces_to_strip else tag_namespace + "#" + local_name
+            else:
+                key = tag
+            cls.tag_keys[tag] = key
+        return key
+
+    def xml_to_dict(self, tree):
+        """ The text of every element under tree, by tag; also collects the FRDR details as it goes """
         fields = defaultdict(list)
-        for path in paths:
-            elements = tree.findall(path, {})
-            for element in elements:
-                tag_namespace = re.search('\{(.*)\}', element.tag).group(1)
-                if tag_namespace in namespaces_to_strip:
-                    tag = re.sub(r'\{.*\}', '', element.tag)
-                else:
-                    tag = tag_namespace + "#" + re.sub(r'\{.*\}', '', element.tag)
-                fields[tag].append(element.text)
+        is_frdr = tree.tag == FRDR_NAMESPACE + "frdr"
+        if is_frdr:
+            self.frdr = {"crdc": [], "creators": None, "affiliations": []}
+        crdc_element = crdc_entry = None
+        creator_element = creator_entry = None
+        creators_element = None
+        tag_keys = self.tag_keys
+        for element in tree.iterdescendants():
+            tag = element.tag
+            if not isinstance(tag, str):
+                continue  # Comments and processing instructions
+            key = tag_keys.get(tag)
+            if key is None:
+                key = self.tag_key(tag)
+            fields[key].append(element.text)
+            if not is_frdr:
+                continue
+            parent = element.getparent()
+            if parent is tree:
+                if tag == FRDR_NAMESPACE + "crdc":
+                    crdc_element, crdc_entry = element, {}
+                    self.frdr["crdc"].append(crdc_entry)
+                elif tag == DATACITE_NAMESPACE + "creators" and creators_element is None:
+                    creators_element = element
+                    self.frdr["creators"] = []
+            elif parent is crdc_element:
+                if tag == FRDR_NAMESPACE + "crdcCode":
+                    crdc_entry.setdefault("crdc_code", element.text)
+                elif tag in (FRDR_NAMESPACE + "crdcGroup", FRDR_NAMESPACE + "crdcClass", FRDR_NAMESPACE + "crdcField"):
+                    language = element.get(XML_LANG)
+                    if language in ("en", "fr"):
+                        crdc_entry["crdc_" + tag[len(FRDR_NAMESPACE) + 4:].lower() + "_" + language] = element.text
+            elif parent is creators_element:
+                creator_element, creator_entry = element, {}
+                self.frdr["creators"].append(creator_entry)
+            elif parent is creator_element:
+                if tag in (DATACITE_NAMESPACE + "creatorName", DATACITE_NAMESPACE + "nameIdentifier"):
+                    creator_entry.setdefault(tag, element.text)
+                elif tag == DATACITE_NAMESPACE + "affiliation":
+                    if element.get("affiliationIdentifier"):
+                        self.frdr["affiliations"].append({"affiliation_name": element.text.strip(),
+                                                          "affiliation_ror": element.get("affiliationIdentifier")})
+                    else:
+                        self.frdr["affiliations"].append(element.text.strip())
+        if is_frdr and self.frdr["creators"] is not None:
+            creators = []
+            for creator_entry in self.frdr["creators"]:
+                if DATACITE_NAMESPACE + "creatorName" in creator_entry and DATACITE_NAMESPACE + "nameIdentifier" in creator_entry:
+                    creators.append({"name": creator_entry[DATACITE_NAMESPACE + "creatorName"],
+                                     "orcid": creator_entry[DATACITE_NAMESPACE + "nameIdentifier"]})
+                elif DATACITE_NAMESPACE + "creatorName" in creator_entry:
+                    creators.append(creator_entry[DATACITE_NAMESPACE + "creatorName"])
+            self.frdr["creators"] = creators
         return dict(fields)
 
 
+def parse_oai_response(content, element_tag=OAI_NAMESPACE + "record"):
+    """ Stream an OAI-PMH response with iterparse, mapping each record as soon as it has been read and then
+    discarding its XML, so a page never needs more than one record in memory as a tree. Returns the mapped records
+    (or the exception a record raised, in its place), the resumption token and any OAI error as (code, text) """
+    items = []
+    resumption_token = None
+    error = None
+    context = etree.iterparse(io.BytesIO(content), events=("end",), remove_blank_text=True, recover=True,
+                              resolve_entities=False,
+                              tag=(element_tag, OAI_NAMESPACE + "resumptionToken", OAI_NAMESPACE + "error"))
+    for event, element in context:
+        if element.tag == element_tag:
+            try:
+                items.append(FRDRRecord(element))
+            except Exception as e:
+                items.append(e)
+        elif element.tag == OAI_NAMESPACE + "resumptionToken":
+            resumption_token = ResumptionToken(token=element.text, cursor=element.get("cursor"),
+                                               complete_list_size=element.get("completeListSize"),
+                                               expiration_date=element.get("expirationDate"))
+        elif element.tag == OAI_NAMESPACE + "error":
+            error = (element.get("code", "UNKNOWN"), element.text or "")
+        element.clear(keep_tail=True)
+        # Drop the records already mapped
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+    return items, resumption_token, error
+
+
+def read_resumption_token(content):
+    """ Just the resumption token of an OAI-PMH response, without mapping its records, so the next page can be
+    requested while this one is still being parsed """
+    context = etree.iterparse(io.BytesIO(content), events=("end",), recover=True, resolve_entities=False,
+                              tag=OAI_NAMESPACE + "resumptionToken")
+    for event, element in context:
+        return element.text
+    return None
+
+
+def raise_oai_error(error):
+    """ Raise the sickle exception for an OAI error (code, text) returned by parse_oai_response() """
+    code, description = error
+    try:
+        raise getattr(oaiexceptions, code[0].upper() + code[1:])(description)
+    except AttributeError:
+        raise oaiexceptions.OAIError(description)
+
+
+class FRDRSickle(Sickle):
+    """ Override Sickle to send its requests through the shared connection pool """
+
+    def __init__(self, endpoint, http_client, **kwargs):
+        self.http_client = http_client
+        super(FRDRSickle, self).__init__(endpoint, **kwargs)
+
+    def _request(self, kwargs):
+        if self.http_method == 'GET':
+            return self.http_client.request("GET", self.endpoint, params=kwargs, **self.request_args)
+        return self.http_client.request("POST", self.endpoint, data=kwargs, **self.request_args)
+
+
 class FRDRItemIterator(BaseOAIIterator):
     """ Modifed from Sickle.interator.OAIItemIterator to implement custom item mapping """
 
@@ -63,34 +210,57 @@ class FRDRItemIterator(BaseOAIIterator):
         super(FRDRItemIterator, self).__init__(sickle, params, ignore_deleted)
 
     def _next_response(self):
-        super(FRDRItemIterator, self)._next_response()
-        self._items = self.oai_response.xml.iterfind('.//' + self.sickle.oai_namespace + self.element)
+        """ Get the next page, mapping its records while it is parsed """
+        if self.element != "record":
+            super(FRDRItemIterator, self)._next_response()
+            self._items = self.oai_response.xml.iterfind('.//' + self.sickle.oai_namespace + self.element)
+            return
+        params = self.params
+        if self.resumption_token:
+            params = {'resumptionToken': self.resumption_token.token, 'verb': self.verb}
+        self.oai_response = self.sickle.harvest(**params)
+        items, self.resumption_token, error = parse_oai_response(self.oai_response.http_response.content)
+        if error is not None:
+            raise_oai_error(error)
+        self._items = iter(items)
 
     def next(self):
         """Return the next record/header/set."""
+        # Whether the exception raised (if any) is only about one record, rather than the page it was on
+        self.record_error = False
         while True:
             for item in self._items:
-                mapped = self.mapper(item)
-                if self.ignore_deleted and mapped.deleted:
+                if isinstance(item, Exception):
+                    # The record could not be mapped
+                    self.record_error = True
+                    raise item
+                if self.element != "record":
+                    item = self.mapper(item)
+                if self.ignore_deleted and item.deleted:
                     continue
-                return mapped
+                return item
             if self.resumption_token and self.resumption_token.token:
                 self._next_response()
             else:
                 raise StopIteration
 
 
-def get_frdr_filenames(base_url):
+def get_frdr_file_listing(base_url, http_client):
+    """ The parsed file_sizes_perm.json of an FRDR dataset, which has both its file names and total size """
     if base_url == "":
-        return ""
+        return None
     full_url = base_url + "file_sizes_perm.json?download=0"
-    session = requests.Session()
-    session.headers.update({'referer': full_url})
-    file = session.get(full_url)
+    file = http_client.get(full_url, headers={'referer': full_url})
     file_text = file.text
     try:
-        data = json.loads(file_text)
-        files = data["contents"]
+        return json.loads(file_text)
+    except Exception as e:
+        return None
+
+
+def get_frdr_filenames(file_listing):
+    try:
+        files = file_listing["contents"]
         file_names = []
         for f in files:
             file_names.append(f["name"])
@@ -99,17 +269,9 @@ def get_frdr_filenames(base_url):
         return ""
 
 
-def get_frdr_files_size(base_url):
-    if base_url == "":
-        return 0
-    full_url = base_url + "file_sizes_perm.json?download=0"
-    session = requests.Session()
-    session.headers.update({'referer': full_url})
-    file = session.get(full_url)
-    file_text = file.text
+def get_frdr_files_size(file_listing):
     try:
-        data = json.loads(file_text)
-        return data["size"]
+        return file_listing["size"]
     except Exception as e:
         return 0
 
@@ -119,21 +281,45 @@ class OAIRepository(HarvestRepository):
 
     def setRepoParams(self, repoParams):
         self.metadataprefix = "oai_dc"
+        self.rate_limit_per_second = 5
         self.oai_identifier_field = "identifier"
         self.default_language = "en"
         super(OAIRepository, self).setRepoParams(repoParams)
-        self.sickle = Sickle(self.url, iterator=FRDRItemIterator)
-
-    def _crawl(self):
-        records = []
+        self.sickle = FRDRSickle(self.url, self.http_client, iterator=FRDRItemIterator, timeout=float(self.http_timeout))
 
+    def get_oai_granularity(self):
+        """ Ask the repository (via Identify) whether it supports datestamps with seconds or only days """
         try:
-            if self.set is None or self.set == "":
-                records = self.sickle.ListRecords(metadataPrefix=self.metadataprefix, ignore_deleted=True)
-            else:
-                records = self.sickle.ListRecords(metadataPrefix=self.metadataprefix, ignore_deleted=True, set=self.set)
+            granularity = self.sickle.Identify().granularity
+            if granularity == "YYYY-MM-DDThh:mm:ssZ":
+                return granularity
         except Exception as e:
-            self.logger.info("No items were found")
+            self.logger.debug("Identify failed for {}, using day granularity: {}".format(self.url, e))
+        return "YYYY-MM-DD"
+
+    def get_oai_from_datestamp(self):
+        """ The from= datestamp for an incremental harvest, or None if the whole repository should be harvested """
+        if self.full_resync:
+            return None
+        # Not the last crawl, which is set when a crawl starts even if it then fails part way
+        last_listing = self.db.get_repo_last_complete_listing(self.repository_id)
+        if not last_listing:
+            return None
+        from_timestamp = last_listing - float(self.incremental_overlap_hours) * 3600
+        if self.get_oai_granularity() == "YYYY-MM-DDThh:mm:ssZ":
+            return time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(from_timestamp))
+        return time.strftime("%Y-%m-%d", time.gmtime(from_timestamp))
+
+    def _crawl(self):
+        list_kwargs = {"metadataPrefix": self.metadataprefix, "ignore_deleted": False}
+        if self.set is not None and self.set != "":
+            list_kwargs["set"] = self.set
+        from_datestamp = self.get_oai_from_datestamp()
+        if from_datestamp:
+            list_kwargs["from"] = from_datestamp
+            self.logger.info("Harvesting items changed since {}".format(from_datestamp))
+        else:
+            self.logger.info("Harvesting all items")
 
         kwargs = {
             "repo_id": self.repository_id,
@@ -155,65 +341,228 @@ class OAIRepository(HarvestRepository):
             "repo_registry_uri": self.repo_registry_uri
         }
         self.repository_id = self.db.update_repo(**kwargs)
+
+        listing_started = time.time()
+        if int(self.oai_record_workers) > 1 or int(self.oai_parse_processes) > 0:
+            self._crawl_pipelined(list_kwargs)
+        else:
+            self._crawl_serial(list_kwargs)
+
+        # Only now is every item changed since from= in the database, so the next crawl can start from here
+        self.flush_records()
+        self.db.update_last_complete_listing(self.repository_id, listing_started)
+
+    def _crawl_serial(self, list_kwargs):
+        records = []
+        try:
+            records = self.sickle.ListRecords(**list_kwargs)
+        except oaiexceptions.NoRecordsMatch:
+            self.logger.info("No items were found")
+
         item_count = 0
 
         while records:
             try:
                 record = records.next()
-                metadata = record.metadata
-
-                # EPrints workaround for using header datestamp in lieu of date
-                if "date" not in metadata and record.header.datestamp:
-                    metadata["date"] = record.header.datestamp
-
-                # Use the header id for the database key (needed later for OAI GetRecord calls)
-                metadata["local_identifier"] = record.header.identifier
-                if "oai:https://" in metadata["local_identifier"]:
-                    metadata["local_identifier"] = metadata["local_identifier"].replace("oai:https://", "oai:")
-
-                # Search for a hyperlink in the list of identifiers; use the first hyperlink but prefer DOIs
-                metadata["item_url"] = None
-                if self.item_url_pattern is not None:
-                        metadata["item_url_pattern"] = self.item_url_pattern
-                        metadata["item_url"] = self.db.construct_local_url(metadata)
-                elif self.oai_identifier_field in metadata:
-                    searchlist = metadata[self.oai_identifier_field]
-                    if not isinstance(searchlist, list):
-                        searchlist = [searchlist]
-                    for idt in searchlist:
-                        if metadata["item_url"] is None or "doi" in idt:
-                            if idt.lower().startswith("http"):
-                                metadata["item_url"] = idt
-                            if idt.lower().startswith("doi:"):
-                                metadata["item_url"] = "https://doi.org/" + idt[4:]
-                            if idt.lower().startswith("hdl:"):
-                                metadata["item_url"] = "https://hdl.handle.net/" + idt[4:]
-
-                metadata["identifier"] = metadata["local_identifier"]
-
-                oai_record = self.unpack_oai_metadata(metadata, record.xml)
-                self.domain_metadata = self.find_domain_metadata(metadata)
-                print("Writing local_id=" + metadata["local_identifier"] + " id=" + metadata["identifier"] + " url=" + metadata["item_url"])
-                self.db.write_record(oai_record, self)
+            except StopIteration:
+                break
+            except Exception as e:
+                if not records.record_error:
+                    # The next page could not be fetched, so the listing is incomplete
+                    raise
+                self.logger.debug("Exception while working on item {}: {} {}".format(item_count, type(e).__name__, e))
+                continue
+
+            try:
+                if record.deleted:
+                    self.delete_oai_record(record.header.identifier)
+                    continue
+                metadata, oai_record, self.domain_metadata = self._map_oai_record(record)
+                self.logger.debug("Writing local_id={} id={} url={}".format(
+                    metadata["local_identifier"], metadata["identifier"], metadata["item_url"]))
+                self.write_record(oai_record)
                 item_count = item_count + 1
-                if (item_count % self.update_log_after_numitems == 0):
-                    tdelta = time.time() - self.tstart + 0.1
-                    self.logger.info(
-                        "Done {} items after {} ({:.1f} items/sec)".format(item_count, self.formatter.humanize(tdelta),
-                                                                           (item_count / tdelta)))
+                self._log_oai_progress(item_count)
 
             except AttributeError:
                 self.logger.debug("AttributeError while working on item {}".format(item_count))
 
-            except StopIteration:
-                break
-
             except Exception as e:
                 self.logger.debug("Exception while working on item {}: {} {}".format(item_count, type(e).__name__, e))
 
         self.logger.info("Processed {} items in feed".format(item_count))
 
-    def unpack_oai_metadata(self, record, record_xml):
+    def _log_oai_progress(self, item_count):
+        if (item_count % self.update_log_after_numitems == 0):
+            tdelta = time.time() - self.tstart + 0.1
+            self.logger.info(
+                "Done {} items after {} ({:.1f} items/sec)".format(item_count, self.formatter.humanize(tdelta),
+                                                                   (item_count / tdelta)))
+
+    def _map_oai_record(self, record):
+        """ The metadata, mapped record and domain metadata for an OAI record that is not deleted """
+        metadata = record.metadata
+
+        # EPrints workaround for using header datestamp in lieu of date
+        if "date" not in metadata and record.header.datestamp:
+            metadata["date"] = record.header.datestamp
+
+        # Use the header id for the database key (needed later for OAI GetRecord calls)
+        metadata["local_identifier"] = record.header.identifier
+        if "oai:https://" in metadata["local_identifier"]:
+            metadata["local_identifier"] = metadata["local_identifier"].replace("oai:https://", "oai:")
+
+        # Search for a hyperlink in the list of identifiers; use the first hyperlink but prefer DOIs
+        metadata["item_url"] = None
+        if self.item_url_pattern is not None:
+                metadata["item_url_pattern"] = self.item_url_pattern
+                metadata["item_url"] = self.db.construct_local_url(metadata)
+        elif self.oai_identifier_field in metadata:
+            searchlist = metadata[self.oai_identifier_field]
+            if not isinstance(searchlist, list):
+                searchlist = [searchlist]
+            for idt in searchlist:
+                if metadata["item_url"] is None or "doi" in idt:
+                    if idt.lower().startswith("http"):
+                        metadata["item_url"] = idt
+                    if idt.lower().startswith("doi:"):
+                        metadata["item_url"] = "https://doi.org/" + idt[4:]
+                    if idt.lower().startswith("hdl:"):
+                        metadata["item_url"] = "https://hdl.handle.net/" + idt[4:]
+
+        metadata["identifier"] = metadata["local_identifier"]
+
+        oai_record = self.unpack_oai_metadata(metadata, record.frdr)
+        return metadata, oai_record, self.find_domain_metadata(metadata)
+
+    def _crawl_pipelined(self, list_kwargs):
+        """ Crawl in stages: one thread fetches the pages (with up to oai_parse_processes of them being parsed in
+        other processes, if set), oai_record_workers threads map the records and look up their FRDR files, and this
+        thread writes them, in the order the repository listed them """
+        workers = max(int(self.oai_record_workers), 1)
+        if int(self.oai_parse_processes) > 0:
+            self.logger.info("Harvesting with {} record workers, parsing up to {} pages at a time in other "
+                             "processes".format(workers, int(self.oai_parse_processes)))
+        else:
+            self.logger.info("Harvesting with {} record workers, parsing each page as it is fetched".format(workers))
+        # A page or two ahead of the writer is enough to keep the workers busy
+        pages = queue.Queue(maxsize=2)
+        stop = threading.Event()
+        fetcher = threading.Thread(target=self._fetch_oai_pages, args=(list_kwargs, pages, stop),
+                                   name="oai-pages", daemon=True)
+        pending = deque()
+        page_count = 0
+        item_count = 0
+        fetcher.start()
+        try:
+            with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="oai-records") as executor:
+                while True:
+                    page = pages.get()
+                    if page is None:
+                        break
+                    if isinstance(page, Exception):
+                        if page_count == 0 and isinstance(page, oaiexceptions.NoRecordsMatch):
+                            self.logger.info("No items were found")
+                            break
+                        # Write what was mapped before the listing failed, then fail the crawl
+                        while pending:
+                            item_count = self._write_oai_result(pending.popleft(), item_count)
+                        raise page
+                    page_count = page_count + 1
+                    for record in page:
+                        if isinstance(record, Exception) or record.deleted:
+                            pending.append(record)
+                        else:
+                            pending.append(executor.submit(self._map_oai_record_in_worker, record))
+                        while len(pending) >= workers * 4:
+                            item_count = self._write_oai_result(pending.popleft(), item_count)
+                while pending:
+                    item_count = self._write_oai_result(pending.popleft(), item_count)
+        finally:
+            stop.set()
+
+        self.logger.info("Processed {} items in feed".format(item_count))
+
+    def _fetch_oai_pages(self, list_kwargs, pages, stop):
+        """ The page stage: fetch and parse each ListRecords page, then the end of the list (None) or the exception
+        that stopped it """
+        with self.metrics.repository(self.name):
+            parse_pool = None
+            processes = int(self.oai_parse_processes)
+            parsing = deque()
+            try:
+                if processes > 0:
+                    # Spawned rather than forked, as the harvest has other threads (and connections) open
+                    parse_pool = ProcessPoolExecutor(max_workers=processes,
+                                                     mp_context=multiprocessing.get_context("spawn"))
+                params = {key: value for key, value in list_kwargs.items() if key != "ignore_deleted"}
+                params["verb"] = "ListRecords"
+                while not stop.is_set():
+                    response = self.sickle.harvest(**params)
+                    content = response.http_response.content
+                    if parse_pool is None:
+                        items, resumption_token, error = parse_oai_response(content)
+                        if not self._put_oai_page(pages, stop, items, error):
+                            return
+                        token = resumption_token.token if resumption_token else None
+                    else:
+                        # Only the resumption token is needed to ask for the next page, so the pool parses up to
+                        # oai_parse_processes pages at once while the next ones are fetched; they are handed on in order
+                        parsing.append(parse_pool.submit(parse_oai_response, content))
+                        token = read_resumption_token(content)
+                        while parsing and (len(parsing) >= processes or not token):
+                            items, resumption_token, error = parsing.popleft().result()
+                            if not self._put_oai_page(pages, stop, items, error):
+                                return
+                    if not token:
+                        break
+                    params = {"resumptionToken": token, "verb": "ListRecords"}
+                self._put_oai_page(pages, stop, None)
+            except Exception as e:
+                self._put_oai_page(pages, stop, e)
+            finally:
+                if parse_pool is not None:
+                    parse_pool.shutdown()
+
+    def _put_oai_page(self, pages, stop, page, error=None):
+        """ Hand a parsed page to the writer, raising its OAI error if it has one; waits for room in the queue,
+        unless the writer has stopped, and returns False if it has """
+        if error is not None:
+            raise_oai_error(error)
+        while not stop.is_set():
+            try:
+                pages.put(page, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _map_oai_record_in_worker(self, record):
+        with self.metrics.repository(self.name):
+            return self._parse_record(self._map_oai_record, record)
+
+    def _write_oai_result(self, result, item_count):
+        """ The writer stage: delete or write one record, once its worker is done with it """
+        try:
+            if isinstance(result, Exception):
+                # The record could not be mapped
+                raise result
+            if isinstance(result, FRDRRecord):
+                # Only deleted records skip the workers
+                self.delete_oai_record(result.header.identifier)
+                return item_count
+            metadata, oai_record, domain_metadata = result.result()
+            self.logger.debug("Writing local_id={} id={} url={}".format(
+                metadata["local_identifier"], metadata["identifier"], metadata["item_url"]))
+            self.write_record(oai_record, domain_metadata)
+        except Exception as e:
+            self.logger.debug("Exception while working on item {}: {} {}".format(item_count, type(e).__name__, e))
+            return item_count
+        item_count = item_count + 1
+        self._log_oai_progress(item_count)
+        return item_count
+
+    def unpack_oai_metadata(self, record, frdr_details=None):
         record["pub_date"] = record.get("date")
 
         if self.metadataprefix.lower() == "ddi":
@@ -255,51 +604,17 @@ class OAIRepository(HarvestRepository):
 
         # Parse FRDR records
         if self.metadataprefix.lower() == "frdr":
-            frdr_xml = record_xml.find("{http://www.openarchives.org/OAI/2.0/}metadata").find("{https://www.frdr-dfdr.ca/schema/1.0/}frdr")
-
-            # Add CRDC from full XML
-            record["crdc"] = []
-            for crdc_xml in frdr_xml.findall("{https://www.frdr-dfdr.ca/schema/1.0/}crdc"):
-                crdc_entry = {}
-                crdc_entry["crdc_code"] = crdc_xml.find("{https://www.frdr-dfdr.ca/schema/1.0/}crdcCode").text
-                for crdc_group in crdc_xml.findall("{https://www.frdr-dfdr.ca/schema/1.0/}crdcGroup"):
-                    if crdc_group.get("{http://www.w3.org/XML/1998/namespace}lang") == "en":
-                        crdc_entry["crdc_group_en"] = crdc_group.text
-                    elif crdc_group.get("{http://www.w3.org/XML/1998/namespace}lang") == "fr":
-                        crdc_entry["crdc_group_fr"] = crdc_group.text
-                for crdc_class in crdc_xml.findall("{https://www.frdr-dfdr.ca/schema/1.0/}crdcClass"):
-                    if crdc_class.get("{http://www.w3.org/XML/1998/namespace}lang") == "en":
-                        crdc_entry["crdc_class_en"] = crdc_class.text
-                    elif crdc_class.get("{http://www.w3.org/XML/1998/namespace}lang") == "fr":
-                        crdc_entry["crdc_class_fr"] = crdc_class.text
-                for crdc_field in crdc_xml.findall("{https://www.frdr-dfdr.ca/schema/1.0/}crdcField"):
-                    if crdc_field.get("{http://www.w3.org/XML/1998/namespace}lang") == "en":
-                        crdc_entry["crdc_field_en"] = crdc_field.text
-                    elif crdc_field.get("{http://www.w3.org/XML/1998/namespace}lang") == "fr":
-                        crdc_entry["crdc_field_fr"] = crdc_field.text
-                record["crdc"].append(crdc_entry)
+            if frdr_details is None or frdr_details["creators"] is None:
+                # Not an FRDR record, or one without a creators element
+                return None
+
+            # Add CRDC, creators and affiliations, collected from the full XML when the record was parsed
+            record["crdc"] = [dict(crdc_entry) for crdc_entry in frdr_details["crdc"]]
             if len(record["crdc"]) == 0:
                 record.pop("crdc")
-
-            # Add creators and affiliations from full XML
-            record["creator"] = []
-            record["affiliation"] = []
-
-            if len(frdr_xml.find("{http://datacite.org/schema/kernel-4}creators")) > 0:
-                for creator_xml in list(frdr_xml.find("{http://datacite.org/schema/kernel-4}creators")):
-                    creator_name = creator_xml.find("{http://datacite.org/schema/kernel-4}creatorName")
-                    creator_orcid = creator_xml.find("{http://datacite.org/schema/kernel-4}nameIdentifier")
-                    if creator_name is not None and creator_orcid is not None:
-                        record["creator"].append({"name":creator_name.text, "orcid":creator_orcid.text})
-                    elif creator_name is not None:
-                        record["creator"].append(creator_name.text)
-                    for affiliation_xml in creator_xml.findall("{http://datacite.org/schema/kernel-4}affiliation"):
-                        # This is currently per-record affiliation, not per-author
-                        if affiliation_xml.get("affiliationIdentifier"):
-                            record["affiliation"].append({"affiliation_name": affiliation_xml.text.strip(),
-                                                          "affiliation_ror": affiliation_xml.get("affiliationIdentifier")})
-                        else:
-                            record["affiliation"].append(affiliation_xml.text.strip())
+            record["creator"] = list(frdr_details["creators"] or [])
+            # This is currently per-record affiliation, not per-author
+            record["affiliation"] = list(frdr_details["affiliations"])
 
             if "dateissued" in record:
                 record["pub_date"] = record["dateissued"]
@@ -357,9 +672,19 @@ class OAIRepository(HarvestRepository):
                 endpoint_hostname = "https://" + endpoint_hostname
             endpoint_path = record.get("https://www.frdr-dfdr.ca/schema/1.0/#globusEndpointPath", [""])[0]
 
+            # The sizes and the names of the files come from the same listing, so it is only fetched once
+            file_listing = None
+            file_listing_error = None
+            try:
+                file_listing = get_frdr_file_listing(endpoint_hostname + endpoint_path, self.http_client)
+            except Exception as e:
+                file_listing_error = e
+
             # Get all File sizes
             try:
-                sizes = get_frdr_files_size(endpoint_hostname + endpoint_path)
+                if file_listing_error is not None:
+                    raise file_listing_error
+                sizes = get_frdr_files_size(file_listing)
                 if not record.get("files_size") == sizes:
                     record["files_altered"] = 1
                     record["files_size"] = sizes
@@ -377,7 +702,9 @@ class OAIRepository(HarvestRepository):
             # Get geospatial files
             if "geodisy_harvested" not in record or record["geodisy_harvested"] == 0:
                 try:
-                    filenames = get_frdr_filenames(endpoint_hostname + endpoint_path)
+                    if file_listing_error is not None:
+                        raise file_listing_error
+                    filenames = get_frdr_filenames(file_listing)
                     # Get File Download URLs
                     for f in filenames:
                         file_segments = len(f.split("."))
@@ -450,14 +777,11 @@ class OAIRepository(HarvestRepository):
         if "?" in record["pub_date"]:
             return None
 
-        try:
-            date_object = dateparser.parse(record["pub_date"])
-            if date_object is None:
-                date_object = dateparser.parse(record["pub_date"], date_formats=["%Y%m%d"])
-            record["pub_date"] = date_object.strftime("%Y-%m-%d")
-        except Exception as e:
+        pub_date = DateNormalizer.normalize(record["pub_date"])
+        if pub_date is None:
             self.logger.error("Something went wrong parsing the date, {} from {}".format(record["pub_date"], record["local_identifier"]))
             return None
+        record["pub_date"] = pub_date
 
         if "title" not in record:
             return None
@@ -528,6 +852,16 @@ class OAIRepository(HarvestRepository):
 
         return record
 
+    def delete_oai_record(self, identifier):
+        """ Mark a record as deleted when the repository sends a deleted header for it """
+        if "oai:https://" in identifier:
+            identifier = identifier.replace("oai:https://", "oai:")
+        # The record may still be waiting to be written, if it was first listed earlier in this crawl
+        self.flush_records()
+        record_uuid = self.db.get_single_record_id("records", identifier, "and repository_id=" + str(self.repository_id))
+        if record_uuid is not None:
+            self.db.delete_record({self.db.get_table_id_column("records"): record_uuid, "local_identifier": identifier})
+
     def find_domain_metadata(self, record):
         # Exclude fundingReference and nameIdentifier; need a way to group linked fields in display first
         excludedElements = ["http://datacite.org/schema/kernel-4#resourcetype",
@@ -562,7 +896,6 @@ class OAIRepository(HarvestRepository):
                     newRecord[elementName] = record.pop(elementName, None)
         return newRecord
 
-    @rate_limited(5)
     def _update_record(self, record):
         #self.logger.debug("Updating OAI record {} {}".format(record["local_identifier"], record["item_url"]))
 
@@ -587,12 +920,13 @@ class OAIRepository(HarvestRepository):
             metadata["geodisy_harvested"] = 0
             if "fizes_size" in record:
                 metadata["fizes_size"] = record["fizes_size"]
-            oai_record = self.unpack_oai_metadata(metadata, single_record.xml)
-            self.domain_metadata = self.find_domain_metadata(metadata)
+            oai_record = self.unpack_oai_metadata(metadata, single_record.frdr)
+            # Refresh workers share this object, so the domain metadata goes along with the record
+            domain_metadata = self.find_domain_metadata(metadata)
             if oai_record is None:
                 self.db.delete_record(record)
                 return False
-            self.db.write_record(oai_record, self)
+            self.write_record(oai_record, domain_metadata)
             return True
 
         except IdDoesNotExist:
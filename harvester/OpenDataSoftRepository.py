@@ -1,9 +1,7 @@
 from harvester.HarvestRepository import HarvestRepository
-import requests
-import time
 import json
 import re
-from dateutil import parser
+from harvester.DateNormalizer import DateNormalizer
 
 
 class OpenDataSoftRepository(HarvestRepository):
@@ -26,6 +24,19 @@ class OpenDataSoftRepository(HarvestRepository):
             options = re.sub("[^a-zA-Z0-9_-]+", "", repoParams["options"])  # Remove potentially bad chars
             self.params["options"] = options
 
+    def get_page_request(self, page, state):
+        if page is None:
+            self.params["start"] = 0
+        elif not page["datasets"]:
+            return None
+        else:
+            self.params["start"] += self.records_per_request
+        payload = {"rows": self.records_per_request, "start": self.params["start"]}
+        return {"url": self.url, "params": payload, "verify": False}
+
+    def get_page_identifiers(self, page, state):
+        return [record["datasetid"] for record in page["datasets"]]
+
     def _crawl(self):
         kwargs = {
             "repo_id": self.repository_id,
@@ -49,25 +60,7 @@ class OpenDataSoftRepository(HarvestRepository):
         self.repository_id = self.db.update_repo(**kwargs)
 
         try:
-            offset = 0
-            item_count = 0
-            while True:
-                self.params["start"] = offset
-                payload = {"rows": self.records_per_request, "start": self.params["start"]}
-                response = requests.get(self.url, params=payload,
-                                        verify=False)  # Needs to be string not dict to force specific urlencoding
-                records = response.json()
-                if not records["datasets"]:
-                    break
-                for record in records["datasets"]:
-                    item_identifier = record["datasetid"]
-                    self.db.write_header(item_identifier, self.item_url_pattern, self.repository_id)
-                    item_count = item_count + 1
-                    if (item_count % self.update_log_after_numitems == 0):
-                        tdelta = time.time() - self.tstart + 0.1
-                        self.logger.info("Done {} item headers after {} ({:.1f} items/sec)".format(
-                            item_count,self.formatter.humanize(tdelta),item_count / tdelta))
-                offset += self.records_per_request
+            item_count = self._crawl_pages()
             self.logger.info("Found {} items in feed".format(item_count))
 
             return True
@@ -83,7 +76,7 @@ class OpenDataSoftRepository(HarvestRepository):
     def format_opendatasoft_to_oai(self, opendatasoft_record):
         record = {}
         record["identifier"] = opendatasoft_record["datasetid"]
-        record["pub_date"] = parser.parse(opendatasoft_record["metas"]["modified"]).strftime('%Y-%m-%d')
+        record["pub_date"] = DateNormalizer.parse(opendatasoft_record["metas"]["modified"])
         record["title"] = opendatasoft_record["metas"]["title"]
         record["description"] = opendatasoft_record["metas"].get("description", "")
         record["publisher"] = opendatasoft_record["metas"].get("publisher", "")
@@ -125,19 +118,22 @@ class OpenDataSoftRepository(HarvestRepository):
 
         return record
 
-    def _update_record(self, record):
+    def get_record_request(self, record):
+        return {"url": self.url.replace("search", "") + record['local_identifier']}
+
+    def process_record_response(self, record, response):
         try:
-            record_url = self.url.replace("search", "") + record['local_identifier']
             try:
-                item_response = requests.get(record_url)
-                opendatasoft_record = json.loads(item_response.text)
+                if isinstance(response, Exception):
+                    raise response
+                opendatasoft_record = json.loads(response.text)
             except Exception as e:
                 # Exception means this URL was not found
                 self.db.delete_record(record)
                 return True
             oai_record = self.format_opendatasoft_to_oai(opendatasoft_record)
             if oai_record:
-                self.db.write_record(oai_record, self)
+                self.write_record(oai_record)
             return True
         except Exception as e:
             self.logger.error("Updating record {} failed: {} {}".format(record['local_identifier'], type(e).__name__, e))
@@ -0,0 +1,196 @@
+import re
+import unicodedata
+from collections import defaultdict
+from math import log
+
+
+class RORMatcher(object):
+    """ Matches affiliation strings to ROR organizations offline, through an inverted index of the ROR names """
+
+    # Words that say nothing about which organization is meant
+    stopwords = {"a", "an", "and", "at", "d", "de", "del", "der", "des", "di", "die", "du", "en", "et", "for", "fur",
+                 "in", "l", "la", "le", "les", "of", "on", "the", "und", "y"}
+
+    # Common ways of naming a country that are not the ROR country name
+    country_aliases = {"usa": "US", "u s a": "US", "us": "US", "united states of america": "US", "uk": "GB",
+                       "u k": "GB", "england": "GB", "scotland": "GB", "wales": "GB", "northern ireland": "GB"}
+
+    # Abbreviations, and spellings that mean the same word
+    abbreviations = {"univ": "university", "inst": "institute", "natl": "national", "intl": "international",
+                     "dept": "department", "hosp": "hospital", "coll": "college", "lab": "laboratory",
+                     "labs": "laboratory", "laboratories": "laboratory", "center": "centre", "ctr": "centre"}
+
+    # An affiliation part that is written like an acronym
+    acronym_pattern = re.compile(r"^[A-Z][A-Z0-9&\-]{1,9}$")
+    # Where an affiliation string is split into parts, such as department, institution, city and country
+    separator_pattern = re.compile(r"[,;|()\[\]\n]+|\s+-\s+")
+    non_word_pattern = re.compile(r"[\W_]+")
+
+    def __init__(self, ror_data, params=None):
+        params = params or {}
+        self.min_score = float(params.get("ror_match_min_score", 0.85))
+        # Names that only share words more common than this are not worth scoring
+        self.max_postings = int(params.get("ror_match_max_postings", 2000))
+        self.candidates_per_part = 100
+        self.acronym_score = 0.9
+        self.country_penalty = 0.9
+        self.ambiguity_penalty = 0.8
+
+        self.organizations = []  # (ror_id, country_code)
+        self.names = []  # (organization index, name tokens, name weight)
+        self.postings = defaultdict(list)  # token -> indexes of the names that contain it
+        self.exact_names = defaultdict(set)  # normalized name -> organization indexes
+        self.acronyms = defaultdict(set)  # acronym -> organization indexes
+        self.countries = dict(self.country_aliases)  # normalized country name -> country code
+        self.idf = {}
+        self._build_index(ror_data)
+
+    @classmethod
+    def normalize(cls, text):
+        """ Lower case, without accents and punctuation """
+        text = unicodedata.normalize("NFKD", text)
+        text = "".join(c for c in text if not unicodedata.combining(c))
+        return cls.non_word_pattern.sub(" ", text.lower().replace("&", " and ")).strip()
+
+    @classmethod
+    def tokenize(cls, text):
+        return [cls.abbreviations.get(token, token) for token in cls.normalize(text).split()
+                if token not in cls.stopwords]
+
+    def _build_index(self, ror_data):
+        organization_indexes = {}
+        tokens_seen = {}
+        for ror_id, name, name_type, country_code in ror_data.iter_names():
+            if ror_id not in organization_indexes:
+                organization_indexes[ror_id] = len(self.organizations)
+                self.organizations.append((ror_id, country_code))
+            organization_index = organization_indexes[ror_id]
+            if name_type == "acronym":
+                self.acronyms[name.strip()].add(organization_index)
+                continue
+            # One copy of each token string, however many names use it
+            tokens = tuple(dict.fromkeys(tokens_seen.setdefault(token, token) for token in self.tokenize(name)))
+            if not tokens:
+                continue
+            name_index = len(self.names)
+            self.names.append((organization_index, tokens))
+            self.exact_names[" ".join(tokens)].add(organization_index)
+            for token in tokens:
+                self.postings[token].append(name_index)
+        for country_name, country_code in ror_data.countries().items():
+            self.countries.setdefault(self.normalize(country_name), country_code)
+
+        name_count = max(len(self.names), 1)
+        self.idf = {token: log(1 + name_count / len(name_indexes)) for token, name_indexes in self.postings.items()}
+        # A word that is in no ROR name weighs as much as the rarest one
+        self.unknown_idf = log(1 + name_count)
+        self.names = [(organization_index, tokens, self._weight(tokens))
+                      for organization_index, tokens in self.names]
+
+    def _weight(self, tokens):
+        return sum(self.idf.get(token, self.unknown_idf) for token in tokens)
+
+    def _parts(self, affiliation):
+        """ Each part of the affiliation, and runs of up to three neighbouring parts, so that names containing a
+        separator (such as "University of California, Berkeley") can still match whole """
+        parts = [part.strip() for part in self.separator_pattern.split(affiliation) if part.strip()]
+        spans = []
+        for length in range(1, 4):
+            for start in range(0, len(parts) - length + 1):
+                spans.append(" ".join(parts[start:start + length]) if length > 1 else parts[start])
+        if len(parts) > 3:
+            spans.append(" ".join(parts))
+        return parts, spans
+
+    def _score_span(self, span, scores):
+        """ Add the candidates for one part of an affiliation to scores, as organization -> (score, weight) """
+        tokens = list(dict.fromkeys(self.tokenize(span)))
+        if not tokens:
+            return
+        span_weight = self._weight(tokens)
+        exact = self.exact_names.get(" ".join(tokens))
+        if exact:
+            for organization_index in exact:
+                self._add_score(scores, organization_index, 1.0, span_weight)
+            return
+
+        # Collect candidates from the names sharing the rarer words of the span
+        indexed_tokens = sorted((token for token in tokens if token in self.postings), key=lambda t: -self.idf[t])
+        selective_tokens = [token for token in indexed_tokens if len(self.postings[token]) <= self.max_postings]
+        if not selective_tokens:
+            selective_tokens = indexed_tokens[:1]
+        shared_weights = defaultdict(float)
+        for token in selective_tokens:
+            token_idf = self.idf[token]
+            for name_index in self.postings[token]:
+                shared_weights[name_index] += token_idf
+        candidates = sorted(shared_weights.items(), key=lambda item: -item[1])[:self.candidates_per_part]
+
+        # Score the best of them on all of their words: the weighted overlap of the two sets of words
+        span_tokens = set(tokens)
+        for name_index, shared_weight in candidates:
+            organization_index, name_tokens, name_weight = self.names[name_index]
+            shared = sum(self.idf[token] for token in name_tokens if token in span_tokens)
+            self._add_score(scores, organization_index, 2 * shared / (span_weight + name_weight), shared)
+
+    def _add_score(self, scores, organization_index, score, weight):
+        if organization_index not in scores or (score, weight) > scores[organization_index]:
+            scores[organization_index] = (score, weight)
+
+    def match(self, affiliation):
+        """ The best (ror_id, score, country_code) for an affiliation string; ror_id is None below min_score """
+        if not affiliation or not affiliation.strip():
+            return None, 0.0, None
+        parts, spans = self._parts(affiliation)
+        scores = {}
+        for span in spans:
+            self._score_span(span, scores)
+        for part in parts:
+            if self.acronym_pattern.match(part) and part in self.acronyms:
+                for organization_index in self.acronyms[part]:
+                    self._add_score(scores, organization_index, self.acronym_score, 0.0)
+        if not scores:
+            return None, 0.0, None
+
+        # A country named in the affiliation counts against organizations elsewhere
+        affiliation_countries = set()
+        for part in parts:
+            country_code = self.countries.get(self.normalize(part))
+            if country_code:
+                affiliation_countries.add(country_code)
+        ranked = []
+        for organization_index, (score, weight) in scores.items():
+            country_code = self.organizations[organization_index][1]
+            if affiliation_countries and country_code not in affiliation_countries:
+                score = score * self.country_penalty
+            ranked.append((score, weight, organization_index))
+        ranked.sort(key=lambda item: (item[0], item[1]), reverse=True)
+
+        score, weight, organization_index = ranked[0]
+        if len(ranked) > 1 and ranked[1][:2] == (score, weight):
+            # Another organization fits just as well
+            score = score * self.ambiguity_penalty
+        score = round(score, 3)
+        ror_id, country_code = self.organizations[organization_index]
+        if score < self.min_score:
+            return None, score, None
+        return ror_id, score, country_code
+
+    def match_affiliations(self, db, logger, matched_before=0, batch_size=1000):
+        """ Match the affiliations in the database that have not been matched since matched_before, and save the
+        results, matched or not, so each affiliation string is only matched once; returns how many matched """
+        affiliations = db.get_unmatched_affiliations(matched_before)
+        logger.info("Matching {} affiliations to ROR organizations".format(len(affiliations)))
+        matches = []
+        matched_count = 0
+        for affiliation in affiliations:
+            ror_id, score, country_code = self.match(affiliation)
+            if ror_id is not None:
+                matched_count += 1
+            matches.append((affiliation, ror_id, score, country_code))
+            if len(matches) >= batch_size:
+                db.write_ror_affiliation_matches(matches)
+                matches = []
+        db.write_ror_affiliation_matches(matches)
+        logger.info("Matched {} of {} affiliations to ROR organizations".format(matched_count, len(affiliations)))
+        return matched_count
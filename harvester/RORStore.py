@@ -0,0 +1,177 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+
+class RORStore(object):
+    """ The parts of the ROR data the harvester uses (country, names, aliases and acronyms) in an indexed sqlite file """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        # Read only, and shared by refresh worker threads under the lock
+        self.con = sqlite3.connect("file:{}?mode=ro".format(filename), uri=True, check_same_thread=False)
+        self.con.row_factory = sqlite3.Row
+        self.count = int(self.get_setting("entries") or 0)
+
+    @staticmethod
+    def store_filename(ror_data_file):
+        """ Where the store for this ROR data file is kept """
+        return os.path.splitext(ror_data_file)[0] + ".db"
+
+    @staticmethod
+    def build(filename, ror_json_file, source=None):
+        """ Convert a ROR data dump into a new store, replacing filename once it is complete; returns the entry count """
+        temp_filename = filename + ".tmp"
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+        con = sqlite3.connect(temp_filename)
+        count = 0
+        try:
+            con.executescript("""
+                PRAGMA journal_mode = OFF;
+                PRAGMA synchronous = OFF;
+                CREATE TABLE organizations (ror_id TEXT PRIMARY KEY NOT NULL, name TEXT, country_code TEXT,
+                    country_name TEXT) WITHOUT ROWID;
+                CREATE TABLE names (ror_id TEXT NOT NULL, name TEXT NOT NULL, name_type TEXT NOT NULL);
+                CREATE TABLE settings (setting_name TEXT PRIMARY KEY NOT NULL, setting_value TEXT);
+            """)
+            with open(ror_json_file, "r", encoding="utf-8") as f:
+                for ror_entry in RORStore.iter_json_array(f):
+                    organization, names = RORStore.compact_entry(ror_entry)
+                    con.execute("INSERT OR REPLACE INTO organizations VALUES (?,?,?,?)", organization)
+                    con.executemany("INSERT INTO names VALUES (?,?,?)", names)
+                    count += 1
+            con.execute("CREATE INDEX names_by_ror_id ON names (ror_id)")
+            con.executemany("INSERT INTO settings VALUES (?,?)",
+                            [("entries", str(count)), ("source", source or ror_json_file),
+                             ("built_timestamp", str(int(time.time())))])
+            con.commit()
+        finally:
+            con.close()
+        os.replace(temp_filename, filename)
+        return count
+
+    @staticmethod
+    def iter_json_array(f, chunk_size=1048576):
+        """ The items of a JSON array, decoded one at a time so the whole file is never held in memory """
+        decoder = json.JSONDecoder()
+        buffer = ""
+        position = 0
+        started = False
+        eof = False
+        while True:
+            # Skip whitespace and the separators around the items
+            while position < len(buffer) and buffer[position] in " \t\r\n,[":
+                if buffer[position] == "[":
+                    started = True
+                position += 1
+            if position < len(buffer) and buffer[position] == "]" and started:
+                return
+            try:
+                if position >= len(buffer):
+                    raise ValueError("Need more data")
+                item, end = decoder.raw_decode(buffer, position)
+            except ValueError:
+                if eof:
+                    if buffer[position:].strip():
+                        raise
+                    return
+                chunk = f.read(chunk_size)
+                eof = chunk == ""
+                buffer = buffer[position:] + chunk
+                position = 0
+                continue
+            yield item
+            position = end
+
+    @staticmethod
+    def compact_entry(ror_entry):
+        """ The organization row and name rows for one ROR record, in either the v1 or the v2 ROR schema """
+        ror_id = ror_entry["id"]
+        names = []
+        name = ror_entry.get("name")
+        country_code = None
+        country_name = None
+        if "names" in ror_entry:
+            # v2: every name in one list, with its types
+            for name_entry in ror_entry["names"]:
+                for name_type in name_entry.get("types", []):
+                    if name_type == "ror_display":
+                        name = name_entry["value"]
+                    names.append((ror_id, name_entry["value"], "name" if name_type == "ror_display" else name_type))
+            for location in ror_entry.get("locations", []):
+                details = location.get("geonames_details", {})
+                if details.get("country_code"):
+                    country_code = details["country_code"]
+                    country_name = details.get("country_name")
+                    break
+        else:
+            if name:
+                names.append((ror_id, name, "name"))
+            names.extend((ror_id, alias, "alias") for alias in ror_entry.get("aliases", []) if alias)
+            names.extend((ror_id, acronym, "acronym") for acronym in ror_entry.get("acronyms", []) if acronym)
+            names.extend((ror_id, label["label"], "label") for label in ror_entry.get("labels", []) if label.get("label"))
+            country = ror_entry.get("country") or {}
+            country_code = country.get("country_code")
+            country_name = country.get("country_name")
+        return (ror_id, name, country_code, country_name), names
+
+    def get_setting(self, setting_name):
+        with self.lock:
+            row = self.con.execute("SELECT setting_value FROM settings WHERE setting_name = ?", (setting_name,)).fetchone()
+        return row["setting_value"] if row else None
+
+    def get(self, ror_id, default=None):
+        """ The ROR entry for this id, with the fields the ROR dump uses, or default if there is none """
+        with self.lock:
+            organization = self.con.execute("SELECT * FROM organizations WHERE ror_id = ?", (ror_id,)).fetchone()
+            if organization is None:
+                return default
+            names = self.con.execute("SELECT name, name_type FROM names WHERE ror_id = ? ORDER BY rowid",
+                                     (ror_id,)).fetchall()
+        entry = {"id": ror_id, "name": organization["name"], "aliases": [], "acronyms": [], "labels": []}
+        if organization["country_code"]:
+            entry["country"] = {"country_code": organization["country_code"], "country_name": organization["country_name"]}
+        for row in names:
+            if row["name_type"] == "alias":
+                entry["aliases"].append(row["name"])
+            elif row["name_type"] == "acronym":
+                entry["acronyms"].append(row["name"])
+            elif row["name_type"] == "label":
+                entry["labels"].append({"label": row["name"]})
+        return entry
+
+    def __getitem__(self, ror_id):
+        entry = self.get(ror_id)
+        if entry is None:
+            raise KeyError(ror_id)
+        return entry
+
+    def __contains__(self, ror_id):
+        with self.lock:
+            return self.con.execute("SELECT 1 FROM organizations WHERE ror_id = ?", (ror_id,)).fetchone() is not None
+
+    def __len__(self):
+        return self.count
+
+    def iter_names(self):
+        """ Every (ror_id, name, name_type, country_code) in the store """
+        with self.lock:
+            rows = self.con.execute("""SELECT names.ror_id, names.name, names.name_type, organizations.country_code
+                FROM names JOIN organizations ON organizations.ror_id = names.ror_id ORDER BY names.rowid""").fetchall()
+        for row in rows:
+            yield row["ror_id"], row["name"], row["name_type"], row["country_code"]
+
+    def countries(self):
+        """ Country name -> country code, for every country in the store """
+        with self.lock:
+            rows = self.con.execute("""SELECT DISTINCT country_name, country_code FROM organizations
+                WHERE country_name IS NOT NULL AND country_code IS NOT NULL""").fetchall()
+        return {row["country_name"]: row["country_code"] for row in rows}
+
+    def close(self):
+        with self.lock:
+            self.con.close()
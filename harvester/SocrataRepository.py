@@ -1,5 +1,4 @@
 from harvester.HarvestRepository import HarvestRepository
-from harvester.rate_limited import rate_limited
 from sodapy import Socrata
 from datetime import datetime
 import time
@@ -10,9 +9,11 @@ class SocrataRepository(HarvestRepository):
 
     def setRepoParams(self, repoParams):
         self.metadataprefix = "socrata"
+        self.rate_limit_per_second = 5
         super(SocrataRepository, self).setRepoParams(repoParams)
         # sodapy doesn't like http/https preceding URLs
-        self.socratarepo = Socrata(self.url, self.socrata_app_token)
+        self.socratarepo = Socrata(self.url, self.socrata_app_token, timeout=float(self.http_timeout),
+                                   session_adapter={"prefix": "https://", "adapter": self.http_client.adapter})
         self.domain_metadata = []
 
 
@@ -39,13 +40,8 @@ class SocrataRepository(HarvestRepository):
         self.repository_id = self.db.update_repo(**kwargs)
         records = self.socratarepo.datasets()
 
-        item_count = 0
-        for rec in records:
-            self.db.write_header(rec["resource"]["id"], self.item_url_pattern, self.repository_id)
-            item_count = item_count + 1
-            if (item_count % self.update_log_after_numitems == 0):
-                tdelta = time.time() - self.tstart + 0.1
-                self.logger.info("Done {} item headers after {} ({:.1f} items/sec)".format(item_count, self.formatter.humanize(tdelta), item_count/tdelta) )
+        item_count = self._write_page_headers([rec["resource"]["id"] for rec in records], 0)
+        self.delete_unlisted_records()
 
         self.logger.info("Found {} items in feed".format(item_count) )
 
@@ -139,14 +135,13 @@ class SocrataRepository(HarvestRepository):
         return record
 
 
-    @rate_limited(5)
     def _update_record(self,record):
 
         try:            
             socrata_record = self.socratarepo.get_metadata(record["local_identifier"])
             oai_record = self.format_socrata_to_oai(socrata_record,record["local_identifier"])
             if oai_record:
-                self.db.write_record(oai_record, self)
+                self.write_record(oai_record)
             return True
 
         except Exception as e:
@@ -0,0 +1,59 @@
+import asyncio
+import threading
+import time
+
+
+class TokenBucket(object):
+    """ Lets through rate requests per second on average, in bursts of up to burst requests """
+
+    def __init__(self, rate, burst=1, min_rate=None):
+        self.max_rate = float(rate)
+        self.rate = self.max_rate
+        self.min_rate = float(min_rate) if min_rate else self.max_rate / 16
+        self.burst = max(1, int(burst))
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def _reserve(self):
+        """ Take a token, returning how long the caller has to wait before it may use it """
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens = self.tokens - 1
+            wait = 0
+            if self.tokens < 0:
+                wait = -self.tokens / self.rate
+            return max(wait, self.paused_until - now)
+
+    def acquire(self):
+        """ Block the calling thread until a request may be made """
+        wait = self._reserve()
+        if wait > 0:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """ Same as acquire(), without blocking the event loop """
+        wait = self._reserve()
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+    def pause(self, seconds):
+        """ Let nothing through for this many seconds, e.g. from a Retry-After header """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + float(seconds))
+
+    def slow_down(self, retry_after=None):
+        """ The server said we are going too fast: halve the rate, and wait as long as it asked """
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+        if retry_after:
+            self.pause(retry_after)
+
+    def speed_up(self):
+        """ After a successful request, creep back towards the configured rate """
+        if self.rate < self.max_rate:
+            with self.lock:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
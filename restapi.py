@@ -8,6 +8,7 @@ import atexit
 import time
 import daemon
 import os
+import threading
 from lockfile.pidlockfile import PIDLockFile
 
 from harvester.DBInterface import DBInterface
@@ -25,6 +26,7 @@ api = Api(app)
 
 CACHE = {"repositories": {"count": 0, "repositories": [], "timestamp": 0}}
 CONFIG = {"restapi": None, "db": None, "handles": {}}
+HANDLES_LOCK = threading.Lock()
 
 
 def get_log():
@@ -36,11 +38,21 @@ def get_log():
 
 
 def get_db():
-    if "db" not in CONFIG["handles"]:
-        CONFIG["handles"]["db"] = DBInterface(CONFIG['db'])
+    with HANDLES_LOCK:
+        if "db" not in CONFIG["handles"]:
+            # Requests are served on several threads, so each borrows a connection from the pool
+            dbparams = dict(CONFIG['db'])
+            dbparams["pool_size"] = CONFIG["restapi"]["api"].get("db_pool_size", 10)
+            CONFIG["handles"]["db"] = DBInterface(dbparams)
     return CONFIG["handles"]["db"]
 
 
+@app.teardown_request
+def release_db(exception=None):
+    if "db" in CONFIG["handles"]:
+        CONFIG["handles"]["db"].release_connection()
+
+
 def get_exporter():
     if "exporter" not in CONFIG["handles"]:
         CONFIG["export"]["destination"] = "stream"
@@ -163,7 +175,9 @@ class Record(Resource):
 class Exporter(Resource):
     def get(self):
         def _generate_resp():
-            yield get_exporter()._generate(False)
+            # This runs after the request has been torn down, so it borrows a connection of its own
+            with get_db().pooled_connection():
+                yield get_exporter()._generate(False)
 
         get_log().debug("{} GET /exporter".format(request.remote_addr))
 
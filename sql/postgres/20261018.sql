@@ -0,0 +1 @@
+alter table records add column if not exists content_hash VARCHAR(40);
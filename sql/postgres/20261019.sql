@@ -0,0 +1,2 @@
+-- Already in place unless it was dropped by hand; the sqlite migration of the same date puts it back
+create unique index if not exists records_by_repository on records (repository_id, local_identifier);
@@ -0,0 +1,2 @@
+alter table repositories add column if not exists last_refresh_timestamp INTEGER DEFAULT 0;
+create index if not exists records_by_repository_modified_timestamp on records (repository_id, modified_timestamp);
@@ -0,0 +1,4 @@
+CREATE SEQUENCE IF NOT EXISTS ror_affiliation_matches_id_sequence;
+SELECT setval('ror_affiliation_matches_id_sequence', coalesce(max(ror_affiliation_match_id), 0) + 1, false) FROM ror_affiliation_matches;
+ALTER TABLE ror_affiliation_matches ALTER ror_affiliation_match_id SET DEFAULT NEXTVAL('ror_affiliation_matches_id_sequence');
+create index if not exists ror_affiliation_matches_by_affiliation_string on ror_affiliation_matches (affiliation_string);
@@ -0,0 +1 @@
+alter table repositories add column if not exists last_complete_listing_timestamp INTEGER DEFAULT 0;
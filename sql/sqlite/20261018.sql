@@ -0,0 +1 @@
+alter table records add column content_hash TEXT;
@@ -0,0 +1,33 @@
+-- records_by_repository was lost when records was rebuilt in 20211123; before putting it back,
+-- remove any duplicate headers written since, keeping the live, most recently modified one
+
+BEGIN TRANSACTION;
+
+CREATE TEMP TABLE duplicate_records AS SELECT record_uuid FROM (
+    SELECT record_uuid, ROW_NUMBER() OVER (
+        PARTITION BY repository_id, local_identifier
+        ORDER BY deleted, modified_timestamp DESC, record_uuid) AS record_rank
+    FROM records WHERE local_identifier IS NOT NULL)
+    WHERE record_rank > 1;
+
+DELETE FROM descriptions WHERE record_uuid IN (SELECT record_uuid FROM duplicate_records);
+DELETE FROM domain_metadata WHERE record_uuid IN (SELECT record_uuid FROM duplicate_records);
+DELETE FROM geobbox WHERE record_uuid IN (SELECT record_uuid FROM duplicate_records);
+DELETE FROM geofile WHERE record_uuid IN (SELECT record_uuid FROM duplicate_records);
+DELETE FROM geoplace WHERE record_uuid IN (SELECT record_uuid FROM duplicate_records);
+DELETE FROM geopoint WHERE record_uuid IN (SELECT record_uuid FROM duplicate_records);
+DELETE FROM records_x_access WHERE record_uuid IN (SELECT record_uuid FROM duplicate_records);
+DELETE FROM records_x_affiliations WHERE record_uuid IN (SELECT record_uuid FROM duplicate_records);
+DELETE FROM records_x_crdc WHERE record_uuid IN (SELECT record_uuid FROM duplicate_records);
+DELETE FROM records_x_creators WHERE record_uuid IN (SELECT record_uuid FROM duplicate_records);
+DELETE FROM records_x_publishers WHERE record_uuid IN (SELECT record_uuid FROM duplicate_records);
+DELETE FROM records_x_rights WHERE record_uuid IN (SELECT record_uuid FROM duplicate_records);
+DELETE FROM records_x_subjects WHERE record_uuid IN (SELECT record_uuid FROM duplicate_records);
+DELETE FROM records_x_tags WHERE record_uuid IN (SELECT record_uuid FROM duplicate_records);
+DELETE FROM records WHERE record_uuid IN (SELECT record_uuid FROM duplicate_records);
+
+DROP TABLE duplicate_records;
+
+CREATE UNIQUE INDEX IF NOT EXISTS records_by_repository ON records (repository_id, local_identifier);
+
+COMMIT;
@@ -0,0 +1 @@
+create index if not exists ror_affiliation_matches_by_affiliation_string on ror_affiliation_matches (affiliation_string);
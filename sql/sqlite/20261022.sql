@@ -0,0 +1 @@
+alter table repositories add column last_complete_listing_timestamp INTEGER DEFAULT 0;
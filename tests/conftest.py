@@ -0,0 +1,100 @@
+import os
+import sys
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from harvester.DBInterface import DBInterface
+
+
+class ListLogger(object):
+    """ Keeps log messages in a list, so tests can look at them """
+
+    def __init__(self):
+        self.messages = []
+
+    def debug(self, message):
+        self.messages.append(("debug", message))
+
+    def info(self, message):
+        self.messages.append(("info", message))
+
+    def error(self, message):
+        self.messages.append(("error", message))
+
+
+class StubRepository(object):
+    """ The parts of a repository that DBInterface.write_record() and write_records() use """
+
+    def __init__(self, repository_id=1, item_url_pattern=None):
+        self.repository_id = repository_id
+        self.item_url_pattern = item_url_pattern
+        self.domain_metadata = {}
+
+
+def add_repository(db, repository_id=1, repository_type="oai"):
+    db.update_records_raw_query(
+        "INSERT INTO repositories (repository_id, repository_url, repository_set, repository_name, repository_type, "
+        "enabled, last_crawl_timestamp) VALUES ({0}, 'https://example.org/repo{0}', '', 'Repository {0}', '{1}', 1, 0)"
+        .format(repository_id, repository_type))
+
+
+def sample_record(i):
+    """ A mapped record that uses every kind of detail the database stores, varying with i """
+    record = {
+        "identifier": "oai:example.org:{}".format(i),
+        "item_url": "https://example.org/record/{}".format(i),
+        "title": "Title {}".format(i),
+        "title_fr": "Titre {}".format(i) if i % 3 == 0 else "",
+        "pub_date": "2020-01-{:02d}".format(1 + i % 28),
+        "series": "Series {}".format(i % 4) if i % 4 == 0 else "",
+        "creator": ["Creator {}, A.".format(i % 5), "Creator {}, B.".format(i % 7)],
+        "tags": ["tag {}".format(i % 6), "tag {}".format(i % 4)],
+        "subject": ["Subject {}".format(i % 3)],
+        "publisher": "Publisher {}".format(i % 2),
+        "rights": "CC-BY {}".format(i % 3),
+        "access": "Public",
+        "description": "Description of record {}".format(i),
+        "files_size": i * 10
+    }
+    if i % 2 == 0:
+        record["creator"].append({"name": "Person {}".format(i % 9), "orcid": "0000-0000-0000-{:04d}".format(i % 9)})
+        record["affiliation"] = ["University {}".format(i % 4),
+                                 {"affiliation_name": "Institute {}".format(i % 3),
+                                  "affiliation_ror": "https://ror.org/0{}".format(i % 3)}]
+        record["tags_fr"] = ["mot {}".format(i % 6)]
+        record["description_fr"] = "Description du document {}".format(i)
+        record["contributor"] = ["Contributor {}".format(i % 5)]
+    if i % 3 == 0:
+        record["geoplaces"] = [{"place_name": "Place {}".format(i % 4)},
+                               {"country": "Canada", "province_state": "BC", "city": "Vancouver", "other": ""}]
+        record["geopoints"] = [{"lat": "49.{}".format(i), "lon": -123.1 - i / 100.0}]
+        record["geobboxes"] = [{"westLon": -124.5, "eastLon": -122.0, "northLat": 50.25, "southLat": 48.5}]
+        record["geofiles"] = [{"filename": "file{}.tif".format(i), "uri": "https://example.org/file{}.tif".format(i)}]
+    if i % 5 == 0:
+        record["crdc"] = [{"crdc_code": "RDF{}".format(i % 3), "crdc_group_en": "Group", "crdc_group_fr": "Groupe",
+                           "crdc_class_en": "Class", "crdc_class_fr": "Classe", "crdc_field_en": "Field",
+                           "crdc_field_fr": "Domaine"}]
+    return record
+
+
+def sample_domain_metadata(i):
+    if i % 4:
+        return {}
+    return {"https://example.org/schema#depth": [str(i), str(i * 2)]}
+
+
+@pytest.fixture
+def make_db(tmp_path, monkeypatch):
+    """ Returns a function that creates an empty sqlite harvest database, with one repository """
+    # The schema is created by the migrations in sql/
+    monkeypatch.chdir(REPO_ROOT)
+
+    def make(name="harvest"):
+        db = DBInterface({"type": "sqlite", "dbname": str(tmp_path / (name + ".db"))})
+        db.setLogger(ListLogger())
+        add_repository(db)
+        return db
+
+    return make
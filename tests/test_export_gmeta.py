@@ -0,0 +1,48 @@
+import glob
+import json
+import os
+from conftest import ListLogger, StubRepository, sample_record, sample_domain_metadata
+from harvester.ExporterGmeta import ExporterGmeta
+
+RECORD_COUNT = 45
+
+
+def export(db, path, workers):
+    exporter = ExporterGmeta(db, ListLogger(), {"export_workers": workers, "export_file_limit_mb": 1})
+    # Small ranges, so even this few records are split between the workers
+    exporter.records_per_chunk = 10
+    export_path = str(path / "export")
+    os.makedirs(export_path)
+    exporter.export(export_filepath=export_path, only_new_records=False, temp_filepath=str(path / "temp"),
+                    export_repository_id=None, destination="file")
+    entries = {}
+    for filename in glob.glob(os.path.join(export_path, "gmeta_*.json")):
+        with open(filename) as gmeta_file:
+            for entry in json.load(gmeta_file)["ingest_data"]["gmeta"]:
+                assert entry["subject"] not in entries
+                entries[entry["subject"]] = entry
+    deleted = []
+    if os.path.exists(os.path.join(export_path, "delete.txt")):
+        with open(os.path.join(export_path, "delete.txt")) as delete_file:
+            deleted = sorted(delete_file.read().split("\n"))
+    return exporter, entries, deleted
+
+
+def test_parallel_export_has_the_same_entries(make_db, tmp_path):
+    db = make_db()
+    repo = StubRepository()
+    db.write_records([sample_record(i) for i in range(RECORD_COUNT)], repo,
+                     [sample_domain_metadata(i) for i in range(RECORD_COUNT)])
+    db.update_records_raw_query("UPDATE records SET deleted = 1 WHERE local_identifier LIKE '%7'")
+
+    serial, serial_entries, serial_deleted = export(db, tmp_path / "serial", 1)
+    parallel, parallel_entries, parallel_deleted = export(db, tmp_path / "parallel", 2)
+
+    deleted_count = len([i for i in range(RECORD_COUNT) if i % 10 == 7])
+    assert len(serial_entries) == RECORD_COUNT - deleted_count
+    assert len(serial_deleted) == deleted_count
+    assert ("info", "Exporter: 5 record ranges across 2 workers") in parallel.logger.messages
+    assert parallel.exported_count == serial.exported_count
+    assert parallel_entries == serial_entries
+    assert parallel_deleted == serial_deleted
+    assert len(glob.glob(str(tmp_path / "parallel" / "temp" / "*"))) == 0
@@ -0,0 +1,105 @@
+import threading
+import time
+import pytest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from conftest import ListLogger
+from harvester.OAIRepository import OAIRepository
+from harvester.HarvestMetrics import HarvestMetrics
+
+PAGE_SIZE = 5
+RECORD_COUNT = 12
+
+
+class OAIHandler(BaseHTTPRequestHandler):
+    """ ListRecords in pages of PAGE_SIZE oai_dc records; the server's fail_from page and later ones fail with a 500 """
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        if query.get("verb") != ["ListRecords"]:
+            return self.respond(500, b"")
+        start = int(query["resumptionToken"][0]) if "resumptionToken" in query else 0
+        if start == 0:
+            self.server.from_params.append(query.get("from", [None])[0])
+        if self.server.fail_from is not None and start >= self.server.fail_from:
+            return self.respond(500, b"")
+        end = min(start + PAGE_SIZE, RECORD_COUNT)
+        records = "".join(self.record(i) for i in range(start, end))
+        token = "<resumptionToken>{}</resumptionToken>".format(end) if end < RECORD_COUNT else ""
+        self.respond(200, ('<?xml version="1.0" encoding="UTF-8"?>'
+                           '<OAI-PMH xmlns="http://www.openarchives.org/OAI/2.0/"><ListRecords>{}{}</ListRecords>'
+                           '</OAI-PMH>').format(records, token).encode("utf-8"))
+
+    def record(self, i):
+        return ('<record><header><identifier>oai:example.org:{0}</identifier><datestamp>2020-01-01</datestamp></header>'
+                '<metadata><oai_dc:dc xmlns:oai_dc="http://www.openarchives.org/OAI/2.0/oai_dc/" '
+                'xmlns:dc="http://purl.org/dc/elements/1.1/"><dc:title>Title {0}</dc:title>'
+                '<dc:creator>Creator {0}</dc:creator><dc:date>2020-01-01</dc:date>'
+                '<dc:identifier>https://example.org/record/{0}</dc:identifier></oai_dc:dc></metadata></record>').format(i)
+
+    def respond(self, status, body):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def oai_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), OAIHandler)
+    server.fail_from = None
+    server.from_params = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def crawl(db, server, workers):
+    repo = OAIRepository({"metrics": HarvestMetrics(), "http_retries": 0})
+    repo.setLogger(ListLogger())
+    repo.setDatabase(db)
+    repo.setRepoParams({"name": "OAI", "type": "oai", "url": "http://127.0.0.1:{}/oai".format(server.server_port),
+                        "homepage_url": "https://example.org/", "enabled": True, "repo_refresh_days": 0,
+                        "rate_limit_per_second": None, "oai_record_workers": workers})
+    repo.crawl()
+    return repo
+
+
+def record_count(db, repo):
+    return len(db.get_records_raw_query("SELECT * FROM records WHERE repository_id = {}".format(repo.repository_id)))
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_failed_crawl_does_not_move_from_datestamp(make_db, oai_server, workers):
+    db = make_db()
+
+    # A crawl that fails part way keeps what it harvested, but the next crawl still asks for everything
+    oai_server.fail_from = PAGE_SIZE
+    repo = crawl(db, oai_server, workers)
+    assert record_count(db, repo) == PAGE_SIZE
+    assert db.get_repo_last_complete_listing(repo.repository_id) == 0
+    assert repo.get_oai_from_datestamp() is None
+
+    oai_server.fail_from = None
+    listing_started = int(time.time())
+    repo = crawl(db, oai_server, workers)
+    assert record_count(db, repo) == RECORD_COUNT
+    last_listing = db.get_repo_last_complete_listing(repo.repository_id)
+    assert listing_started - 1 <= last_listing <= time.time()
+    from_datestamp = repo.get_oai_from_datestamp()
+    assert from_datestamp == time.strftime("%Y-%m-%d", time.gmtime(last_listing - 24 * 3600))
+
+    # A failed incremental crawl leaves the datestamp where the last complete listing put it
+    oai_server.fail_from = 0
+    repo = crawl(db, oai_server, workers)
+    assert db.get_repo_last_complete_listing(repo.repository_id) == last_listing
+
+    oai_server.fail_from = None
+    crawl(db, oai_server, workers)
+    assert oai_server.from_params == [None, None, from_datestamp, from_datestamp]
@@ -0,0 +1,102 @@
+import time
+from conftest import ListLogger, StubRepository, sample_record
+from harvester.HarvestRepository import HarvestRepository
+from harvester.HarvestMetrics import HarvestMetrics
+
+
+class ListingRepository(HarvestRepository):
+    """ A repository that lists the identifiers a test gives it """
+
+    def setRepoParams(self, repoParams):
+        self.listing = []
+        self.skip_part = False
+        super(ListingRepository, self).setRepoParams(repoParams)
+
+    def _crawl(self):
+        self._write_page_headers(self.listing, 0)
+        if self.skip_part:
+            self.listing_incomplete = True
+        self.delete_unlisted_records()
+
+
+def make_repository(db):
+    repo = ListingRepository({"metrics": HarvestMetrics()})
+    repo.setLogger(ListLogger())
+    repo.setDatabase(db)
+    repo.setRepoParams({"name": "Repository 1", "url": "https://example.org/repo1", "homepage_url": "https://example.org/",
+                        "item_url_pattern": "https://example.org/record/%id%", "enabled": True,
+                        "repo_refresh_days": 0, "update_log_after_numitems": 1000})
+    repo.repository_id = 1
+    return repo
+
+
+def identifiers(count):
+    return ["oai:example.org:{}".format(i) for i in range(count)]
+
+
+def crawl(repo, listing, skip_part=False):
+    repo.listing = listing
+    repo.skip_part = skip_part
+    repo.crawl()
+
+
+def deleted_identifiers(db):
+    rows = db.get_records_raw_query("SELECT local_identifier FROM records WHERE deleted = 1")
+    return sorted(row["local_identifier"] for row in rows)
+
+
+def test_unlisted_records_are_deleted(make_db):
+    db = make_db()
+    repo = make_repository(db)
+    crawl(repo, identifiers(20))
+    assert deleted_identifiers(db) == []
+
+    crawl(repo, identifiers(17))
+    assert deleted_identifiers(db) == ["oai:example.org:17", "oai:example.org:18", "oai:example.org:19"]
+
+
+def test_unlisted_records_are_kept_if_the_listing_looks_broken(make_db):
+    db = make_db()
+    repo = make_repository(db)
+    crawl(repo, identifiers(20))
+
+    # More than max_unlisted_fraction of the items missing
+    crawl(repo, identifiers(5))
+    assert deleted_identifiers(db) == []
+
+    # Part of the listing skipped
+    crawl(repo, identifiers(17), skip_part=True)
+    assert deleted_identifiers(db) == []
+
+    # Nothing listed
+    crawl(repo, [])
+    assert deleted_identifiers(db) == []
+
+
+def test_relisted_records_are_revived_and_refreshed(make_db):
+    db = make_db()
+    repo = make_repository(db)
+    crawl(repo, identifiers(4))
+    stub = StubRepository(item_url_pattern=repo.item_url_pattern)
+    for i in range(4):
+        db.write_record(sample_record(i), stub)
+    assert len(db.get_records_raw_query("SELECT * FROM records_x_creators")) > 0
+
+    crawl(repo, identifiers(3))
+    assert deleted_identifiers(db) == ["oai:example.org:3"]
+    removed = db.get_records_raw_query("SELECT recs.local_identifier FROM records_x_creators x "
+                                       "JOIN records recs ON recs.record_uuid = x.record_uuid "
+                                       "WHERE recs.local_identifier = 'oai:example.org:3'")
+    assert len(removed) == 0
+
+    crawl(repo, identifiers(4))
+    assert deleted_identifiers(db) == []
+    stale = db.get_stale_records(int(time.time()) - 86400, 1, 10)
+    assert [record["local_identifier"] for record in stale] == ["oai:example.org:3"]
+
+    # The refresh writes the revived record in full, although its metadata has not changed
+    db.write_record(sample_record(3), stub)
+    restored = db.get_records_raw_query("SELECT recs.local_identifier FROM records_x_creators x "
+                                        "JOIN records recs ON recs.record_uuid = x.record_uuid "
+                                        "WHERE recs.local_identifier = 'oai:example.org:3'")
+    assert len(restored) > 0
@@ -0,0 +1,99 @@
+import copy
+from conftest import StubRepository, sample_record, sample_domain_metadata
+
+RECORD_COLUMNS = ["title", "title_fr", "pub_date", "series", "deleted", "item_url", "files_size", "files_altered",
+                  "content_hash"]
+
+DETAIL_QUERIES = {
+    "creators": "SELECT recs.local_identifier, c.creator, c.orcid_id, x.is_contributor FROM records_x_creators x "
+                "JOIN creators c ON c.creator_id = x.creator_id JOIN records recs ON recs.record_uuid = x.record_uuid",
+    "tags": "SELECT recs.local_identifier, t.tag, t.language FROM records_x_tags x JOIN tags t ON t.tag_id = x.tag_id "
+            "JOIN records recs ON recs.record_uuid = x.record_uuid",
+    "subjects": "SELECT recs.local_identifier, s.subject, s.language FROM records_x_subjects x "
+                "JOIN subjects s ON s.subject_id = x.subject_id JOIN records recs ON recs.record_uuid = x.record_uuid",
+    "publishers": "SELECT recs.local_identifier, p.publisher FROM records_x_publishers x "
+                  "JOIN publishers p ON p.publisher_id = x.publisher_id JOIN records recs ON recs.record_uuid = x.record_uuid",
+    "affiliations": "SELECT recs.local_identifier, a.affiliation, a.affiliation_ror FROM records_x_affiliations x "
+                    "JOIN affiliations a ON a.affiliation_id = x.affiliation_id "
+                    "JOIN records recs ON recs.record_uuid = x.record_uuid",
+    "rights": "SELECT recs.local_identifier, r.rights FROM records_x_rights x JOIN rights r ON r.rights_id = x.rights_id "
+              "JOIN records recs ON recs.record_uuid = x.record_uuid",
+    "access": "SELECT recs.local_identifier, a.access FROM records_x_access x JOIN access a ON a.access_id = x.access_id "
+              "JOIN records recs ON recs.record_uuid = x.record_uuid",
+    "crdc": "SELECT recs.local_identifier, c.crdc_code, c.crdc_field_en FROM records_x_crdc x "
+            "JOIN crdc c ON c.crdc_id = x.crdc_id JOIN records recs ON recs.record_uuid = x.record_uuid",
+    "descriptions": "SELECT recs.local_identifier, d.description, d.language FROM descriptions d "
+                    "JOIN records recs ON recs.record_uuid = d.record_uuid",
+    "geoplace": "SELECT recs.local_identifier, g.country, g.province_state, g.city, g.other, g.place_name FROM geoplace g "
+                "JOIN records recs ON recs.record_uuid = g.record_uuid",
+    "geopoint": "SELECT recs.local_identifier, g.lat, g.lon FROM geopoint g JOIN records recs ON recs.record_uuid = g.record_uuid",
+    "geobbox": "SELECT recs.local_identifier, g.westLon, g.eastLon, g.northLat, g.southLat FROM geobbox g "
+               "JOIN records recs ON recs.record_uuid = g.record_uuid",
+    "geofile": "SELECT recs.local_identifier, g.filename, g.uri FROM geofile g JOIN records recs ON recs.record_uuid = g.record_uuid",
+    "domain_metadata": "SELECT recs.local_identifier, s.namespace, d.field_name, d.field_value FROM domain_metadata d "
+                       "JOIN domain_schemas s ON s.schema_id = d.schema_id JOIN records recs ON recs.record_uuid = d.record_uuid"
+}
+
+
+def database_contents(db):
+    """ Everything stored about each record, by local identifier, without the ids that depend on insertion order """
+    contents = {}
+    for row in db.get_records_raw_query("SELECT * FROM records"):
+        contents[row["local_identifier"]] = {column: row[column] for column in RECORD_COLUMNS}
+    for table, sql in DETAIL_QUERIES.items():
+        for row in db.get_records_raw_query(sql):
+            row = tuple(row)
+            contents[row[0]].setdefault(table, []).append(row[1:])
+    for record in contents.values():
+        for table in DETAIL_QUERIES:
+            record[table] = sorted(record.get(table, []), key=repr)
+    return contents
+
+
+def changed_record(i):
+    record = sample_record(i)
+    record["title"] = "Retitled {}".format(i)
+    record["tags"] = ["tag {}".format(i % 6), "new tag"]
+    record.pop("geopoints", None)
+    record.pop("description_fr", None)
+    return record
+
+
+def write_one_at_a_time(db, records, domain_metadata):
+    repo = StubRepository()
+    for record, metadata in zip(records, domain_metadata):
+        repo.domain_metadata = copy.deepcopy(metadata)
+        db.write_record(copy.deepcopy(record), repo)
+
+
+def write_in_batches(db, records, domain_metadata, batch_size=7):
+    repo = StubRepository()
+    for start in range(0, len(records), batch_size):
+        db.write_records(copy.deepcopy(records[start:start + batch_size]), repo,
+                         copy.deepcopy(domain_metadata[start:start + batch_size]))
+
+
+def test_write_records_matches_write_record(make_db):
+    single = make_db("single")
+    batched = make_db("batched")
+
+    # New records
+    records = [sample_record(i) for i in range(30)]
+    domain_metadata = [sample_domain_metadata(i) for i in range(30)]
+    write_one_at_a_time(single, records, domain_metadata)
+    write_in_batches(batched, records, domain_metadata)
+    first_pass = database_contents(single)
+    assert len(first_pass) == 30
+    assert first_pass == database_contents(batched)
+
+    # Changed, unchanged and new records together
+    records = [changed_record(i) if i % 2 else sample_record(i) for i in range(35)]
+    domain_metadata = [{} if i % 8 == 0 else sample_domain_metadata(i) for i in range(35)]
+    write_one_at_a_time(single, records, domain_metadata)
+    write_in_batches(batched, records, domain_metadata)
+    second_pass = database_contents(single)
+    assert len(second_pass) == 35
+    assert second_pass["oai:example.org:1"]["title"] == "Retitled 1"
+    assert second_pass["oai:example.org:3"]["geopoint"] == []
+    assert second_pass["oai:example.org:8"]["domain_metadata"] == []
+    assert second_pass == database_contents(batched)